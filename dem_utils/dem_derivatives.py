@@ -13,14 +13,14 @@ import sys
 import numpy as np
 
 ## Third Party Libs
-import cv2
 from osgeo import gdal
 from scipy.ndimage.filters import generic_filter
 
 ## Local libs
-from misc_utils.RasterWrapper import Raster
+from misc_utils.RasterWrapper import Raster, creation_options
 from misc_utils.logging_utils import create_logger
 from misc_utils.array_utils import interpolate_nodata
+from dem_utils.tpi_engine import tpi_windows, window_name
 
 
 gdal.UseExceptions()
@@ -47,6 +47,9 @@ def gdal_dem_derivative(input_dem, output_path, derivative, return_array=False,
 
     # if args:
         # dem_options = gdal.DEMProcessingOptions(args)
+    # Tiled, compressed GeoTIFF unless otherwise specified
+    if args.get('format', 'GTiff') == 'GTiff':
+        args.setdefault('creationOptions', creation_options())
     logger.info('Creating and writing {} to: {}'.format(derivative, output_path))
     status = gdal.DEMProcessing(output_path, input_dem, derivative, **args)
     # logger.info(status)
@@ -57,61 +60,60 @@ def gdal_dem_derivative(input_dem, output_path, derivative, return_array=False,
         return array
 
 
+def multiscale_tpi(dem, windows, output_path, nodata_val=-9999):
+    """
+    Write TPI for each of windows as bands of output_path, reading dem
+    and building its summed-area tables once, see tpi_windows.
+
+    Parameters
+    ----------
+    dem : os.path.abspath
+        Path to the source DEM.
+    windows : list
+        See tpi_windows.
+    output_path : os.path.abspath
+    nodata_val : float
+
+    Returns
+    -------
+    output_path : os.path.abspath
+    """
+    logger.info('Computing TPI for windows: {}'.format(windows))
+    dem_raster = Raster(dem)
+    tpis = tpi_windows(dem_raster.MaskedArray, windows)
+
+    logger.info('Writing TPI to: {}'.format(output_path))
+    dst_ds = dem_raster.CreateOutput(output_path, depth=len(windows),
+                                     dtype=gdal.GDT_Float32,
+                                     nodata_val=nodata_val)
+    for band, tpi in enumerate(tpis, start=1):
+        dst_ds.GetRasterBand(band).WriteArray(tpi.filled(nodata_val))
+        dst_ds.GetRasterBand(band).SetDescription(
+            'tpi_{}'.format(window_name(windows[band - 1])))
+    dem_raster.FinishOutput(dst_ds, output_path)
+    dst_ds = None
+
+    return output_path
+
+
 def calc_tpi(dem, size):
     """
-    OpenCV implemntation of TPI, updated to ignore NaN values.
+    TPI with a square window, see tpi_windows. Windows are clipped at the
+    edges of dem and NoData is excluded from the window means.
     
     Parameters
     ----------
     dem : np.ndarray
         Expects a MaskedArray with a fill value of the DEM nodata value
-    size : Size of kernel along one axis. Square kernel used.
+    size : Size of kernel along one axis, must be odd. Square kernel used.
 
     Returns
     ----------
     np.ndarray (masked) : TPI
     """
     logger.info('Computing TPI with kernel size {}...'.format(size))
-    # Set up 'kernel'
-    window = (size, size)
-    window_count = size * size
-
-    # Get original mask
-    # mask = copy.deepcopy(dem.mask)
-
-    # # Change fill value to -9999 to ensure NaN corrections are applied correctly
-    # nodata_val = -9999
-    # dem.fill_value = nodata_val
-    nodata_val = dem.fill_value
-
-    # Count the number of non-NaN values in the window for each pixel
-    logger.debug('Counting number of valid pixels per window...')
-    num_valid_window = cv2.boxFilter(np.logical_not(dem.mask).astype(int), -1, window, normalize=False,
-                                     borderType=cv2.BORDER_REPLICATE)
-
-    # Change masked values to fill value
-    dem = dem.data
-
-    # Get raw sum within window for each pixel
-    logger.debug('Getting raw sum including NoData values...')
-    sum_window = cv2.boxFilter(dem, -1, window, normalize=False, borderType=cv2.BORDER_REPLICATE)
-
-    # Correct these sums by removing (fill value*number of times it was include in the sum) for each pixel
-    logger.debug('Correcting for inclusion of NoData values...')
-    sum_window = np.where(num_valid_window != window_count,  # if not all pixels in window were valid
-                          # remove NoData val from sum for each time it was included
-                          sum_window + (-nodata_val * (window_count - num_valid_window)),
-                          sum_window)
-
-    # Compute TPI (value - mean of value in window)
-    logger.debug('Calculating TPI...')
-    with np.errstate(divide='ignore', invalid='ignore'):
-        tpi = dem - (sum_window / num_valid_window)
-    # Remask any originally masked pixels
-    tpi = np.ma.masked_where(dem.data == nodata_val, tpi)
-    # tpi = np.ma.masked_where(mask, tpi)
 
-    return tpi
+    return tpi_windows(dem, [size])[0]
 
 
 # def calc_tpi(dem, size):
@@ -134,6 +136,7 @@ def calc_tpi(dem, size):
     logger.debug('Cleaning up edge no data values...')
     dem = interpolate_nodata(dem, method='nearest')
 
+    import cv2
     kernel = np.ones((size,size),np.float32)/(size*size)
     # -1 indicates new output array
     dem_conv = cv2.filter2D(dem, -1, kernel, borderType=cv2.BORDER_REPLICATE)
@@ -169,7 +172,7 @@ def dem_derivative(dem, derivative, output_path, size, **args):
         Path to the source DEM.
     derivative : STR
         Name of the derivative to create. One of:
-            tpi_ocv
+            tpi_ocv, tpi_std, tpi_multi
             gdal_hillsahde, gdal_slope, gdal_aspect,
             gdal_color-relief, gdal_tpi, gdal_tri,
             gdal_roughness
@@ -177,7 +180,7 @@ def dem_derivative(dem, derivative, output_path, size, **args):
         The path to write the output derivative.
     size : INT
         If a moving kernel operation, the size of the kernel
-        to use.
+        to use. A list of sizes for tpi_multi, see tpi_windows.
     
     Returns
     --------
@@ -214,6 +217,8 @@ def dem_derivative(dem, derivative, output_path, size, **args):
         tpi = None
         arr = None
         dem_raster = None
+    elif derivative == 'tpi_multi':
+        multiscale_tpi(dem, size, output_path)
     else:
         logger.error('Unknown derivative argument: {}'.format(derivative))
 
@@ -222,7 +227,7 @@ if __name__ == '__main__':
     supported_derivatives = ["hillshade", "slope", "aspect", "color-relief",
                               "TRI", "TPI", "Roughness"]
     all_derivs = ['gdal_{}'.format(x) for x in supported_derivatives]
-    all_derivs.extend(['tpi_ocv', 'tpi_std'])
+    all_derivs.extend(['tpi_ocv', 'tpi_std', 'tpi_multi'])
 
     parser = argparse.ArgumentParser()
 
@@ -234,6 +239,9 @@ if __name__ == '__main__':
                         help='Type of derivative to create, one of: {}'.format(all_derivs))
     parser.add_argument('-s', '--tpi_window_size', type=int,
                         help='Size of moving kernel to use in creating TPI.')
+    parser.add_argument('-ms', '--tpi_window_sizes', type=int, nargs='+',
+                        help='Sizes of moving kernels to use in creating '
+                             'multi-scale TPI (tpi_multi), one band each.')
     parser.add_argument('-ka', '--kw_args', nargs='+',
                         help="""Arguments to pass to gdal.DEMProcessing.
                                 Format: "keyword:arg" "keyword2:args2" """)
@@ -244,6 +252,10 @@ if __name__ == '__main__':
     output_path = args.output_path
     derivative = args.derivative
     window_size = args.tpi_window_size
+    if derivative == 'tpi_multi':
+        if not args.tpi_window_sizes:
+            parser.error('tpi_multi requires --tpi_window_sizes.')
+        window_size = args.tpi_window_sizes
     gdal_args = args.kw_args
 
     # Parse gdal_args into dictionary
@@ -262,6 +274,8 @@ if __name__ == '__main__':
             derivative_name = derivative.replace('_ocv', '')
             if window_size:
                 derivative_name = '{}{}'.format(derivative_name, window_size)
+        if derivative == 'tpi_multi' and window_size:
+            derivative_name = 'tpi{}'.format('_'.join(str(w) for w in window_size))
 
         out_name = os.path.splitext(os.path.basename(dem))[0]
         output_path = os.path.join(output_path, '{}_{}.tif'.format(out_name, derivative_name))
@@ -11,10 +11,12 @@ import os
 import glob
 
 import geopandas as gpd
+from shapely.geometry import box
 from tqdm import tqdm
 
 from misc_utils.logging_utils import LOGGING_CONFIG
-from misc_utils.RasterWrapper import Raster
+from misc_utils.gdal_tools import raster_bounds, raster_metadata, \
+    set_metadata_db
 
 
 #### Set up logging
@@ -43,17 +45,20 @@ def raster_footprints(rasters):
     logger.info('Iterating over rasters...')
     df = gpd.GeoDataFrame(columns=['location','geometry'])
     for fname in tqdm(rasters):
-        r = Raster(fname)
-        bbox = r.raster_bbox()
+        # Header only, cached by raster_metadata
+        bbox = box(*raster_bounds(fname))
         df = df.append({'location':fname, 'geometry': bbox}, ignore_index=True)
     
     # Set crs of dataframe to the last raster -- this assumes they are all the same
-    df.crs = r.prj.wkt
+    df.crs = raster_metadata(fname)['srs_wkt']
     
     return df
 
 
-def main(directory, out_footprint, pattern='\*.tif', dryrun=False):
+def main(directory, out_footprint, pattern='\*.tif', dryrun=False,
+         metadata_db=None):
+    if metadata_db:
+        set_metadata_db(metadata_db)
     # Find files that match the given pattern    
     full_pattern = directory + pattern
     matches = glob.glob(full_pattern)
@@ -88,7 +93,12 @@ if __name__ == '__main__':
     
     parser.add_argument('--dryrun', action='store_true',
                         help='Find matches only.')
+
+    parser.add_argument('--metadata_db', type=os.path.abspath,
+                        help="""SQLite file to cache raster metadata in, so
+                                unchanged rasters are not reopened on later runs.""")
     
     args = parser.parse_args()
     
-    main(args.input_directory, args.out_footprint, args.pattern, args.dryrun)
\ No newline at end of file
+    main(args.input_directory, args.out_footprint, args.pattern, args.dryrun,
+         metadata_db=args.metadata_db)
\ No newline at end of file
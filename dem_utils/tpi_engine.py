@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+TPI from summed-area tables: window sums and counts of valid cells are
+taken from integral images of the DEM, built once for all window sizes.
+Depends only on numpy, so it can be used without GDAL or OpenCV.
+"""
+
+import numpy as np
+
+from misc_utils.logging_utils import create_logger
+
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+
+def summed_area_tables(dem, mask):
+    """
+    Integral images of the valid values of dem and of the number of valid
+    pixels, with a leading row and column of zeros, so that the sum over
+    rows r0:r1 and columns c0:c1 is
+    sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0].
+
+    Parameters
+    ----------
+    dem : np.ndarray
+    mask : np.ndarray
+        True where dem is NoData.
+
+    Returns
+    -------
+    tuple : (np.ndarray, np.ndarray, float) value and count tables, each
+        of shape (rows + 1, cols + 1), and the offset subtracted from values
+    """
+    valid = ~mask
+    # Offset values by their mean to keep the sums small, as TPI does not
+    # depend on the offset
+    offset = dem[valid].mean() if valid.any() else 0
+    values = np.where(valid, dem - offset, 0).astype(np.float64)
+
+    value_sat = np.zeros((dem.shape[0] + 1, dem.shape[1] + 1))
+    value_sat[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    count_sat = np.zeros((dem.shape[0] + 1, dem.shape[1] + 1), dtype=np.int64)
+    count_sat[1:, 1:] = valid.cumsum(axis=0).cumsum(axis=1)
+
+    return value_sat, count_sat, offset
+
+
+def window_sum(sat, size):
+    """
+    Sum over the size x size window centered on each pixel from a table
+    from summed_area_tables, with windows clipped at the edges.
+    """
+    rows, cols = sat.shape[0] - 1, sat.shape[1] - 1
+    radius = size // 2
+    r = np.arange(rows)
+    c = np.arange(cols)
+    r0 = np.clip(r - radius, 0, rows)
+    r1 = np.clip(r + radius + 1, 0, rows)
+    c0 = np.clip(c - radius, 0, cols)
+    c1 = np.clip(c + radius + 1, 0, cols)
+
+    return (sat[np.ix_(r1, c1)] - sat[np.ix_(r0, c1)] -
+            sat[np.ix_(r1, c0)] + sat[np.ix_(r0, c0)])
+
+
+def tpi_windows(dem, windows, mask=None):
+    """
+    TPI (value - mean of valid values in window) at multiple scales from
+    one pair of summed-area tables, at a cost per pixel per scale that
+    does not depend on the window size.
+
+    Parameters
+    ----------
+    dem : np.ndarray
+        Masked arrays are masked in the output.
+    windows : list
+        Windows as an int size of a square window, or a tuple of
+        (inner, outer) sizes for an annulus: the outer square window
+        excluding the inner square window, e.g. (1, 5) for a 5 x 5
+        window excluding the center pixel. Sizes must be odd, so that
+        windows are centered on each pixel.
+    mask : np.ndarray
+        True where dem is NoData, defaults to the mask of dem.
+
+    Returns
+    -------
+    list : np.ma.MaskedArray TPI for each window, masked where dem is
+        masked or the window has no valid values
+    """
+    for w in windows:
+        sizes = w if isinstance(w, (tuple, list)) else [w]
+        if any(size % 2 == 0 for size in sizes if size):
+            logger.error('Unsupported window: {}, window sizes must be '
+                         'odd.'.format(w))
+            raise ValueError
+    if mask is None:
+        mask = np.ma.getmaskarray(dem)
+    dem = np.ma.getdata(dem)
+    value_sat, count_sat, offset = summed_area_tables(dem, mask)
+
+    tpis = []
+    for w in windows:
+        inner, outer = w if isinstance(w, (tuple, list)) else (0, w)
+        logger.debug('Computing TPI with window {}...'.format(w))
+        sums = window_sum(value_sat, outer)
+        counts = window_sum(count_sat, outer)
+        if inner:
+            sums -= window_sum(value_sat, inner)
+            counts -= window_sum(count_sat, inner)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tpi = (dem - offset) - sums / counts
+        tpis.append(np.ma.masked_where(mask | (counts == 0), tpi))
+
+    return tpis
+
+
+def window_name(window):
+    """Name of a tpi_windows window, e.g. '5' or '1-5' for an annulus."""
+    if isinstance(window, (tuple, list)):
+        return '-'.join(str(w) for w in window)
+    return str(window)
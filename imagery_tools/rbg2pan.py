@@ -1,6 +1,7 @@
 import os, string, sys, re, glob, argparse, subprocess, logging
 from osgeo import gdal, gdalconst
 from selection_utils import taskhandler
+from misc_utils.RasterWrapper import Raster
 
 #### Create Logger
 logger = logging.getLogger("logger")
@@ -14,6 +15,8 @@ default_format = 'GTIFF'
 default_suffix = '_pan'
 suffixes = ('ortho', 'matchtag', 'ms_img')
 formats = ('JPEG', 'GTiff')
+# Luma weights of red, green and blue
+pan_expr = 'r*0.2989 + g*0.5870 + b*0.1140'
 
 
 def main():
@@ -39,6 +42,9 @@ def main():
                         help="submit tasks to PBS")
     parser.add_argument("--parallel-processes", type=int, default=1,
                         help="number of parallel processes to spawn (default 1)")
+    parser.add_argument("--num_threads", type=int,
+                        help="number of threads to convert each image with "
+                             "(default is number of cores)")
     parser.add_argument("--qsubscript",
                         help="qsub script to use in PBS submission (default is qsub_rgb2pan.sh in script root folder)")
     parser.add_argument("--dryrun", action="store_true", default=False,
@@ -193,15 +199,26 @@ def rgb2pan(ms_img, args):
 
     if not os.path.isfile(pan_img) or args.overwrite is True:
         logger.info("Converting to panchromatic: {}".format(ms_img))
-        cmd = 'gdal_calc.py -A {0} --A_band={1} -B {0} --B_band={2} -C {0} --C_band={3} ' \
-              '--outfile={4} --calc="A*0.2989+B*0.5870+C*0.1140"'.format(ms_img,
-                                                                         r_band_num,
-                                                                         g_band_num,
-                                                                         b_band_num,
-                                                                         pan_img)
-
         if not args.dryrun:
-            taskhandler.exec_cmd(cmd)
+            src = Raster(ms_img)
+            # Formats that can not be written block by block (JPEG) are
+            # written to a temporary GeoTIFF and copied
+            out_img = pan_img if args.format == 'GTiff' else tempfile
+            # Keep the source NoData, if none leave it unset rather than
+            # using a value that can not be represented in integer types
+            is_float = 'Float' in gdal.GetDataTypeName(src.dtype)
+            src.BandMath(pan_expr,
+                         {'r': int(r_band_num),
+                          'g': int(g_band_num),
+                          'b': int(b_band_num)},
+                         out_img,
+                         dtype=src.dtype,
+                         nodata_val=src.nodata_val,
+                         set_nodata=src.nodata_val is not None or is_float,
+                         num_threads=args.num_threads)
+            src = None
+            if out_img != pan_img:
+                gdal.Translate(pan_img, out_img, format=args.format)
 
         if not args.dryrun:
             for f in deletables:
@@ -5,13 +5,17 @@ Created on Fri Jul 19 10:20:36 2019
 @author: disbr007
 
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import os
+import threading
 import numpy as np
 import numpy.ma as ma
 from typing import Union
 import pathlib
 
-from osgeo import gdal, osr  # ogr
+from osgeo import gdal, gdal_array, osr  # ogr
 # from shapely.geometry import Polygon
 from shapely.geometry import box
 import geopandas as gpd
@@ -23,6 +27,24 @@ logger = create_logger(__name__, 'sh', 'DEBUG')
 
 gdal.UseExceptions()
 
+# Minimum size of blocks, in pixels per dimension, when iterating over a
+# raster in multiples of its native block size
+BLOCK_TARGET = 512
+
+# Defaults for GeoTIFF outputs: internally tiled and compressed, with
+# multithreaded compression
+GTIFF_BLOCKSIZE = 512
+GTIFF_COMPRESS = 'LZW'
+GTIFF_NUM_THREADS = 'ALL_CPUS'
+# Overviews are built down to this size, in pixels
+OVERVIEW_MIN_SIZE = 256
+# COG driver names for GeoTIFF predictor values
+COG_PREDICTORS = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+# Band math expressions for indices
+NDVI_EXPR = '(nir - red) / (nir + red)'
+MNDWI_EXPR = '(green - swir) / (green + swir)'
+
 
 # TODO: Move these functions to gdal_utils
 def same_srs(raster1, raster2):
@@ -59,9 +81,108 @@ def same_srs(raster1, raster2):
     return same
 
 
+def creation_options(fmt='GTiff', compress=GTIFF_COMPRESS, predictor=None,
+                     tiled=True):
+    """
+    GDAL creation options for GeoTIFF ('GTiff') or Cloud-Optimized
+    GeoTIFF ('COG') outputs. Other formats get no options.
+
+    Parameters
+    ----------
+    fmt : str
+    compress : str
+        Compression, e.g. 'LZW', 'DEFLATE', 'ZSTD', or None.
+    predictor : int
+        1 (none), 2 (horizontal differencing, for integers) or 3 (floating
+        point), used with compress.
+    tiled : bool
+        Write GeoTIFFs in GTIFF_BLOCKSIZE tiles rather than strips. COGs
+        are always tiled.
+
+    Returns
+    -------
+    list : of 'KEY=VALUE' options
+    """
+    if fmt not in ('GTiff', 'COG'):
+        return []
+    options = ['BIGTIFF=IF_SAFER',
+               'NUM_THREADS={}'.format(GTIFF_NUM_THREADS)]
+    if compress:
+        options.append('COMPRESS={}'.format(compress))
+        if predictor:
+            options.append('PREDICTOR={}'.format(
+                COG_PREDICTORS[predictor] if fmt == 'COG' else predictor))
+    if fmt == 'COG':
+        options.append('BLOCKSIZE={}'.format(GTIFF_BLOCKSIZE))
+    elif tiled:
+        options.extend(['TILED=YES',
+                        'BLOCKXSIZE={}'.format(GTIFF_BLOCKSIZE),
+                        'BLOCKYSIZE={}'.format(GTIFF_BLOCKSIZE)])
+
+    return options
+
+
+def overview_levels(x_sz, y_sz, min_size=OVERVIEW_MIN_SIZE):
+    """Overview decimation factors (2, 4, 8, ...) until the larger
+    dimension is less than min_size."""
+    levels = []
+    factor = 2
+    while max(x_sz, y_sz) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+
+    return levels
+
+
+def cog_temp_path(out_path):
+    """Path of the intermediate GeoTIFF written before copying to a COG
+    at out_path, as the COG driver can only copy existing rasters."""
+    return '{}_cog_tmp.tif'.format(os.path.splitext(str(out_path))[0])
+
+
+def band_math(expression, arrays):
+    """
+    Evaluate expression over named arrays, e.g.
+    band_math('(nir - red) / (nir + red)', {'nir': nir, 'red': red}).
+
+    Parameters
+    ----------
+    expression : str
+        Arithmetic expression of the names in arrays, which may also use
+        np (numpy) and ma (numpy.ma) functions.
+    arrays : dict
+        name: array, masked arrays are masked in the result.
+
+    Returns
+    -------
+    np.ma.MaskedArray : float64 result, masked where any input is masked
+        or the result is invalid (e.g. division by zero)
+    """
+    try:
+        code = compile(expression, '<band_math>', 'eval')
+    except SyntaxError as e:
+        logger.error('Invalid band math expression: {}'.format(expression))
+        raise e
+    # Compute in float to avoid integer division and overflow
+    names = {n: ma.masked_array(a).astype(np.float64)
+             for n, a in arrays.items()}
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        try:
+            result = eval(code, {'__builtins__': {}, 'np': np, 'ma': ma},
+                          names)
+        except NameError as e:
+            logger.error('Unknown name in band math expression: '
+                         '{}'.format(expression))
+            raise e
+
+    return ma.masked_invalid(result)
+
+
 def stack_rasters(rasters, minbb=True, rescale=False):
     """
-    Stack single band rasters into a multiband raster.
+    Stack single band rasters into a multiband raster. The stacked array
+    is allocated once and filled band by band. For a lazy stack that is
+    not read into memory, see gdal_tools.stack_rasters.
 
     Parameters
     ----------
@@ -90,37 +211,35 @@ def stack_rasters(rasters, minbb=True, rescale=False):
         logger.warning("""Spatial references do not match, match status between
                           reference and rest:\n{}""".format('\n'.join(srs_matches)))
 
-    # Initialize the stacked array with just the reference array
-    if ref.depth > 1:
-        stacked = ref.GetBandAsArray(1, mask=True)
+    # All bands of the reference, then all bands of the rest
+    layers = [(ref, b) for b in range(1, ref.depth + 1)]
+    for rast in rasters[1:]:
+        r = Raster(rast)
+        layers.extend([(r, b) for b in range(1, r.depth + 1)])
+
+    if rescale:
+        dtype = np.float64
+    else:
+        dtype = np.result_type(*[
+            gdal_array.GDALTypeCodeToNumericTypeCode(
+                r.data_src.GetRasterBand(b).DataType)
+            for r, b in layers])
+    stacked = ma.masked_array(
+        np.empty((ref.y_sz, ref.x_sz, len(layers)), dtype=dtype),
+        mask=np.zeros((ref.y_sz, ref.x_sz, len(layers)), dtype=bool))
+
+    for i, (r, b) in enumerate(layers):
+        band = r.GetBandAsArray(b, mask=True)
         if rescale:
-            stacked = (stacked - stacked.min()) / (stacked.max() - stacked.min())
-
-        for i in range(ref.depth - 1):
-            band = ref.GetBandAsArray(i + 2, mask=True)
-            if rescale:
-                band = (band - band.min()) / (band.max() - band.min())
-            stacked = np.ma.dstack([stacked, band])
-
-    for i, rast in enumerate(rasters[1:]):
-        ma = Raster(rast).MaskedArray
-        if np.ma.isMaskedArray(ma):
-            if rescale:
-                # Rescale to between 0 and 1
-                ma = (ma - ma.min()) / (ma.max() - ma.min())
-            # Replace mask/nodata value in array with reference values
-            # ma_mask = ma.mask
-            # ma = np.ma.masked_where(ma_mask, ma)
-            # ma.set_fill_value(ref.nodata_val)
-            # ma = ma.filled(ma.fill_value)
-
-        stacked = np.ma.dstack([stacked, ma])
-
-        ma = None
+            # Rescale to between 0 and 1
+            band = (band - band.min()) / (band.max() - band.min())
+        stacked[:, :, i] = band
+        band = None
 
     # Revert to original NoData value (stacking changes)
     # stacked.set_fill_value(ref.nodata_val)
     ref = None
+    layers = None
 
     return stacked
 
@@ -169,19 +288,247 @@ class Raster:
         self.nodata_val = self.data_src.GetRasterBand(1).GetNoDataValue()
         self.dtype = self.data_src.GetRasterBand(1).DataType
 
-        # Get the raster as an array
-        # Defaults to band 1 -- use ReadArray() to return stack
-        # of multiple bands
-        # TODO: Init these here, but then call as method to avoid loading all on Raster() call
-        # @property for lazy evaluation?
-        self.Array = self.data_src.ReadAsArray()
-        self.Mask = self.Array == self.nodata_val
-        self.MaskedArray = ma.masked_array(self.Array, mask=self.Mask)
-        np.ma.set_fill_value(self.MaskedArray, self.nodata_val)
+        # Only the header is read on init, the arrays are read on first
+        # access of Array, Mask or MaskedArray
+        self._array = None
+        self._mask = None
+        self._masked_array = None
+
+    @property
+    def Array(self):
+        """The raster as an array, read on first access. Defaults to band 1
+        -- use ReadStackedArray() to return stack of multiple bands"""
+        if self._array is None:
+            self._array = self.data_src.ReadAsArray()
+        return self._array
+
+    @property
+    def Mask(self):
+        if self._mask is None:
+            self._mask = self.Array == self.nodata_val
+        return self._mask
+
+    @property
+    def MaskedArray(self):
+        if self._masked_array is None:
+            self._masked_array = ma.masked_array(self.Array, mask=self.Mask)
+            np.ma.set_fill_value(self._masked_array, self.nodata_val)
+        return self._masked_array
+
+    def ReadWindow(self, xoff, yoff, xsize, ysize, fill_value=None,
+                   band=None):
+        """
+        Read a window of the raster in pixel coordinates, without reading
+        the whole raster (unless Array has already been read). Parts of
+        the window outside of the raster are filled with fill_value.
+
+        Parameters
+        ----------
+        xoff, yoff : int
+            Column and row of the upper left pixel of the window.
+        xsize, ysize : int
+            Number of columns and rows in the window.
+        fill_value : numeric
+            Value for pixels outside of the raster, defaults to the NoData
+            value.
+        band : int
+            Band to read, defaults to all bands.
+
+        Returns
+        -------
+        np.ndarray : (ysize, xsize), or (bands, ysize, xsize) for
+            multiband rasters, or None if the window does not overlap the
+            raster
+        """
+        # Intersection of the window with the raster
+        x0, y0 = max(xoff, 0), max(yoff, 0)
+        x1, y1 = min(xoff + xsize, self.x_sz), min(yoff + ysize, self.y_sz)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        if band is not None:
+            if self._array is not None:
+                arr = self._array[band - 1] if self._array.ndim == 3 \
+                    else self._array
+                arr = arr[y0:y1, x0:x1]
+            else:
+                arr = self.data_src.GetRasterBand(band).ReadAsArray(
+                    x0, y0, x1 - x0, y1 - y0)
+        elif self._array is not None:
+            arr = self._array[..., y0:y1, x0:x1]
+        else:
+            arr = self.data_src.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        if (x0, y0, x1, y1) == (xoff, yoff, xoff + xsize, yoff + ysize):
+            return arr
+
+        # Pad the parts of the window outside of the raster
+        if fill_value is None:
+            fill_value = self.nodata_val
+        if fill_value is None or (np.issubdtype(arr.dtype, np.integer) and
+                                  not float(fill_value).is_integer()):
+            arr = arr.astype(np.float32)
+            fill_value = np.nan if fill_value is None else fill_value
+        window = np.full(arr.shape[:-2] + (ysize, xsize), fill_value,
+                         dtype=arr.dtype)
+        window[..., y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = arr
+
+        return window
 
-    # def Masked_Array(self):
-    #     masked_array = ma.masked_array(self.Array, mask=self.Mask)
-    #     masked_array = np.ma.set_fill_value(self.nodata_val, masked_array)
+    def BlockSize(self, band=1):
+        """Native (x, y) block size of band in the file."""
+        return tuple(self.data_src.GetRasterBand(band).GetBlockSize())
+
+    def IterBlocks(self, block_size=None, halo=0):
+        """
+        Iterate over windows covering the raster, aligned to the blocks of
+        the file.
+
+        Parameters
+        ----------
+        block_size : tuple
+            (x, y) size of windows in pixels. Defaults to the smallest
+            multiple of the native block size of at least BLOCK_TARGET
+            pixels in each dimension (capped at the raster size).
+        halo : int
+            Number of pixels to grow each window by on each side, for
+            functions that need neighboring pixels.
+
+        Yields
+        ------
+        tuple : (window, halo_window), each as (xoff, yoff, xsize, ysize),
+            where halo_window is window grown by halo, possibly extending
+            past the edges of the raster (see ReadWindow)
+        """
+        if block_size is None:
+            native_x, native_y = self.BlockSize()
+            block_size = (min(native_x * int(np.ceil(BLOCK_TARGET / native_x)),
+                              self.x_sz),
+                          min(native_y * int(np.ceil(BLOCK_TARGET / native_y)),
+                              self.y_sz))
+        block_x, block_y = block_size
+        for yoff in range(0, self.y_sz, block_y):
+            ysize = min(block_y, self.y_sz - yoff)
+            for xoff in range(0, self.x_sz, block_x):
+                xsize = min(block_x, self.x_sz - xoff)
+                yield ((xoff, yoff, xsize, ysize),
+                       (xoff - halo, yoff - halo,
+                        xsize + 2 * halo, ysize + 2 * halo))
+
+    def ReadBlock(self, halo_window, bands=None, masked=True):
+        """
+        Read halo_window from IterBlocks for each of bands (default: band 1)
+        as a list of arrays, masked where NoData (including outside of the
+        raster) if masked.
+        """
+        if bands is None:
+            bands = [1]
+        arrs = []
+        for b in bands:
+            arr = self.ReadWindow(*halo_window, band=b)
+            if masked:
+                nodata_val = self.data_src.GetRasterBand(b).GetNoDataValue()
+                mask = np.isnan(arr) if np.issubdtype(arr.dtype, np.floating) \
+                    else np.zeros(arr.shape, dtype=bool)
+                if nodata_val is not None:
+                    mask |= arr == nodata_val
+                arr = ma.masked_array(arr, mask=mask)
+            arrs.append(arr)
+
+        return arrs
+
+    def MapBlocks(self, fxn, out_path, bands=None, out_depth=1,
+                  block_size=None, halo=0, num_threads=None, masked=True,
+                  fmt='GTiff', dtype=None, nodata_val=None,
+                  compress=GTIFF_COMPRESS, predictor=None, tiled=True,
+                  overviews=False, cog=False, set_nodata=True):
+        """
+        Apply fxn to the raster block by block in a thread pool, writing
+        the results to out_path as they are done, so that rasters larger
+        than memory can be processed. Blocks are read with a separate
+        dataset handle in each thread, and written from the calling thread.
+
+        Parameters
+        ----------
+        fxn : callable
+            Called as fxn(*arrs) with the arrays from ReadBlock for each
+            block, returning an array with the same rows and columns, with
+            out_depth bands along the first axis if out_depth > 1. Masked
+            values are written as nodata_val.
+        out_path : str
+        bands : list
+            Band numbers to pass to fxn, defaults to [1].
+        out_depth : int
+            Number of bands returned by fxn.
+        block_size : tuple
+            (x, y) size of blocks, see IterBlocks.
+        halo : int
+            Number of neighboring pixels to include around each block. The
+            halo is removed from the result of fxn before writing.
+        num_threads : int
+            Number of threads, defaults to the number of cores.
+        masked : bool
+            Pass masked arrays to fxn, see ReadBlock.
+        fmt, dtype, nodata_val, compress, predictor, tiled, overviews, cog :
+            See WriteArray.
+        set_nodata : bool
+            See CreateOutput. If False, masked values are written as 0
+            unless nodata_val is given.
+
+        Returns
+        -------
+        str : out_path
+        """
+        num_threads = num_threads if num_threads else os.cpu_count()
+        if nodata_val is None:
+            if self.nodata_val is not None:
+                nodata_val = self.nodata_val
+            else:
+                nodata_val = -9999 if set_nodata else 0
+        dst_ds = self.CreateOutput(out_path, depth=out_depth, fmt=fmt,
+                                   dtype=dtype, nodata_val=nodata_val,
+                                   compress=compress, predictor=predictor,
+                                   tiled=tiled, cog=cog,
+                                   set_nodata=set_nodata)
+        # GDAL datasets can not be shared between threads
+        local = threading.local()
+
+        def process_block(halo_window):
+            if not hasattr(local, 'raster'):
+                local.raster = Raster(self.src_path)
+            return fxn(*local.raster.ReadBlock(halo_window, bands=bands,
+                                               masked=masked))
+
+        def write_block(window, result):
+            xoff, yoff, xsize, ysize = window
+            result = result.result()
+            if isinstance(result, np.ma.MaskedArray):
+                result = result.filled(nodata_val)
+            result = result.reshape((out_depth, ) + result.shape[-2:])
+            result = result[:, halo:halo + ysize, halo:halo + xsize]
+            for i in range(out_depth):
+                dst_ds.GetRasterBand(i + 1).WriteArray(result[i], xoff, yoff)
+
+        logger.debug('Processing blocks of {} with {} threads...'.format(
+            self.src_path, num_threads))
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            # Bound the number of blocks held in memory
+            pending = deque()
+            for window, halo_window in self.IterBlocks(block_size=block_size,
+                                                       halo=halo):
+                pending.append((window, pool.submit(process_block,
+                                                    halo_window)))
+                if len(pending) >= 2 * num_threads:
+                    write_block(*pending.popleft())
+            while pending:
+                write_block(*pending.popleft())
+
+        self.FinishOutput(dst_ds, out_path, overviews=overviews, cog=cog,
+                          compress=compress, predictor=predictor)
+        dst_ds = None
+        if cog:
+            gdal.Unlink(cog_temp_path(out_path))
+
+        return out_path
 
     def get_projwin(self):
         """Get projwin ordered."""
@@ -257,17 +604,62 @@ class Raster:
         """Calculate NDVI from multispectral bands"""
         red = self.GetBandAsArray(red_num)
         nir = self.GetBandAsArray(nir_num)
-        ndvi = (nir - red) / (nir + red)
+        ndvi = band_math(NDVI_EXPR, {'red': red, 'nir': nir})
 
         return ndvi
 
     def mndwi_array(self, green_num, swir_num):
         green = self.GetBandAsArray(green_num)
         swir = self.GetBandAsArray(swir_num)
-        mndwi = (green - swir) / (green + swir)
+        mndwi = band_math(MNDWI_EXPR, {'green': green, 'swir': swir})
 
         return mndwi
 
+    def BandMath(self, expression, bands, out_path, dtype=gdal.GDT_Float32,
+                 nodata_val=None, block_size=None, num_threads=None,
+                 fmt='GTiff', **write_kwargs):
+        """
+        Evaluate expression over named bands block by block in a thread
+        pool, writing the result to out_path, see band_math and MapBlocks.
+        NoData in any band is NoData in the output.
+
+        Parameters
+        ----------
+        expression : str
+            E.g. '(nir - red) / (nir + red)'
+        bands : dict
+            name: band number, for each name in expression
+        out_path : str
+        dtype : int
+            GDAL data type of the output.
+        nodata_val : numeric
+            Defaults to the NoData value of the current raster, or -9999.
+        block_size : tuple
+        num_threads : int
+        fmt : str
+        **write_kwargs
+            compress, predictor, tiled, overviews, cog, see WriteArray, and
+            set_nodata, see CreateOutput.
+
+        Returns
+        -------
+        str : out_path
+        """
+        names = list(bands.keys())
+        # Validate expression before creating the output
+        band_math(expression, {n: np.zeros(1) for n in names})
+        logger.debug('Calculating {} from {}'.format(expression, bands))
+
+        def evaluate(*arrs):
+            return band_math(expression, dict(zip(names, arrs)))
+
+        return self.MapBlocks(evaluate, out_path,
+                              bands=[bands[n] for n in names],
+                              block_size=block_size,
+                              num_threads=num_threads,
+                              fmt=fmt, dtype=dtype, nodata_val=nodata_val,
+                              **write_kwargs)
+
     def ArrayWindow(self, projWin):
         """
         Takes a projWin in geocoordinates, converts
@@ -275,7 +667,11 @@ class Raster:
         array referenced
         """
         xmin, ymin, xmax, ymax = self.projWin2pixelWin(projWin)
-        self.arr_window = self.Array[ymin:ymax, xmin:xmax]
+        # Clip to raster, as slicing the full array would
+        xmin, ymin = max(xmin, 0), max(ymin, 0)
+        xmax, ymax = min(xmax, self.x_sz), min(ymax, self.y_sz)
+        self.arr_window = self.ReadWindow(xmin, ymin, xmax - xmin,
+                                          ymax - ymin)
 
         return self.arr_window
 
@@ -287,6 +683,28 @@ class Raster:
         px = int(np.around((geocoord[1] - self.geotransform[0]) / self.geotransform[1]))
         return py, px
 
+    def geo2pixels(self, points):
+        """
+        Convert an array of geographic coordinates to pixel coordinates in
+        one step, see geo2pixel.
+
+        Parameters
+        ----------
+        points : array-like
+            (n, 2) array of (y, x) in geocoordinates
+
+        Returns
+        -------
+        tuple : (np.ndarray, np.ndarray) of rows and columns
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        py = np.around((points[:, 0] - self.geotransform[3]) /
+                       self.geotransform[5]).astype(np.int64)
+        px = np.around((points[:, 1] - self.geotransform[0]) /
+                       self.geotransform[1]).astype(np.int64)
+
+        return py, px
+
     def pixel2geo(self, pixel_coord):
         y, x = pixel_coord
         gy = self.geotransform[4] * x + self.geotransform[5] * y + self.geotransform[4] * 0.5 + self.geotransform[5] * 0.5 + self.geotransform[3]
@@ -324,25 +742,26 @@ class Raster:
         '''
         # Get number of bands in raster
         num_bands = self.data_src.RasterCount
-        # For each band read as array and add to list
-        band_arrays = []
-        for band in range(num_bands):
-            band_arr = self.data_src.GetRasterBand(band).ReadAsArray()
-            band_arrays.append(band_arr)
 
-        # If stacked is True, stack bands and return
+        # If stacked is True, read each band into the stacked array
         if stacked:
             # Control for 1 band rasters as stacked=True is the default
-            if num_bands > 1:
-                stacked_array = np.dstack(band_arrays)
-            else:
-                stacked_array = band_arrays[0]
+            if num_bands == 1:
+                return self.data_src.GetRasterBand(1).ReadAsArray()
+            stacked_array = None
+            for band in range(1, num_bands + 1):
+                band_arr = self.data_src.GetRasterBand(band).ReadAsArray()
+                if stacked_array is None:
+                    stacked_array = np.empty(band_arr.shape + (num_bands, ),
+                                             dtype=band_arr.dtype)
+                stacked_array[:, :, band - 1] = band_arr
 
             return stacked_array
 
         # Return list of band arrays
         else:
-            return band_arrays
+            return [self.data_src.GetRasterBand(band).ReadAsArray()
+                    for band in range(1, num_bands + 1)]
 
     def stack_arrays(self, arrays):
         """
@@ -375,10 +794,18 @@ class Raster:
         return stacked
 
     def WriteArray(self, array, out_path, stacked=False, fmt='GTiff',
-                   dtype=None, nodata_val=None):
+                   dtype=None, nodata_val=None, compress=GTIFF_COMPRESS,
+                   predictor=None, tiled=True, overviews=False, cog=False):
         """
         Writes the passed array with the metadata of the current raster object
-        as new raster.
+        as new raster. GeoTIFFs are tiled and compressed by default, see
+        creation_options.
+
+        overviews : bool
+            Build internal overviews, see FinishOutput.
+        cog : bool
+            Write a Cloud-Optimized GeoTIFF (with overviews) rather than
+            fmt.
         """
         # Get dimensions of input array
         dims = len(array.shape)
@@ -392,12 +819,73 @@ class Raster:
             rows, cols = array.shape
             depth = 1
 
+        # Create output file
+        dst_ds = self.CreateOutput(out_path, depth=depth, fmt=fmt,
+                                   dtype=dtype, nodata_val=nodata_val,
+                                   compress=compress, predictor=predictor,
+                                   tiled=tiled, cog=cog)
+
+        # Loop through each layer of array and write as band
+        for i in range(depth):
+            if stacked:
+                if isinstance(array, np.ma.MaskedArray):
+                    lyr = array[i, :, :].filled()
+                else:
+                    lyr = array[i, :, :]
+                band = i + 1
+                dst_ds.GetRasterBand(band).WriteArray(lyr)
+            else:
+                # logger.info(array.dtype)
+                band = i + 1
+                if isinstance(array, np.ma.MaskedArray):
+                    dst_ds.GetRasterBand(band).WriteArray(array.filled(self.nodata_val))
+                else:
+                    dst_ds.GetRasterBand(band).WriteArray(array)
+
+        self.FinishOutput(dst_ds, out_path, overviews=overviews, cog=cog,
+                          compress=compress, predictor=predictor)
+        dst_ds = None
+        if cog:
+            gdal.Unlink(cog_temp_path(out_path))
+
+    def CreateOutput(self, out_path, depth=1, fmt='GTiff', dtype=None,
+                     nodata_val=None, compress=GTIFF_COMPRESS, predictor=None,
+                     tiled=True, cog=False, set_nodata=True):
+        """
+        Create a new raster with the size, geotransform and projection of
+        the current raster object, with nodata_val set on all bands. Once
+        written, pass to FinishOutput.
+
+        Parameters
+        ----------
+        out_path : str
+        depth : int
+            Number of bands.
+        fmt : str
+            GDAL driver name.
+        dtype : int
+            GDAL data type, defaults to the data type of the current raster.
+        nodata_val : numeric
+            Defaults to the NoData value of the current raster, or -9999.
+        compress, predictor, tiled :
+            See creation_options.
+        cog : bool
+            Create an intermediate GeoTIFF at cog_temp_path(out_path), to
+            be copied to a COG at out_path by FinishOutput.
+        set_nodata : bool
+            False to leave NoData unset, e.g. for integer outputs of
+            rasters without NoData, where -9999 can not be represented.
+
+        Returns
+        -------
+        gdal.Dataset : opened for writing
+        """
         # Handle dtype
         if not dtype:
             # Use original dtype
             dtype = self.dtype
         # Handle NoData value
-        if nodata_val is None:
+        if nodata_val is None and set_nodata:
             if self.nodata_val is not None:
                 nodata_val = self.nodata_val
             else:
@@ -405,36 +893,78 @@ class Raster:
                                'using -9999'.format(self.src_path))
                 nodata_val = -9999
 
-        # Create output file
+        if cog:
+            fmt = 'GTiff'
+            out_path = cog_temp_path(out_path)
         driver = gdal.GetDriverByName(fmt)
         try:
             dst_ds = driver.Create(out_path, self.x_sz, self.y_sz, bands=depth,
-                                   eType=dtype)
+                                   eType=dtype,
+                                   options=creation_options(fmt,
+                                                            compress=compress,
+                                                            predictor=predictor,
+                                                            tiled=tiled))
         except:
             logger.error('Error creating: {}'.format(out_path))
         dst_ds.SetGeoTransform(self.geotransform)
         dst_ds.SetProjection(self.prj.ExportToWkt())
-
-        # Loop through each layer of array and write as band
-        for i in range(depth):
-            if stacked:
-                if isinstance(array, np.ma.MaskedArray):
-                    lyr = array[i, :, :].filled()
-                else:
-                    lyr = array[i, :, :]
-                band = i + 1
-                dst_ds.GetRasterBand(band).WriteArray(lyr)
-                dst_ds.GetRasterBand(band).SetNoDataValue(nodata_val)
-            else:
-                # logger.info(array.dtype)
-                band = i + 1
-                if isinstance(array, np.ma.MaskedArray):
-                    dst_ds.GetRasterBand(band).WriteArray(array.filled(self.nodata_val))
-                else:
-                    dst_ds.GetRasterBand(band).WriteArray(array)
+        if set_nodata:
+            for band in range(1, depth + 1):
                 dst_ds.GetRasterBand(band).SetNoDataValue(nodata_val)
 
-        dst_ds = None
+        return dst_ds
+
+    def FinishOutput(self, dst_ds, out_path, overviews=False, cog=False,
+                     compress=GTIFF_COMPRESS, predictor=None,
+                     resampling='NEAREST'):
+        """
+        Build overviews for and flush a dataset from CreateOutput. If cog,
+        dst_ds is copied to a Cloud-Optimized GeoTIFF at out_path, with
+        overviews; the caller should release dst_ds and remove
+        cog_temp_path(out_path) afterwards. Without the COG driver (GDAL <
+        3.1), overviews are built on dst_ds and copied to a tiled GeoTIFF
+        with COPY_SRC_OVERVIEWS, which has the same layout.
+
+        Parameters
+        ----------
+        dst_ds : gdal.Dataset
+        out_path : str
+        overviews : bool
+            Build internal overviews down to OVERVIEW_MIN_SIZE.
+        cog : bool
+        compress, predictor :
+            See creation_options.
+        resampling : str
+            Overview resampling method, e.g. 'NEAREST', 'AVERAGE'.
+        """
+        if cog:
+            logger.debug('Writing COG: {}'.format(out_path))
+            if gdal.GetDriverByName('COG') is not None:
+                dst_ds.FlushCache()
+                options = creation_options('COG', compress=compress,
+                                           predictor=predictor)
+                options.append('RESAMPLING={}'.format(resampling))
+                gdal.Translate(str(out_path), dst_ds, format='COG',
+                               creationOptions=options)
+                return
+            logger.debug('COG driver not available (GDAL {}), copying '
+                         'overviews to a tiled GeoTIFF'.format(
+                             gdal.__version__))
+            levels = overview_levels(self.x_sz, self.y_sz)
+            if levels:
+                dst_ds.BuildOverviews(resampling, levels)
+            dst_ds.FlushCache()
+            options = creation_options('GTiff', compress=compress,
+                                       predictor=predictor, tiled=True)
+            options.append('COPY_SRC_OVERVIEWS=YES')
+            gdal.Translate(str(out_path), dst_ds, format='GTiff',
+                           creationOptions=options)
+            return
+        if overviews:
+            levels = overview_levels(self.x_sz, self.y_sz)
+            if levels:
+                dst_ds.BuildOverviews(resampling, levels)
+        dst_ds.FlushCache()
 
     def WriteMask(self, out_path, **kwargs):
         self.WriteArray(self.Mask, out_path=out_path, **kwargs)
@@ -445,15 +975,22 @@ class Raster:
         self.WriteMask(out_path=out_mask_img)
         gdal_polygonize(img=out_mask_img, out_vec=out_vec, **kwargs)
 
-    def NDVI(self, out_path, red_num, nir_num):
-        ndvi_arr = self.ndvi_array(red_num, nir_num)
-        self.WriteArray(ndvi_arr, out_path, stacked=False)
+    # Indices are written with a NoData value outside of their range (-1
+    # to 1), as the NoData value of imagery (often 0) is a valid index
+    def NDVI(self, out_path, red_num, nir_num, num_threads=None,
+             nodata_val=-9999):
+        self.BandMath(NDVI_EXPR, {'red': red_num, 'nir': nir_num}, out_path,
+                      nodata_val=nodata_val, num_threads=num_threads)
 
-    def mNDWI(self, out_path, green_num, swir_num):
-            mndwi_arr = self.mndwi_array(green_num, swir_num)
-            self.WriteArray(mndwi_arr, out_path, stacked=False)
+    def mNDWI(self, out_path, green_num, swir_num, num_threads=None,
+              nodata_val=-9999):
+        self.BandMath(MNDWI_EXPR, {'green': green_num, 'swir': swir_num},
+                      out_path, nodata_val=nodata_val,
+                      num_threads=num_threads)
 
     def create_brightness(self, bands: list, out_path: Union[str, pathlib.PurePath]):
+        """Sum of bands, written to out_path if given. See BandMath to
+        stream the sum to a file without reading the bands into memory."""
         for i, b in enumerate(bands):
             a = self.GetBandAsArray(b)
             if i == 0:
@@ -489,12 +1026,15 @@ class Raster:
         py = int(np.around((point[0] - self.geotransform[3]) / self.geotransform[5]))
         px = int(np.around((point[1] - self.geotransform[0]) / self.geotransform[1]))
         # Handle point being out of raster bounds
-        try:
-            point_value = self.Array[py, px]
-        except IndexError as e:
+        if not (0 <= py < self.y_sz and 0 <= px < self.x_sz):
             logger.warning('Point not within raster bounds.')
-            logger.warning(e)
-            point_value = None
+            logger.warning('Pixel ({}, {}) outside of raster of size '
+                           '({}, {})'.format(py, px, self.y_sz, self.x_sz))
+            return None
+        point_value = self.ReadWindow(px, py, 1, 1)[..., 0, 0]
+        if point_value.ndim == 0:
+            point_value = point_value[()]
+
         return point_value
 
     def SampleWindow(self, center_point, window_size, agg='mean', grow_window=False, max_grow=100000):
@@ -543,7 +1083,11 @@ class Raster:
             growing = True
             while growing:
                 ymin, ymax, xmin, xmax = window_bounds(window_size, py, px)
-                window = self.Array[ymin:ymax, xmin:xmax].astype(np.float32)
+                window = self.ReadWindow(xmin, ymin, xmax - xmin, ymax - ymin)
+                if window is None:
+                    raise IndexError('Window rows {}:{}, columns {}:{} outside '
+                                     'of raster.'.format(ymin, ymax, xmin, xmax))
+                window = window.astype(np.float32)
                 window = np.where(window == self.nodata_val, np.nan, window)
 
                 # Test for window with all nans to avoid getting 0's for all nans
@@ -566,7 +1110,8 @@ class Raster:
                 else:
                     # Window all nan's, return nan value (arbitratily picking -9999)
                     # If grow_window is True, increase window (y+2, x+2)
-                    if grow_window:
+                    if grow_window and \
+                            (window_size[0] + 2) * (window_size[1] + 2) <= max_grow:
                         window_size = (window_size[0] + 2, window_size[1] + 2)
                     # If grow_window is False, return no data and exit while loop
                     else:
@@ -580,6 +1125,139 @@ class Raster:
 
         return window_agg
 
+    def _block_groups(self, py, px, y_step=0, x_step=0):
+        """
+        Group pixel coordinates by the native block they fall in, yielding
+        the positions of the pixels in each block and the window covering
+        them, grown by (y_step, x_step) pixels on each side.
+        """
+        block_x, block_y = self.BlockSize()
+        n_block_x = -(-self.x_sz // block_x)
+        keys = (py // block_y) * n_block_x + (px // block_x)
+        order = np.argsort(keys, kind='stable')
+        splits = np.flatnonzero(np.diff(keys[order])) + 1
+        for idx in np.split(order, splits):
+            if idx.size == 0:
+                continue
+            ymin = py[idx].min() - y_step
+            xmin = px[idx].min() - x_step
+            window = (xmin, ymin,
+                      px[idx].max() + x_step + 1 - xmin,
+                      py[idx].max() + y_step + 1 - ymin)
+            yield idx, window
+
+    def SamplePoints(self, points, band=1):
+        """
+        Sample the raster at many points at once, reading only the blocks
+        that contain points, once each. Must be the same coordinate system
+        used by the raster object.
+
+        Parameters
+        ----------
+        points : array-like
+            (n, 2) array of (y, x) in geocoordinates
+        band : int
+
+        Returns
+        -------
+        np.ma.MaskedArray : value at each point, masked where the point is
+            outside of the raster or NoData
+        """
+        py, px = self.geo2pixels(points)
+        inside = (py >= 0) & (py < self.y_sz) & (px >= 0) & (px < self.x_sz)
+        if not inside.all():
+            logger.warning('Points not within raster bounds: '
+                           '{:,}'.format((~inside).sum()))
+        band_nodata = self.data_src.GetRasterBand(band).GetNoDataValue()
+        values = None
+        in_idx = np.flatnonzero(inside)
+        for idx, (xoff, yoff, xsize, ysize) in self._block_groups(
+                py[in_idx], px[in_idx]):
+            block = self.ReadWindow(xoff, yoff, xsize, ysize, band=band)
+            if values is None:
+                values = np.zeros(len(py), dtype=block.dtype)
+            values[in_idx[idx]] = block[py[in_idx[idx]] - yoff,
+                                        px[in_idx[idx]] - xoff]
+        if values is None:
+            values = np.zeros(len(py))
+        mask = ~inside
+        if band_nodata is not None:
+            mask |= values == band_nodata
+
+        return ma.masked_array(values, mask=mask)
+
+    def SampleWindows(self, center_points, window_size, aggs=('mean', ),
+                      band=1, grow_window=False, max_grow=100000):
+        """
+        Aggregate windows centered on many points at once, see
+        SampleWindow. Points are grouped by the block they fall in and
+        the windows of each group are read as one array.
+
+        Parameters
+        ----------
+        center_points : array-like
+            (n, 2) array of (y, x) in geocoordinates
+        window_size : tuple
+            (y_size, x_size) as number of pixels (must be odd)
+        aggs : list
+            Aggregations of valid values in each window, any of 'mean',
+            'sum', 'min', 'max', 'std', 'count'.
+        band : int
+        grow_window : bool
+            Increase the size of windows without any valid values (y+2,
+            x+2) until one is included or the window area exceeds max_grow.
+        max_grow : int
+            The maximum area (x * y) windows will grow to.
+
+        Returns
+        -------
+        dict : agg: np.ndarray of the aggregate of each window, NoData for
+            windows without valid values
+        """
+        agg_lut = {'mean': np.nanmean, 'sum': np.nansum, 'min': np.nanmin,
+                   'max': np.nanmax, 'std': np.nanstd,
+                   'count': lambda w, axis: np.sum(~np.isnan(w), axis=axis)}
+        unknown = [a for a in aggs if a not in agg_lut]
+        if unknown:
+            logger.error('Unknown aggregation(s): {}'.format(unknown))
+            raise ValueError
+        nodata_val = self.nodata_val if self.nodata_val is not None \
+            else np.nan
+
+        py, px = self.geo2pixels(center_points)
+        results = {a: np.full(len(py), nodata_val, dtype=np.float64)
+                   for a in aggs}
+        remaining = np.arange(len(py))
+        while remaining.size:
+            y_step, x_step = int(window_size[0] / 2), int(window_size[1] / 2)
+            # Offsets of the pixels of a window from its center
+            dy, dx = np.mgrid[-y_step:y_step + 1, -x_step:x_step + 1]
+            has_valid = np.zeros(len(remaining), dtype=bool)
+            for idx, (xoff, yoff, xsize, ysize) in self._block_groups(
+                    py[remaining], px[remaining], y_step, x_step):
+                block = self.ReadWindow(xoff, yoff, xsize, ysize, band=band)
+                if block is None:
+                    # Windows entirely outside of the raster
+                    continue
+                block = block.astype(np.float32)
+                block[block == self.nodata_val] = np.nan
+                rows = py[remaining[idx]] - yoff
+                cols = px[remaining[idx]] - xoff
+                windows = block[rows[:, None, None] + dy,
+                                cols[:, None, None] + dx]
+                valid = ~np.isnan(windows).all(axis=(1, 2))
+                has_valid[idx] = valid
+                with np.errstate(all='ignore'):
+                    for a in aggs:
+                        results[a][remaining[idx[valid]]] = agg_lut[a](
+                            windows[valid], axis=(1, 2))
+            window_size = (window_size[0] + 2, window_size[1] + 2)
+            if not grow_window or window_size[0] * window_size[1] > max_grow:
+                break
+            remaining = remaining[~has_valid]
+
+        return results
+
     def create_window(self, window_size, center):
         window = RasterWindow(self, window_size, center)
         return window
@@ -624,45 +1302,27 @@ class RasterWindow:
         return ymin, ymax, xmin, xmax
 
     def create_exceed_window(self, ymin, ymax, xmin, xmax):
-        # TODO Handle if both xmin and xmax are negative -
-        #  array will be wrong dimensions
-        neg_rows = None
-        neg_cols = None
-        # Handle negative ymin
-        if ymin < 0:
-            # Create array with NoData val for number of columns
-            neg_rows = np.array([np.array([self.raster.nodata_val
-                                  for j in range(self.window_size[1])])
-                        for i in range(abs(ymin))])
-            ymin = 0
-        # Handle negative xmin
-        if xmin < 0:
-            neg_cols = np.array([np.array([self.raster.nodata_val
-                                  for j in range(self.window_size[1])])
-                        for i in range(abs(xmin))])
-            xmin = 0
-        # TODO: Set type based on type of self.raster
-        window = self.raster.Array[ymin:ymax, xmin:xmax]
-
-        if neg_rows is not None:
-            # Insert negative rows (ymin)
-            window = np.insert(window, 0, neg_rows, 0)
-        if neg_cols is not None:
-            # Insert negative columns (xmin)
-            window = np.insert(window, 0, neg_rows, 0)
+        """Window that extends past the edges of the raster, with the
+        pixels outside of the raster set to NoData."""
+        window = self.raster.ReadWindow(xmin, ymin, xmax - xmin, ymax - ymin)
+        if window is None:
+            # Entirely outside of the raster
+            fill_value = self.raster.nodata_val
+            window = np.full((ymax - ymin, xmax - xmin),
+                             np.nan if fill_value is None else fill_value,
+                             dtype=np.float32)
         return window
 
-
-
     def get_window(self, masked=True) -> np.ma.masked_array:
         ymin, ymax, xmin, xmax = self.window_bounds()
         if ymin < 0 or xmin < 0 or \
-                ymax > self.raster.Array.shape[0] or \
-                xmax > self.raster.Array.shape[1]:
+                ymax > self.raster.y_sz or \
+                xmax > self.raster.x_sz:
             # create array with nans
             window = self.create_exceed_window(ymin, ymax, xmin, xmax)
         else:
-            window = self.raster.Array[ymin:ymax, xmin:xmax].astype(np.float32)
+            window = self.raster.ReadWindow(xmin, ymin, xmax - xmin,
+                                            ymax - ymin).astype(np.float32)
         if masked:
             window = np.ma.masked_where(window == self.raster.nodata_val,
                                         window)
@@ -6,8 +6,10 @@ with in memory writing ability.
 import copy
 import os
 import glob
+import json
 import logging
 import posixpath
+import sqlite3
 from pathlib import Path, PurePath
 import subprocess
 from subprocess import PIPE
@@ -25,6 +27,12 @@ logger = create_logger(__name__, 'sh',
 ogr.UseExceptions()
 gdal.UseExceptions()
 
+# Process-wide cache of raster header metadata, keyed by path, file size
+# and modification time, see raster_metadata. Optionally persisted to a
+# SQLite sidecar, see set_metadata_db.
+_raster_metadata = {}
+_metadata_db = None
+
 
 def ogr_reproject(input_shp, to_sr, output_shp=None, in_mem=False):
     """
@@ -156,16 +164,109 @@ def get_shp_sr(in_shp):
     return srs
 
 
+def set_metadata_db(db_path):
+    """
+    Persist the raster metadata cache to a SQLite database at db_path,
+    so that later runs can skip opening rasters that have not changed.
+    Pass None to only cache in memory.
+    """
+    global _metadata_db
+    _metadata_db = str(db_path) if db_path else None
+    if _metadata_db:
+        with sqlite3.connect(_metadata_db, timeout=30) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS raster_metadata '
+                         '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                         'metadata TEXT)')
+        logger.debug('Caching raster metadata in: {}'.format(_metadata_db))
+
+
+def _metadata_key(path):
+    """(absolute path, size, modification time) of path, or None if path
+    is not a local file (e.g. /vsimem), which are not cached."""
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+    return os.path.abspath(path), stat.st_size, stat.st_mtime
+
+
+def _read_metadata(path):
+    src = gdal.Open(path)
+    band = src.GetRasterBand(1)
+    metadata = {'geotransform': list(src.GetGeoTransform()),
+                'x_sz': src.RasterXSize,
+                'y_sz': src.RasterYSize,
+                'depth': src.RasterCount,
+                'srs_wkt': src.GetProjection(),
+                'nodata': band.GetNoDataValue(),
+                'block_size': list(band.GetBlockSize()),
+                'dtype': band.DataType}
+    band = None
+    src = None
+
+    return metadata
+
+
+def _cache_metadata(key, metadata):
+    _raster_metadata[key] = metadata
+    if _metadata_db:
+        with sqlite3.connect(_metadata_db, timeout=30) as conn:
+            conn.execute('INSERT OR REPLACE INTO raster_metadata '
+                         'VALUES (?, ?, ?, ?)',
+                         (key[0], key[1], key[2], json.dumps(metadata)))
+
+
+def _cached_metadata(key):
+    metadata = _raster_metadata.get(key)
+    if metadata is None and _metadata_db:
+        with sqlite3.connect(_metadata_db, timeout=30) as conn:
+            row = conn.execute('SELECT metadata FROM raster_metadata '
+                               'WHERE path = ? AND size = ? AND mtime = ?',
+                               key).fetchone()
+        if row:
+            metadata = json.loads(row[0])
+            _raster_metadata[key] = metadata
+
+    return metadata
+
+
+def raster_metadata(raster):
+    """
+    Header metadata of raster, read without reading any pixels and cached
+    for the process (and in the SQLite sidecar if set_metadata_db has been
+    called) until the file's size or modification time changes.
+
+    Parameters
+    ----------
+    raster : str
+        Path to raster.
+
+    Returns
+    -------
+    dict : geotransform, x_sz, y_sz, depth, srs_wkt, and the nodata,
+        block_size and (GDAL) dtype of band 1
+    """
+    raster = str(raster)
+    key = _metadata_key(raster)
+    if key is None:
+        return _read_metadata(raster)
+    metadata = _cached_metadata(key)
+    if metadata is None:
+        metadata = _read_metadata(raster)
+        _cache_metadata(key, metadata)
+
+    return copy.deepcopy(metadata)
+
+
 def get_raster_sr(raster):
     """
     Get the crs of raster.
     raster: path to raster.
     """
-    ds = gdal.Open(raster)
-    prj = ds.GetProjection()
+    prj = raster_metadata(raster)['srs_wkt']
     srs = osr.SpatialReference(wkt=prj)
     prj = None
-    ds = None
     return srs
 
 
@@ -405,12 +506,12 @@ def raster_bounds(path):
     '''
     GDAL only version of getting bounds for a single raster.
     '''
-    src = gdal.Open(path)
-    gt = src.GetGeoTransform()
+    metadata = raster_metadata(path)
+    gt = metadata['geotransform']
     ulx = gt[0]
     uly = gt[3]
-    lrx = ulx + (gt[1] * src.RasterXSize)
-    lry = uly + (gt[5] * src.RasterYSize)
+    lrx = ulx + (gt[1] * metadata['x_sz'])
+    lry = uly + (gt[5] * metadata['y_sz'])
 
     return ulx, lry, lrx, uly
 
@@ -578,10 +679,8 @@ def match_pixel_size(rasters, dst_dir=None, sfx=None, resampleAlg='cubic', in_me
     rasters = [Path(r) for r in rasters]
     rasters_res = {}
     for r in rasters:
-        src = gdal.Open(str(r))
-        gt = src.GetGeoTransform()
+        gt = raster_metadata(r)['geotransform']
         rasters_res[r] = (gt[1], gt[5])
-        src1 = None
 
     max_x_raster = max(rasters_res.keys(), key=lambda k: abs(rasters_res[k][0]))
     max_y_raster = max(rasters_res.keys(), key=lambda k: abs(rasters_res[k][1]))
@@ -615,7 +714,14 @@ def match_pixel_size(rasters, dst_dir=None, sfx=None, resampleAlg='cubic', in_me
 
 
 def get_raster_stats(raster, band_num=1):
-    src = gdal.Open(raster)
+    # Statistics are cached with the raster's metadata
+    key = _metadata_key(str(raster))
+    metadata = raster_metadata(raster) if key else {}
+    stats = metadata.get('stats', {}).get(str(band_num))
+    if stats is not None:
+        return stats
+
+    src = gdal.Open(str(raster))
     band = src.GetRasterBand(band_num)
 
     stats = band.GetStatistics(True, True)
@@ -624,6 +730,12 @@ def get_raster_stats(raster, band_num=1):
              'max': stats[1],
              'mean': stats[2],
              'std': stats[3]}
+    band = None
+    src = None
+
+    if key:
+        metadata.setdefault('stats', {})[str(band_num)] = stats
+        _cache_metadata(key, metadata)
 
     return stats
 
@@ -354,6 +354,7 @@ def write_gdf(src_gdf, out_footprint, to_str_cols=None,
               nan_to=None,
               precision=None,
               overwrite=True,
+              append=False,
               **kwargs):
     """
     Handles common issues with writing GeoDataFrames to a variety of formats,
@@ -361,6 +362,10 @@ def write_gdf(src_gdf, out_footprint, to_str_cols=None,
     handling NaNs.
     date_format : str
         Use to convert datetime fields to string fields, using format provided
+    append : bool
+        Append features to an existing out_footprint, e.g. to write a
+        layer in chunks, see append_gdf. Takes precedence over overwrite.
+        If out_footprint does not exist it is created.
     TODO: Add different handling for different formats, e.g. does gpkg allow datetime/NaN?
     """
     gdf = copy.deepcopy(src_gdf)
@@ -370,7 +375,7 @@ def write_gdf(src_gdf, out_footprint, to_str_cols=None,
 
     # Format agnostic functions
     # Remove if exists and overwrite
-    if out_footprint.exists():
+    if not append and out_footprint.exists():
         if overwrite:
             logger.warning('Overwriting existing file: '
                            '{}'.format(out_footprint))
@@ -411,11 +416,38 @@ def write_gdf(src_gdf, out_footprint, to_str_cols=None,
                 logger.warning('Attempting to write GeoDataFrame with non-WGS84 '
                                'CRS to GeoJSON. Reprojecting to WGS84.')
                 gdf = gdf.to_crs('epsg:4326')
-        gdf.to_file(out_footprint, driver=driver, **kwargs)
+        out_path = str(out_footprint)
     elif driver in [GPKG, OPEN_FILE_GDB, FILE_GBD]:
-        gdf.to_file(str(out_footprint.parent), layer=layer, driver=driver, **kwargs)
+        out_path = str(out_footprint.parent)
     else:
         logger.error('Unsupported driver: {}'.format(driver))
+        return None
+
+    if append and layer_exists(out_path, layer):
+        append_gdf(gdf, out_path, driver=driver, layer=layer)
+    else:
+        gdf.to_file(out_path, layer=layer, driver=driver, **kwargs)
+
+
+def layer_exists(path, layer=None):
+    """True if path exists and contains layer (if provided)."""
+    if not os.path.exists(path):
+        return False
+    if layer is None:
+        return True
+    return layer in fiona.listlayers(path)
+
+
+def append_gdf(gdf, path, driver, layer=None):
+    """
+    Append the features of gdf to an existing layer with fiona, as
+    GeoDataFrame.to_file does not support appending in all geopandas
+    versions. The features are written with the schema of the existing
+    layer.
+    """
+    logger.debug('Appending {:,} features to: {}'.format(len(gdf), path))
+    with fiona.open(path, 'a', driver=driver, layer=layer) as dst:
+        dst.writerecords(gdf.iterfeatures())
 
 
 def dissolve_touching(gdf: gpd.GeoDataFrame):
@@ -442,3 +474,19 @@ def read_vec(vec_path: str, **kwargs) -> gpd.GeoDataFrame:
         gdf = gpd.read_file(vec_path, driver=driver, **kwargs)
 
     return gdf
+
+
+def count_features(vec_path: str) -> int:
+    """
+    Number of features in any valid vector format, without reading them.
+    """
+    driver, layer = detect_ogr_driver(vec_path, name_only=True)
+    if layer is not None:
+        src = fiona.open(str(Path(vec_path).parent), layer=layer,
+                         driver=driver)
+    else:
+        src = fiona.open(str(vec_path), driver=driver)
+    with src:
+        count = len(src)
+
+    return count
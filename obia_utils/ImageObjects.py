@@ -1,7 +1,8 @@
 import copy
+import heapq
 import operator
+import os
 from random import randint
-import time
 
 import numpy as np
 from osgeo import ogr, gdal
@@ -11,6 +12,10 @@ from tqdm import tqdm
 
 from misc_utils.logging_utils import create_logger
 from misc_utils.gpd_utils import read_vec, write_gdf
+from obia_utils.adjacency import query_pairs, touches_adjacency, csr_row, \
+    pairs_to_csr, raster_label_pairs, label_pairs_to_neighbors, UnionFind, \
+    geometry_hash, save_neighbors, load_neighbors
+from obia_utils.tiling import tiled_classify, tiled_dissolve
 # from misc_utils.RasterWrapper import Raster
 
 import matplotlib.pyplot as plt
@@ -37,6 +42,70 @@ def weighted_majority(values, weights):
     return wmaj
 
 
+def aggregate_pair(agg_type, value, other, weight, other_weight):
+    """Aggregate the values of two objects being merged, using the
+    objects' areas as weights where needed."""
+    if agg_type == 'mean':
+        agg = weighted_mean(values=[value, other],
+                            weights=[weight, other_weight])
+    elif agg_type == 'majority':
+        # Get the value assoc with object that has most area
+        agg = max([(value, weight), (other, other_weight)],
+                  key=operator.itemgetter(1))[0]
+    elif agg_type == 'minority':
+        # Get the value assoc. with object that has least area
+        agg = min([(value, weight), (other, other_weight)],
+                  key=operator.itemgetter(1))[0]
+    elif agg_type == 'minimum':
+        agg = min(value, other)
+    elif agg_type == 'maximum':
+        agg = max(value, other)
+    elif agg_type == 'sum':
+        agg = value + other
+    elif agg_type == 'bool_and':
+        agg = value and other
+    elif agg_type == 'bool_or':
+        agg = value or other
+    else:
+        logger.error('Unknown agg_type: {}'.format(agg_type))
+        raise KeyError
+
+    return agg
+
+
+def aggregate_groups(agg_type, values, weights, groups):
+    """Aggregate values within groups, using weights (object areas) where
+    needed. Returns a pd.Series indexed by group."""
+    df = pd.DataFrame({'value': np.asarray(values),
+                       'weight': np.asarray(weights),
+                       'group': np.asarray(groups)})
+    grouped = df.groupby('group')
+    if agg_type == 'mean':
+        agg = ((df['value'] * df['weight']).groupby(df['group']).sum() /
+               grouped['weight'].sum())
+    elif agg_type == 'majority':
+        # Value of the object with the most area in each group
+        agg = df.loc[grouped['weight'].idxmax()].set_index('group')['value']
+    elif agg_type == 'minority':
+        # Value of the object with the least area in each group
+        agg = df.loc[grouped['weight'].idxmin()].set_index('group')['value']
+    elif agg_type == 'minimum':
+        agg = grouped['value'].min()
+    elif agg_type == 'maximum':
+        agg = grouped['value'].max()
+    elif agg_type == 'sum':
+        agg = grouped['value'].sum()
+    elif agg_type == 'bool_and':
+        agg = grouped['value'].all()
+    elif agg_type == 'bool_or':
+        agg = grouped['value'].any()
+    else:
+        logger.error('Unknown agg_type: {}'.format(agg_type))
+        raise KeyError
+
+    return agg
+
+
 # Pairwise functions
 def within_range(a, b, range):
     return operator.le(abs(a - b), range)
@@ -57,6 +126,8 @@ def pairwise_match(row, possible_match, pairwise_criteria : list):
             'within': {'field': "field_name", 'range': "within range"}
             'threshold: {'field': "field_name, 'op', operator comparison fxn,
                          'threshold': value to use in fxn}
+    Values may be arrays (e.g. of all neighbors of an object) to test
+    many possible matches at once.
     Returns
     -------
     bool : True is all criteria are met
@@ -91,7 +162,7 @@ def pairwise_match(row, possible_match, pairwise_criteria : list):
             #                                       met))
             criteria_met.append(met)
 
-    return all(criteria_met)
+    return np.logical_and.reduce(criteria_met)
 
 
 def z_score(value, mean, std):
@@ -138,39 +209,74 @@ def overlay_any_objects(geometry, others, predicate='contains',
     """Determines if any others are related to geometry, based on spatial
      predicate, optionally using the centroids of others, optionally
      using a threshold on others to reduce the number of others that are
-    considered"""
-    if threshold:
-        # Subset others to only include those that meet threshold provided
-        others = others[op(others[other_value_field], threshold)]
+    considered.
+    geometry may be a single geometry, or a GeoSeries / GeoDataFrame of
+    many objects, in which case all objects are tested with one bulk
+    spatial index query and a boolean pd.Series is returned. threshold
+    may then be an array-like with a threshold for each object, e.g. a
+    column of objects."""
+    single = not isinstance(geometry, (gpd.GeoSeries, gpd.GeoDataFrame))
+    if single:
+        geometry = gpd.GeoSeries([geometry])
+        if threshold is not None:
+            threshold = [threshold]
+    geoms = gpd.GeoSeries(geometry.geometry.values, index=geometry.index)
+    if threshold is not None:
+        threshold = np.broadcast_to(np.asarray(threshold), len(geoms))
 
-    # Determine if object contains others
     if others_centroid:
-        others_geoms = others.geometry.centroid.values
+        others_geoms = others.geometry.centroid
     else:
-        others_geoms = others.geometry.values
-    if predicate == 'contains':
-        overlays = np.any([geometry.contains(og) for og in others_geoms])
-    elif predicate == 'within':
-        overlays = np.any([geometry.within(og) for og in others_geoms])
-    elif predicate == 'intersects':
-        overlays = np.any([geometry.intersects(og) for og in others_geoms])
-    elif predicate == 'disjoint':
-        overlays = np.any([geometry.disjoint(og) for og in others_geoms])
-    elif predicate == 'overlaps':
-        overlays = np.any([geometry.overlaps(og) for og in others_geoms])
-    elif predicate == 'touches':
-        overlays = np.any([geometry.touches(og) for og in others_geoms])
-
-    return overlays
+        others_geoms = others.geometry
+    others_geoms = gpd.GeoSeries(others_geoms.values)
+
+    overlays = np.zeros(len(geoms), dtype=bool)
+    if len(others_geoms) > 0 and len(geoms) > 0:
+        # 'disjoint' cannot use the spatial index: an object is disjoint
+        # from any other if fewer others intersect it than are considered
+        query_predicate = 'intersects' if predicate == 'disjoint' \
+            else predicate
+        query_idx, other_idx = query_pairs(others_geoms, geoms,
+                                           predicate=query_predicate)
+        if threshold is not None:
+            # Only consider others that meet the object's threshold
+            other_values = others[other_value_field].values
+            met = np.asarray(op(other_values[other_idx],
+                                threshold[query_idx]), dtype=bool)
+            query_idx = query_idx[met]
+        if predicate == 'disjoint':
+            n_related = np.bincount(query_idx, minlength=len(geoms))
+            if threshold is not None:
+                n_considered = np.array([np.asarray(op(other_values, t),
+                                                    dtype=bool).sum()
+                                         for t in threshold])
+            else:
+                n_considered = len(others_geoms)
+            overlays = n_related < n_considered
+        else:
+            overlays[query_idx] = True
+
+    if single:
+        return overlays[0]
+    return pd.Series(overlays, index=geometry.index)
 
 
 class ImageObjects:
     """
     Designed to facilitate object-based-image-analysis
     classification.
+    If label_raster is provided (the raster segmentation the objects were
+    polygonized from), neighbors are determined from adjacent pixel labels
+    rather than vector topology. label_fld holds each object's label.
+    If adjacency_cache is provided (a path to an .npz file, or True to use
+    one next to objects_path), the neighbors of all objects are computed
+    once and saved there, keyed by a hash of the geometries, and reloaded
+    on later runs with the same objects.
     TODO: Make a subclass of gpd.GeoDataFrame
     """
-    def __init__(self, objects_path, value_fields=None):
+    def __init__(self, objects_path, value_fields=None,
+                 label_raster=None, label_fld='raster_val',
+                 adjacency_cache=None):
         if isinstance(objects_path, gpd.GeoDataFrame):
             self.objects = copy.deepcopy(objects_path)
             self.objects_path = None
@@ -196,6 +302,9 @@ class ImageObjects:
         self.m_ct_fld = 'merge_count'
         self.continue_iter = 'continue_iter'
         self.mergeable_ids = None
+        # Values of value_fields before pseudo_merging aggregated them,
+        # used by merge(aggregate_values=True)
+        self._premerge_values = None
 
         # List of (field_name, summary_stat) to be recalculated after merging
         self.value_fields = self._parse_value_fields(value_fields)
@@ -212,6 +321,20 @@ class ImageObjects:
         self.objects[self.nebs_fld] = np.NaN
         # Rules
         self._rule_fld_name = 'in_field' # field name in rule dictionaries
+        # Label raster adjacency
+        self.label_raster = label_raster
+        self.label_fld = label_fld
+        self._label_neighbors = None
+        # Persisted adjacency
+        if adjacency_cache is True:
+            if self.objects_path is None:
+                logger.error('adjacency_cache path must be provided when '
+                             'objects are not read from a file.')
+                raise ValueError
+            adjacency_cache = '{}_adjacency.npz'.format(
+                os.path.splitext(self.objects_path)[0])
+        self.adjacency_cache = adjacency_cache
+        self._cached_neighbors = None
 
         # TODO: check for unique index, create if not
         # Name index if unnamed
@@ -267,8 +390,9 @@ class ImageObjects:
     def calc_compactness(self):
         logger.info('Calculating object compactness')
         # Polsby - Popper Score - - 1 = circle
-        self.objects[self.compact_fld] = self.objects.geometry.apply(
-            lambda x: (np.pi * 4 * x.area) / (x.boundary.length) ** 2)
+        self.objects[self.compact_fld] = (np.pi * 4 *
+                                          self.objects.geometry.area /
+                                          self.objects.geometry.length ** 2)
 
     def _nv_field_name(self, field):
         return '{}_nv'.format(field)
@@ -283,9 +407,70 @@ class ImageObjects:
         value = self.objects.at[index_value, value_field]
         return value
 
-    def get_neighbors(self, subset=None):
+    @property
+    def label_neighbors(self):
+        """Series of neighbor IDs for each object, determined from the
+        label raster. Computed on first access."""
+        if self._label_neighbors is None:
+            if self.label_fld not in self.fields:
+                logger.error('Label field not found: {}'.format(self.label_fld))
+                raise KeyError
+            pairs = raster_label_pairs(self.label_raster)
+            self._label_neighbors = label_pairs_to_neighbors(
+                pairs, self.objects[self.label_fld])
+        return self._label_neighbors
+
+    @property
+    def cached_neighbors(self):
+        """Series of neighbor IDs for each object, loaded from the
+        adjacency_cache if it was saved for the current geometries,
+        otherwise computed for all objects and saved. Loaded on first
+        access."""
+        if self._cached_neighbors is None:
+            key = geometry_hash(self.objects.geometry)
+            neighbors = load_neighbors(self.adjacency_cache, key)
+            if neighbors is None:
+                logger.info('Computing neighbors for all objects...')
+                adj = touches_adjacency(self.objects.geometry)
+                object_ids = self.objects.index.to_numpy(dtype='i')
+                neighbors = pd.Series(
+                    [np.setdiff1d(object_ids[csr_row(adj, pos)], [i])
+                     .astype('i')
+                     for pos, i in enumerate(object_ids)],
+                    index=self.objects.index,
+                    dtype=object)
+                save_neighbors(self.adjacency_cache, neighbors, key)
+            self._cached_neighbors = neighbors
+        return self._cached_neighbors
+
+    def _known_neighbors(self):
+        """Precomputed neighbors to take neighbors from before computing
+        them from geometries."""
+        known = []
+        if self.label_raster is not None:
+            known.append(self.label_neighbors)
+        if self.adjacency_cache is not None:
+            known.append(self.cached_neighbors)
+        return known
+
+    def _invalidate_known_neighbors(self, ids):
+        """Drop label and cached neighbors of objects with geometries that
+        have changed (ids), and of objects neighboring them, so that they
+        are recomputed from geometries."""
+        def _drop_stale(known):
+            if known is None:
+                return None
+            stale = [ids]
+            stale.extend(known.reindex(ids).dropna().values)
+            return known.drop(np.unique(np.concatenate(stale)),
+                              errors='ignore')
+        self._label_neighbors = _drop_stale(self._label_neighbors)
+        self._cached_neighbors = _drop_stale(self._cached_neighbors)
+
+    def get_neighbors(self, subset=None, known_only=False):
         """Creates a new column containing IDs of neighbors as list of
-        indicies."""
+        indicies. If known_only, neighbors are only taken from the label
+        raster or adjacency cache, and not computed from geometries."""
         # If no subset is provided, use the whole dataframe
         if subset is None:
             logger.warning('No subset provided when finding neighbors, '
@@ -296,36 +481,38 @@ class ImageObjects:
         ns = []
         # List to store unique_ids
         labels = []
-        # Iterate over rows, for each row, get indicies of all features
-        # it touches
-        # logger.debug('Getting neighbors for {} '
-        #              'features...'.format(len(subset)))
-        pre = time.time()
-        for index, row in tqdm(subset.iterrows(),
-                               total=len(subset),
-                               desc='Finding neighbors'):
-            # neighbors = self.objects[self.objects.geometry
-            #                          .touches(row['geometry'])].index.tolist()
-            # ARF
-            neighbors = np.unique(self.objects[self.objects.geometry
-                                  .touches(row['geometry'])]
-                                  .index.to_numpy(dtype='i'))
-
-            # If the feature is considering itself a neighbor remove it from
-            # the list
-            if index in neighbors:
-                neighbors = np.delete(neighbors, np.where(neighbors == index))
-
-            # Save the neighbors that have been found and their IDs
-            ns.append(neighbors)
-            labels.append(index)
-        # post = time.time()
-        # logger.info('rows: {}'.format(post-pre))
-        # pre = time.time()
-        # neighbors = [self.objects[self.objects.geometry.touches(t.geometry)].index.values
-        #              for t in subset.itertuples()]
-        # post = time.time()
-        # logger.info('tuples compre: {}'.format(post-pre))
+
+        # Take neighbors from the label raster or adjacency cache where
+        # possible, only the remaining objects are found using geometries
+        geom_subset = subset
+        for known in self._known_neighbors():
+            known_nebs = known.reindex(geom_subset.index).dropna()
+            ns.extend(known_nebs.values)
+            labels.extend(known_nebs.index)
+            geom_subset = geom_subset[
+                ~geom_subset.index.isin(known_nebs.index)]
+
+        if len(geom_subset) > 0 and not known_only:
+            # Sparse (subset x objects) adjacency from a single bulk spatial
+            # index query, rather than a touches() test per object
+            adj = touches_adjacency(self.objects.geometry,
+                                    query_geoms=geom_subset.geometry)
+            object_ids = self.objects.index.to_numpy(dtype='i')
+
+            for pos, index in enumerate(tqdm(geom_subset.index,
+                                             total=len(geom_subset),
+                                             desc='Finding neighbors')):
+                neighbors = np.unique(object_ids[csr_row(adj, pos)])
+
+                # If the feature is considering itself a neighbor remove it
+                # from the list
+                if index in neighbors:
+                    neighbors = np.delete(neighbors,
+                                          np.where(neighbors == index))
+
+                # Save the neighbors that have been found and their IDs
+                ns.append(neighbors)
+                labels.append(index)
 
         # if not any(ns):
         #     logger.warning('No neighbors found.')
@@ -389,82 +576,55 @@ class ImageObjects:
             self.objects[self.mp_fld] = self.objects[self.mp_fld].apply(
                 lambda x: np.unique(np.where(x == old_neb, new_neb, x)))
 
-    def replace_neighbor_value(self, neb_v_fld, old_neb, new_neb, new_value):
-        """Replace old_nebs value in neb_v_fld with new_neb and new_nebs
-        value, new_value."""
-        def _rowwise_replace_nv(neb_v_fld, old_neb, new_neb, new_value):
-            if old_neb in neb_v_fld:
-                neb_v_fld.pop(old_neb)
-                neb_v_fld[new_neb] = new_value
-            return neb_v_fld
-
-        # self.objects[neb_v_fld] = self.objects[neb_v_fld].apply(
-        #     lambda x: _rowwise_replace_nv(x, old_neb,
-        #                                   new_neb, new_value)
-        #     if isinstance(x, dict) else x)
-        self.objects[~self.objects[neb_v_fld].isna()][neb_v_fld] = \
-            self.objects[~self.objects[neb_v_fld].isna()][neb_v_fld].apply(
-                lambda x: _rowwise_replace_nv(x, old_neb, new_neb, new_value))
-        # self.objects[neb_v_fld] = self.objects[neb_v_fld].apply(
-        #     lambda x: _rowwise_replace_nv(x,
-        #                                   old_neb,
-        #                                   new_neb,
-        #                                   new_value)
-        #     if isinstance(x, dict) else x)
+    def neighbor_values(self, value_field, subset=None,
+                        compute_neighbors=False):
+        """
+        Values of value_field for the neighbors of each object in subset,
+        gathered from the value field by index into an array aligned with
+        the edges of adjacency_matrix(subset), rather than stored per object.
+
+        Returns
+        -------
+        tuple : (adj, has_nebs, nv) where adj and has_nebs are as returned by
+            adjacency_matrix and nv[adj.indptr[i]:adj.indptr[i+1]] are the
+            values of the neighbors of the i-th object in subset, in the
+            order of adj.indices
+        """
+        adj, has_nebs = self.adjacency_matrix(
+            subset, compute_neighbors=compute_neighbors)
+        nv = self.objects[value_field].to_numpy()[adj.indices]
+
+        return adj, has_nebs, nv
 
     def compute_neighbor_values(self, value_field, subset=None,
                                 compute_neighbors=False):
-        """Look up the value in value field for each neighbor,
-        adding a dict of {neighbor_id: value} in out_field of
-        each row. If compute_neighbors == False, only performed
-        on rows where neighbors have been computed previously).
+        """Register value_field as a neighbor value field, optionally
+        computing neighbors for subset. Neighbor values are not stored,
+        they are gathered from value_field when needed (see
+        neighbor_values) so stay current as objects are merged. If
+        compute_neighbors == False, neighbor values are only available for
+        rows where neighbors have been computed previously.
         Parameters
         ---------
         value_field : str
             Name of field to compute neighbor values for
         subset : pd.DataFrame or gpd.GeoDataFrame
             Subset of self.objects to compute neighbors for
-            TODO: Change all "subsets" to take list of indicies to compute on
-             which will avoid duplicating large dataframes
         compute_neighbors : bool
             True to compute neighbor for any object in subset (or self.objects
              if subset not provided) that doesn't have neighbors computed
         """
         out_field = self._nv_field_name(value_field)
         if subset is None:
-            subset = copy.deepcopy(self.objects)
+            subset = self.objects
         if compute_neighbors:
             # If subset doesn't have neighbors computed, compute them
             if any(subset[self.nebs_fld].isnull()):
-                subset = self.get_neighbors(subset)
-        # Get all neighbors that have been found in dataframe
-        # This takes lists of neighbors and puts them into the index of an
-        # empty dataframe, and drops NaN's and drops duplicates.
-        neighbors = pd.DataFrame(subset.neighbors.explode().
-                                 dropna().
-                                 drop_duplicates()).set_index(self.nebs_fld)
-        # Get the value in value_field for each neighbor feature
-        neighbors = pd.merge(neighbors, self.objects[[value_field]],
-                             left_index=True, right_index=True,
-                             )
-        # Create a dictionary in the main objects dataframe
-        # which is {neighbor_id: value} for all objects that
-        # have neighbors computed
-        # TODO: change to use get_value()
-        subset[out_field] = (subset[~subset[self.nebs_fld].isnull()][self.nebs_fld]
-                             .apply(lambda x: {i: neighbors.at[i, value_field]
-                                               for i in x}))
-
-        # Merge neighbor value field back in
-        if out_field in self.fields:
-            self.objects.drop(columns=out_field, inplace=True)
-        self.objects = pd.merge(self.objects,
-                                subset[[out_field]],
-                                how='outer', suffixes=('', '_y'),
-                                left_index=True, right_index=True)
+                self.get_neighbors(subset[subset[self.nebs_fld].isnull()])
         # Add neighbor value field and field it is based on to list of tuples
         # of all neighbor value fields
-        self.nv_fields.append((value_field, out_field))
+        if (value_field, out_field) not in self.nv_fields:
+            self.nv_fields.append((value_field, out_field))
 
         return self.objects[self.objects.index.isin(subset.index)]
 
@@ -537,22 +697,29 @@ class ImageObjects:
         # else:
         #     self.objects[self.mc_fld] = True
         if merge_candidate_rules is not None:
-            for rule in merge_candidate_rules:
-                self.apply_single_rule(**rule)
+            self.classify_objects(True, class_fld=self.mc_fld,
+                                  threshold_rules=[
+                                      r for r in merge_candidate_rules
+                                      if r['rule_type'] == 'threshold'],
+                                  adj_rules=[
+                                      r for r in merge_candidate_rules
+                                      if r['rule_type'] == 'adjacent'],
+                                  overwrite_class=True)
         else:
             self.objects[self.mc_fld] = True
-        self.classify_objects(True, class_fld=self.mc_fld,
-                              threshold_rules=[r for r in merge_candidate_rules
-                                               if r['rule_type'] == 'threshold'],
-                              adj_rules=[r for r in merge_candidate_rules
-                                         if r['rule_type'] == 'adjacent'],
-                              overwrite_class=True)
 
     def pseudo_merging(self, merge_candidate_rules, pairwise_criteria,
                        grow_fields: list = None,
                        merge_seeds=False,
                        max_iter=None):
         """
+        Determine merges without modifying geometries. Each mergeable
+        object, smallest first, is merged into the neighboring merge
+        candidate with the closest values in grow_fields. Mergeable objects
+        are held in a priority queue by area and merged objects are resolved
+        with a union-find, so each merge only updates the objects it touches.
+        Merges are recorded in merge_path, see merge().
+
         mc_fields_ops_thresholds : list TODO: Update for merge_candidate_rules
             List of tuples of (field_name, operator fxn, threshold) to identify
             merge candidate objects. Only these object will be merged into. If
@@ -601,238 +768,301 @@ class ImageObjects:
         self.objects[self.pseudo_area_fld] = self.objects.area
         self.objects = self.objects.sort_values(by=self.pseudo_area_fld)
 
-        # Initialize empty lists to store "merge path" -> ordered list of
-        # neighbors IDs to merge into
-        self.objects[self.mp_fld] = [[] for i in range(self.num_objs)]
-
-        # Determine all mergable IDs, using the merge_seeds as starting point
-        if max_iter is None:
-            self.objects[self.continue_iter] = False
-        self.update_mergeable_ids(max_iter=max_iter)
-
-        # Get neighbors for mergeable IDs
-        self.get_neighbors(subset=self.objects[
-            self.objects.index.isin(self.mergeable_ids)])
-
         # If no grow fields provided, use all value fields
         if grow_fields is None:
             grow_fields = self.value_fields
+        if merge_candidate_rules is None:
+            merge_candidate_rules = []
+        if pairwise_criteria is None:
+            pairwise_criteria = []
 
-        # While there are rows that are mergeable and
-        # that haven't been checked look for a possible merge to a neighbor
-        # that is a merge_candidate
-        while self.mergeable_ids:
-            logger.info('Mergeable IDs: {:,}'.format(len(self.mergeable_ids)))
-            # Get the first row
-            r = self.objects.loc[self.mergeable_ids[0]]
-
-            # Get ID of row
-            i = r.name
-            logger.debug('Working on object: {}'.format(i))
-
-            # logger.debug('Current ID: {}'.format(i))
-            # Check that neighbor value fields have been computed for all
-            # merge fields, if not compute
-            for gf in grow_fields:
-                merge_nv_field = self._nv_field_name(gf)
-                # TODO: better check for computed_neighbor values
-                # TODO: could add compute_neighbors=True to compute neighbors
-                #  "on the fly" rather than upfront out of the merging loop
-                # if not all(neighbors in merge_field.keys()) (apply)
-                if merge_nv_field not in r.index:
-                    self.compute_neighbor_values(gf)  # TODO: for merge_candidates only?
+        # Get neighbors for all objects that can be merged or merged into
+        self.get_neighbors(subset=self.objects[
+            (self.objects[self.m_seed_fld] == True) |
+            (self.objects[self.mc_fld] == True)])
+
+        # Working copies of all fields used while merging, by position
+        ids = self.objects.index.to_numpy(dtype='i')
+        id_pos = {oid: pos for pos, oid in enumerate(ids)}
+        value_fields = self.value_fields if self.value_fields else {}
+        pairwise_fields = [params['field'] for pc in pairwise_criteria
+                           for params in pc.values()]
+        rule_fields = [r[self._rule_fld_name] for r in merge_candidate_rules]
+        vals = dict()
+        for fld in set(list(value_fields) + list(grow_fields) +
+                       pairwise_fields + rule_fields):
+            vals[fld] = self.objects[fld].to_numpy(copy=True)
+            if value_fields.get(fld) == 'mean':
+                vals[fld] = vals[fld].astype(float)
+        area = self.objects[self.pseudo_area_fld].to_numpy(dtype=float,
+                                                           copy=True)
+        mergeable = self.objects[self.m_fld].to_numpy(dtype=bool, copy=True)
+        candidate = (self.objects[self.mc_fld] == True).to_numpy(copy=True)
+        seed = (self.objects[self.m_seed_fld] == True).to_numpy(copy=True)
+        merge_ct = np.zeros(len(ids), dtype=int)
+        merge_paths = [[] for _ in range(len(ids))]
+        nebs = [set(id_pos[n] for n in ns if n in id_pos)
+                if isinstance(ns, np.ndarray) else None
+                for ns in self.objects[self.nebs_fld]]
+        merged_into = UnionFind(len(ids))
+
+        # Running sums for the standard deviation of each grow field, which
+        # is updated as merged values change rather than recomputed
+        std_n = {gf: np.count_nonzero(~pd.isnull(vals[gf]))
+                 for gf in grow_fields}
+        std_s1 = {gf: np.nansum(vals[gf].astype(float)) for gf in grow_fields}
+        std_s2 = {gf: np.nansum(vals[gf].astype(float) ** 2)
+                  for gf in grow_fields}
+
+        def _std(gf):
+            n = std_n[gf]
+            return np.sqrt(max(std_s2[gf] - std_s1[gf] ** 2 / n, 0) / (n - 1))
+
+        def _set_value(fld, pos, value):
+            if fld in std_n and not pd.isnull(vals[fld][pos]):
+                std_s1[fld] -= vals[fld][pos]
+                std_s2[fld] -= vals[fld][pos] ** 2
+            vals[fld][pos] = value
+            if fld in std_n and not pd.isnull(value):
+                std_s1[fld] += value
+                std_s2[fld] += value ** 2
+
+        def _neighbors(pos):
+            # Compute neighbors on demand, resolving any merged neighbors
+            if nebs[pos] is None:
+                found = self.get_neighbors(
+                    self.objects.iloc[[pos]]).iat[0, self.objects.columns
+                                                  .get_loc(self.nebs_fld)]
+                nebs[pos] = set(merged_into.find(id_pos[n]) for n in found
+                                if n in id_pos) - {pos}
+            return nebs[pos]
+
+        def _is_mergeable(pos):
+            # Same requirements as update_mergeable_ids: a mergeable merge
+            # candidate seed that has not reached max_iter
+            return (candidate[pos] and mergeable[pos] and seed[pos] and
+                    (max_iter is None or merge_ct[pos] < max_iter))
+
+        def _is_candidate(pos):
+            for rule in merge_candidate_rules:
+                fld_vals = vals[rule[self._rule_fld_name]]
+                is_met = rule['op'](fld_vals[pos], rule['threshold'])
+                if rule['rule_type'] == 'adjacent':
+                    is_met = any(rule['op'](fld_vals[n], rule['threshold'])
+                                 for n in _neighbors(pos))
+                if not is_met:
+                    return False
+            return True
+
+        def _row(pos):
+            return {fld: vals[fld][pos] for fld in pairwise_fields}
+
+        # Priority queue of (area, position) of mergeable objects, smallest
+        # first. Entries are skipped if stale (area changed or no longer
+        # mergeable) rather than resorting all objects after each merge.
+        queue = [(area[pos], pos) for pos in range(len(ids))
+                 if _is_mergeable(pos)]
+        heapq.heapify(queue)
+        merges = 0
+        pbar = tqdm(desc='Pseudo-merging')
+        while queue:
+            a, i = heapq.heappop(queue)
+            if a != area[i] or not _is_mergeable(i):
+                continue
+            pbar.update(1)
 
             # Find best match, which is closest value in terms of standard
-            # deviations summed for all merge fields, given pairwise criteria
+            # deviations summed for all grow fields, given pairwise criteria
             # are all met.
-            # Init dict to hold all standard deviations for current ID for
-            # each neighbor:
-            # {neighbor_id1: [std of merge_field1, std of merge_field2, ...],
-            #  neighbor_id2: [...]}
-            neighbor_abs_stds = {n: [] for n in r[self.nebs_fld]
-                                 if n is not None}
-            # Compute number of std away from current row's value for each
-            # neighbor for each merge_field, in order to choose best neighbor
-            # to merge with
-            for neb_id in r[self.nebs_fld]:
-                # Skip if marked unmergeable or not a merge_candidate
-                try:
-                    if (not self.objects.at[neb_id, self.m_fld] or not self.objects.at[neb_id, self.mc_fld]):
-                        continue
-                except Exception as e:
-                    logger.error(e)
-                    logger.error('row: {}'.format(i))
-                    logger.error('neb_id: {}, type: {}'.format(neb_id, type(neb_id)))
-                    logger.error('m_fld: {}, type: {}'.format(self.m_fld, type(self.m_fld)))
-                    continue
-
-                # Get the neighbors row, containing all values
-                possible_match = self.objects.loc[neb_id, :]
-                # Check if neighbor meets pairwise criteria, if not skip
-                if pairwise_criteria is not None and \
-                        not all([pairwise_match(r, possible_match, pc)
-                                 for pc in pairwise_criteria]):
-                    neighbor_abs_stds.pop(neb_id)
-                    continue
-                # Get number of standard deviations in each grow field
-                for gf in grow_fields:
-                    neighbor_abs_stds[neb_id].append(
-                        abs_stds(r[gf], possible_match[gf],
-                                 std=self.object_stats.loc['std', gf]))
-
-            # Find neighbor with least total std away from feature considering
-            # all merge fields
-            best_match = None
-            best_match_id = None
-            if len(neighbor_abs_stds.keys()) != 0:
-                best_match_id = min(neighbor_abs_stds.keys(),
-                                    key=lambda k: sum(neighbor_abs_stds[k]))
-                best_match = self.objects.loc[best_match_id, :] # Can potentially remove this, just check if best_match_id below
-                logger.debug('Match found: {}'.format(best_match_id))
-
-            if best_match is not None:
-                logger.debug('Aggregating stats of current object and best match...')
-                # Update value fields of best match row with approriate
+            # Neighbors that are mergeable merge candidates, in ID order
+            nebs_i = np.array([n for n in _neighbors(i)
+                               if mergeable[n] and candidate[n]], dtype=int)
+            nebs_i = nebs_i[np.argsort(ids[nebs_i])]
+            # Check if neighbors meet pairwise criteria, all at once
+            if pairwise_criteria and len(nebs_i) > 0:
+                nebs_i = nebs_i[np.logical_and.reduce(
+                    [pairwise_match(_row(i), _row(nebs_i), pc)
+                     for pc in pairwise_criteria])]
+
+            if len(nebs_i) > 0:
+                neighbor_abs_stds = np.sum(
+                    [abs_stds(vals[gf][i], vals[gf][nebs_i].astype(float),
+                              std=_std(gf))
+                     for gf in grow_fields], axis=0)
+                # NaN differences are never the best match
+                neighbor_abs_stds[np.isnan(neighbor_abs_stds)] = np.inf
+                b = nebs_i[np.argmin(neighbor_abs_stds)]
+                logger.debug('Match found: {} -> {}'.format(ids[i], ids[b]))
+
+                # Update value fields of best match with appropriate
                 # aggregate e.g.: weighted mean
-                for vf, agg_type in self.value_fields.items():
-                    if agg_type == 'mean':
-                        self.objects.at[best_match_id, vf] = (
-                            weighted_mean(values=[r[vf], best_match[vf]],
-                                          weights=[r[self.pseudo_area_fld],
-                                                   best_match[self.pseudo_area_fld]]))
-                    elif agg_type == 'majority':
-                        # Get the value assoc with object that has most area
-                        self.objects.at[best_match_id, vf] = (
-                            max([(r[vf], r[self.pseudo_area_fld]),
-                                 (best_match[vf], best_match[self.pseudo_area_fld])],
-                                key=operator.itemgetter(1))[0])
-                    elif agg_type == 'minority':
-                        # Get the value assoc. with object that has least area
-                        self.objects.at[best_match_id, vf] = (
-                            min([(r[vf], r[self.pseudo_area_fld]),
-                                 (best_match[vf], best_match[self.pseudo_area_fld])],
-                                key=operator.itemgetter(1))[0])
-                    elif agg_type == 'minimum':
-                        self.objects.at[best_match_id, vf] = min(
-                            r[vf], best_match[vf])
-                    elif agg_type == 'maximum':
-                        self.objects.at[best_match_id, vf] = max(
-                            r[vf], best_match[vf])
-                    elif agg_type == 'sum':
-                        self.objects.at[best_match_id, vf] = sum(
-                            r[vf] + best_match[vf])
-                    elif agg_type == 'bool_and':
-                        self.objects.at[best_match_id, vf] = \
-                            (r[vf] and best_match[vf])
-                    elif agg_type == 'bool_or':
-                        self.objects.at[best_match_id, vf] = \
-                            (r[vf] or best_match[vf])
-                    else:
-                        logger.error('Unknown agg_type: {} for '
-                                     'value field: {}'.format(agg_type, vf))
-
-                # Update area field (add areas) TODO: make pseudo_area field
-                self.objects.at[best_match_id, self.pseudo_area_fld] = (
-                        r[self.pseudo_area_fld] + best_match[self.pseudo_area_fld])
-
-                # Calculate neighbors for best match if not already
-                if isinstance(best_match[self.nebs_fld], float) or \
-                        best_match[self.nebs_fld].size == 0 or \
-                        any([np.isnan(n) for n in best_match[self.nebs_fld]]):
-                    self.get_neighbors(self.objects[self.objects.index
-                                       .isin([best_match_id])])
-
-                # Replace current object with best match in all neighbor fields
-                # and merge_paths
-                self.replace_neighbor(i, best_match_id, update_merges=True)
-
-                # Update neighbor value fields that had current object as
-                # neighbor
-                for vf, nvf in self.nv_fields:
-                    self.replace_neighbor_value(nvf, i, best_match_id,
-                                                self.objects.at[best_match_id,
-                                                                vf])
-                # Update merge_path
-                # Get all of the feature to be merged's merge_path ids and add
-                # them to best match objects merge_path
-                # RAF
-                self.objects.at[best_match_id, self.mp_fld] = \
-                    np.concatenate([self.objects.at[best_match_id, self.mp_fld],
-                                    r[self.mp_fld]]).astype('i')
-                # Store ID to merge in new (best_match) object's merge_path
-                # field
-                # self.objects.at[best_match_id, self.mp_fld].append(i)
-                self.objects.at[best_match_id, self.mp_fld] = \
-                    np.concatenate([self.objects.at[best_match_id, self.mp_fld],
-                                    [i]])
-
-                # Mark as merge_seed
-                self.objects.at[best_match_id, self.m_seed_fld] = True
+                for vf, agg_type in value_fields.items():
+                    _set_value(vf, b, aggregate_pair(agg_type,
+                                                     vals[vf][i], vals[vf][b],
+                                                     area[i], area[b]))
+                area[b] += area[i]
+                seed[b] = True
+                merge_ct[b] += 1
+
+                # Merge current object into best match: combine neighbors
+                # and merge paths, updating only the objects touched
+                merged_into.union(i, into=b)
+                for n in _neighbors(i):
+                    if nebs[n] is not None:
+                        nebs[n].discard(i)
+                        if n != b:
+                            nebs[n].add(b)
+                _neighbors(b).update(_neighbors(i) - {b})
+                nebs[b].discard(i)
+                merge_paths[b].extend(merge_paths[i])
+                merge_paths[b].append(i)
+                merge_paths[i] = []
+                merges += 1
+
+                # Recheck merge candidacy of objects with changed values or
+                # neighbors, queueing any that have become mergeable
+                recheck = [b]
+                if any(r['rule_type'] == 'adjacent'
+                       for r in merge_candidate_rules):
+                    recheck.extend(nebs[b])
+                for pos in recheck:
+                    if mergeable[pos] and not candidate[pos]:
+                        candidate[pos] = _is_candidate(pos)
+                    if _is_mergeable(pos):
+                        heapq.heappush(queue, (area[pos], pos))
 
             # Mark original feature as no longer mergeable, it was either
             # "merged" or there was no possible match
-            self.objects.at[i, self.mp_fld] = []
-            self.objects.at[i, self.m_fld] = False
-            self.objects.at[i, self.mc_fld] = False
-
-            # TODO: potentially check if any merge_paths exist, only merge() if yes
-            # logger.debug('Merge paths:\n'
-            #              '{}'.format(self.objects[self.objects[self.mp_fld]
-            #                          .apply(lambda x: len(x) > 0)][self.mp_fld]))
-            # self.merge()
-
-            # Recalculate merge candidates, using new (merged) values # TODO: Just test the newly created feature
-            self.find_merge_candidates(merge_candidate_rules)
-
-            # Resort by area so smallest possible merge object is checked next # TODO: Check if necessary to resort
-            logger.debug('Sorting by area, smallest first...')
-            self.objects = self.objects.sort_values(by=self.pseudo_area_fld)
-
-            logger.debug('Updating mergeable IDs...')
-            self.update_mergeable_ids(max_iter=max_iter)
+            mergeable[i] = False
+            candidate[i] = False
+        pbar.close()
+        logger.info('Pseudo-merges found: {:,}'.format(merges))
+
+        # Keep the values of objects before any pseudo-merges, for objects
+        # not already kept by an earlier call
+        if value_fields:
+            premerge = self.objects[list(value_fields)].copy()
+            if self._premerge_values is not None:
+                premerge = pd.concat([
+                    self._premerge_values,
+                    premerge[~premerge.index.isin(
+                        self._premerge_values.index)]])
+            self._premerge_values = premerge
+
+        # Write results back to objects
+        for fld, fld_vals in vals.items():
+            self.objects[fld] = fld_vals
+        self.objects[self.pseudo_area_fld] = area
+        self.objects[self.m_fld] = mergeable
+        # Objects that have been checked are no longer merge candidates,
+        # unchecked non-candidates are left null
+        self.objects[self.mc_fld] = np.where(candidate, True,
+                                             np.where(mergeable, None, False))
+        self.objects[self.m_seed_fld] = seed
+        self.objects[self.mp_fld] = [np.unique(ids[mp]).astype('i')
+                                     for mp in merge_paths]
+        self.objects[self.nebs_fld] = [np.unique(ids[list(ns)]).astype('i')
+                                       if ns is not None else np.NaN
+                                       for ns in nebs]
+        self.objects[self.continue_iter] = (merge_ct < max_iter
+                                            if max_iter else True)
+        self.update_mergeable_ids(max_iter=None)
+        # Neighbor values for grow fields, based on merged neighbors
+        for gf in grow_fields:
+            self.compute_neighbor_values(gf)
+
+        # Resort by area so smallest object is first
+        self.objects = self.objects.sort_values(by=self.pseudo_area_fld)
 
-    def merge(self):
-        # merge features that have a merge path
+    def merge(self, aggregate_values=False, tile_size=None, num_cores=None):
+        """Merge each object with the objects in its merge_path. The final
+        object of every pending merge (following merge_paths that contain
+        objects with merge_paths of their own) is resolved first, then all
+        merges are dissolved in a single grouped union. Values are taken from
+        the object merged into, which pseudo_merging has already aggregated,
+        unless aggregate_values is True, in which case value_fields are
+        aggregated in one grouped aggregation from the values the objects
+        had before pseudo_merging.
+        If tile_size is provided, the dissolve is split into tiles of
+        merges run in a process pool of num_cores."""
         logger.debug('Performing calculated merges...')
         logger.debug('Objects before merge: {:,}'.format(self.num_objs))
-        for i, r in self.objects[
-                self.objects[self.mp_fld].map(lambda d: len(d)) > 0].iterrows():
-            logger.debug('Merging: {} into {}'.format(r[self.mp_fld], i))
-            # Create gdf of current row and the features to merge with it.
-            # Important that the current row is first, as it contains the
-            # correct aggregated values and the dissolve function defaults
-            # to keeping the first rows values
-            to_merge = pd.concat([gpd.GeoDataFrame([r], crs=self.objects.crs),
-                                  self.objects[self.objects.index
-                                 .isin(r[self.mp_fld])]])
-            to_merge['temp'] = 1
-            merged = to_merge[['geometry', 'temp']].dissolve(by='temp')
-            merged.index = [i]
-
-            # Add columns from current row back in (should be aggregated
-            # already
-            merged = pd.merge(merged,
-                              gpd.GeoDataFrame([r]).drop(columns='geometry'),
-                              left_index=True,
-                              right_index=True)
-
-            # Zero out merge_path
-            merged[self.mp_fld] = [[]]
-
-            # Add to merge count
-            merged[self.m_ct_fld] = merged[self.m_ct_fld] + \
-                                    len(r[self.mp_fld])
-
-            # Drop both original objects
-            self.objects.drop(np.concatenate([r[self.mp_fld], [i]]),
-                                             inplace=True)
-            # Add merged object back in
-            # self.objects = pd.concat([self.objects, merged])
-            self.objects = self.objects.append(merged)
-
-            # Replace merge field vlaues
-            for m in r[self.mp_fld]:
-                self.replace_neighbor(m, i, update_merges=True)
+        has_mp = self.objects[self.mp_fld].map(lambda d: len(d)) > 0
+        if not has_mp.any():
+            return
+
+        # Resolve the object each object is finally merged into
+        ids = self.objects.index
+        id_pos = {oid: pos for pos, oid in enumerate(ids)}
+        merged_into = UnionFind(len(ids))
+        for i, mp in self.objects.loc[has_mp, self.mp_fld].items():
+            for m in mp:
+                if m in id_pos:
+                    merged_into.union(id_pos[m], into=id_pos[i])
+        roots = np.array([merged_into.find(pos) for pos in range(len(ids))])
+        in_group = pd.Series(roots).duplicated(keep=False).values
+        to_merge = self.objects[in_group]
+        group = ids[roots[in_group]]
+        logger.debug('Merging {:,} objects into {:,}'.format(
+            len(to_merge), len(np.unique(group))))
+
+        # Dissolve all merges at once
+        merge_grp = 'merge_group'
+        if tile_size:
+            merged = gpd.GeoDataFrame(
+                geometry=tiled_dissolve(to_merge.geometry, group,
+                                        tile_size=tile_size,
+                                        num_cores=num_cores),
+                crs=self.objects.crs)
+        else:
+            merged = gpd.GeoDataFrame({merge_grp: group},
+                                      geometry=to_merge.geometry.values,
+                                      crs=self.objects.crs)\
+                .dissolve(by=merge_grp)
+
+        # Add columns from object merged into back in
+        merged = pd.merge(merged,
+                          self.objects.loc[merged.index]
+                          .drop(columns=self.objects.geometry.name),
+                          left_index=True,
+                          right_index=True)
+        merged.index.name = self.objects.index.name
+        if aggregate_values and self.value_fields:
+            areas = to_merge.geometry.area
+            premerge = self._premerge_values
+            known = (to_merge.index.isin(premerge.index)
+                     if premerge is not None else
+                     np.zeros(len(to_merge), dtype=bool))
+            for vf, agg_type in self.value_fields.items():
+                values = to_merge[vf].to_numpy(copy=True)
+                values[known] = premerge.loc[to_merge.index[known], vf]
+                merged[vf] = aggregate_groups(agg_type, values, areas,
+                                              group)
+
+        # Zero out merge_path
+        merged[self.mp_fld] = [[] for _ in range(len(merged))]
+
+        # Add to merge count
+        group_size = pd.Series(group).value_counts()
+        merged[self.m_ct_fld] = merged[self.m_ct_fld] + \
+                                (group_size.loc[merged.index].values - 1)
+
+        # Replace original objects with merged objects
+        self.objects = pd.concat([self.objects[~in_group],
+                                  merged[self.objects.columns]])
+        self._invalidate_known_neighbors(to_merge.index.to_numpy(dtype='i'))
+        # Merged objects are the originals for any later pseudo_merging
+        self._premerge_values = None
+
+        # Replace merged objects with the object they were merged into in
+        # all neighbor lists
+        replace = dict(zip(to_merge.index, group))
+        self.objects[self.nebs_fld] = [
+            ns if not isinstance(ns, np.ndarray)
+            else np.setdiff1d(np.unique([replace.get(n, n) for n in ns]),
+                              [i]).astype('i')
+            for i, ns in self.objects[self.nebs_fld].items()]
+        logger.debug('Objects after merge: {:,}'.format(self.num_objs))
 
     # def determine_adj_thresh(self, neb_values_fld, value_thresh, value_op, out_field, subset=None):
     #     """Determines if each row is has neighbor that meets the value
@@ -865,52 +1095,97 @@ class ImageObjects:
     #                                for v in x.values())))
 
     def best_adjacent_to(self, in_field, op):
-        best_fxn_lut = {
-            operator.lt: min,
-            operator.le: min,
-            operator.gt: max,
-            operator.ge: max
+        """Get tuple of (ID, value) of the "best" neighbor of each object,
+        the neighbor with the lowest value in in_field for operator.lt/le,
+        or the highest for operator.gt/ge. Objects without neighbors
+        computed are NaN."""
+        best_lowest_lut = {
+            operator.lt: True,
+            operator.le: True,
+            operator.gt: False,
+            operator.ge: False
         }
-        best_fxn = best_fxn_lut[op]
+        lowest = best_lowest_lut[op]
 
         logger.debug('Finding adjacent features with values in {}...'.format(in_field))
-        # Create neighbor-value field(s) if necessary
-        in_field_nv = self._nv_field_name(in_field)
-        if in_field_nv not in self.fields:
-            self.compute_neighbor_values(in_field)
-
-        # Get tuple of (ID, value) of "best" neighbor
-        best_series = self.objects[in_field_nv].apply(
-            lambda nv: best_fxn(nv.items(), key=operator.itemgetter(1))
-            if pd.notnull(nv) else nv)
+        self.compute_neighbor_values(in_field)
+        adj, has_nebs, nv = self.neighbor_values(in_field)
+        rows = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+        neb_ids = self.objects.index.to_numpy()[adj.indices]
+        nv = nv.astype(float)
+
+        # Sort edges by object, then value (NaN last), then neighbor ID and
+        # take the first edge of each object
+        order = np.lexsort((neb_ids, nv if lowest else -nv, rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = rows[order][1:] != rows[order][:-1]
+        best = order[first]
+
+        best_series = pd.Series(np.NaN, index=self.objects.index, dtype=object)
+        best_series.iloc[rows[best]] = list(zip(neb_ids[best], nv[best]))
 
         return best_series
 
+    def adjacency_matrix(self, subset=None, compute_neighbors=True):
+        """
+        Sparse adjacency matrix of subset (rows) to all objects (columns, in
+        the order of self.objects), built from the neighbors field.
+
+        Returns
+        -------
+        tuple : (scipy.sparse.csr_matrix, np.array) the adjacency matrix and
+            a boolean array indicating which rows have neighbors computed
+        """
+        if subset is None:
+            subset = self.objects
+        if compute_neighbors:
+            missing = subset[~subset[self.nebs_fld].apply(
+                lambda x: isinstance(x, np.ndarray))]
+            if len(missing) > 0:
+                self.get_neighbors(missing)
+        neighbors = self.objects.loc[subset.index, self.nebs_fld]
+        has_nebs = neighbors.apply(
+            lambda x: isinstance(x, np.ndarray)).to_numpy(dtype=bool)
+        neighbors = [ns if isinstance(ns, np.ndarray) else np.array([], dtype='i')
+                     for ns in neighbors]
+        rows = np.repeat(np.arange(len(neighbors)),
+                         [len(ns) for ns in neighbors])
+        cols = self.objects.index.get_indexer(
+            np.concatenate(neighbors) if neighbors else [])
+        adj = pairs_to_csr(rows[cols != -1], cols[cols != -1],
+                           shape=(len(subset), self.num_objs))
+
+        return adj, has_nebs
+
     def adjacent_to(self, in_field, op, threshold,
                     src_field=None, src_op=None, src_thresh=None,
                     out_field=None,
-                    compute_neighbors=True):
+                    compute_neighbors=True,
+                    subset=None,
+                    adjacency=None):
+        """Determine if each object has any neighbor where op(in_field,
+        threshold) is True, as a sparse adjacency matrix product with the
+        boolean mask of objects meeting the threshold. Only objects in subset
+        are tested (all if None), objects without neighbors computed are
+        NaN. A precomputed adjacency_matrix(subset) can be passed to reuse it
+        across rules."""
         logger.debug('Finding adjacent features with values...')
-
-        # # Create neighbor-value field(s) if necessary
-        in_field_nv = self._nv_field_name(in_field)
-        if in_field_nv not in self.fields:
-            self.compute_neighbor_values(in_field,
-                                         compute_neighbors=compute_neighbors)
-
+        if subset is None:
+            subset = self.objects
+        if adjacency is None:
+            adjacency = self.adjacency_matrix(
+                subset, compute_neighbors=compute_neighbors)
+        adj, has_nebs = adjacency
+
+        meets = op(self.objects[in_field], threshold).to_numpy(dtype=bool)
+        is_adj = adj.dot(meets.astype(np.int32)) > 0
+        adj_series = (pd.Series(is_adj, index=subset.index)
+                      .where(has_nebs)
+                      .reindex(self.objects.index))
         if src_field:
-            adj_series = (
-                # src object threshold
-                (src_op(self.objects[src_field], src_thresh)) &
-                # True if any neighbor has value that meets op(nv, threshold)
-                (self.objects[in_field_nv].apply(
-                    lambda nv: any([op(v, threshold) for k, v in nv.items()])
-                    if pd.notnull(nv) else nv))
-                )
-        else:
-            adj_series = (self.objects[in_field_nv].apply(
-                lambda nv: any([op(v, threshold) for k, v in nv.items()])
-                if pd.notnull(nv) else nv))
+            # src object threshold
+            adj_series = (src_op(self.objects[src_field], src_thresh) &
+                          adj_series)
 
         if out_field:
             self.objects[out_field] = adj_series
@@ -927,19 +1202,25 @@ class ImageObjects:
             if lc in self.fields:
                 to_str_cols.append(lc)
 
-        to_str_cols.extend([nvf for vf, nvf in self.nv_fields])
+        # Gather neighbor values to write as lists
+        objects = copy.copy(self.objects)
+        for vf, nvf in self.nv_fields:
+            adj, has_nebs, nv = self.neighbor_values(vf)
+            objects[nvf] = [list(nv[adj.indptr[i]:adj.indptr[i + 1]])
+                            for i in range(adj.shape[0])]
+            to_str_cols.append(nvf)
 
         logger.info('Writing objects to: {}'.format(out_objects))
-        if self.objects.index.name in self.fields:
-            self.objects.index.name = self.objects.index.name + \
-                                      str(np.random.randint(0, 100))
-        write_gdf(self.objects.reset_index(), out_objects,
+        if objects.index.name in self.fields:
+            objects.index.name = objects.index.name + \
+                                 str(np.random.randint(0, 100))
+        write_gdf(objects.reset_index(), out_objects,
                   to_str_cols=to_str_cols,
                   overwrite=overwrite,
                   **kwargs)
 
     def apply_single_rule(self, rule_type, in_field, op, threshold,
-                          out_field=None, **kwargs):
+                          out_field=None, subset=None, **kwargs):
         """
         Apply rule to objects, returning boolean series indicating if each
         object meets the rule.
@@ -956,6 +1237,9 @@ class ImageObjects:
             The value to compare in_field to using op.
         out_field : str
             The field to store the boolean results of the rule in.
+        subset : gpd.GeoDataFrame
+            Subset of self.objects to evaluate adjacency rules for, other
+            objects are NaN.
         **kwargs : dict
             Keyword arguments to pass through to sub functions
             For rule_type == 'adjacent', these can be
@@ -965,7 +1249,7 @@ class ImageObjects:
         """
         # Ensure rule type is supported
         type_threshold = 'threshold'
-        type_adjacent = 'adjacent',
+        type_adjacent = 'adjacent'
         type_adj_or = 'adjacent_or_is'
         accepted_rule_types = [type_threshold, type_adjacent, type_adj_or]
         if rule_type not in accepted_rule_types:
@@ -980,11 +1264,13 @@ class ImageObjects:
             results = self.adjacent_to(in_field=in_field,
                                        op=op,
                                        threshold=threshold,
+                                       subset=subset,
                                        **kwargs)
         elif rule_type == type_adj_or:
             adj_results = self.adjacent_to(in_field=in_field,
                                            op=op,
                                            threshold=threshold,
+                                           subset=subset,
                                            **kwargs)
             is_results = op(self.objects[in_field], threshold)
             results = adj_results | is_results
@@ -996,7 +1282,7 @@ class ImageObjects:
 
         return results
 
-    def apply_rules(self, rules, out_field=None):
+    def apply_rules(self, rules, out_field=None, subset=None):
         """
         Apply a number of rules to objects.
 
@@ -1004,21 +1290,29 @@ class ImageObjects:
         ----------
         rules : list
             List of dictionaries of keyword arguments to single_rule
+        subset : gpd.GeoDataFrame
+            Subset of self.objects to evaluate adjacency rules for. The
+            adjacency matrix of the subset is built once and shared by all
+            adjacency rules.
 
         Returns
         ---------
         pd.series : Boolean series indicating if all rules met
         """
-        # Get and store boolean Series for each rule
-        all_results = []
+        adjacency = None
+        if any(r['rule_type'] != 'threshold' for r in rules):
+            adjacency = self.adjacency_matrix(subset)
+
+        # Combine the boolean array for each rule
+        # FIXME: NaNs (neighbors not computed) are treated as True
+        results = np.ones(self.num_objs, dtype=bool)
         for r in rules:
+            if r['rule_type'] != 'threshold':
+                r = dict(r, subset=subset, adjacency=adjacency)
             sr = self.apply_single_rule(**r)
-            all_results.append(sr)
-
-        # Get single series indicating if True across all result rows
-        # FIXME: row of NaNs being returned as True
-        results = pd.DataFrame(all_results).transpose().apply(
-            lambda row: all([v for v in row]), axis=1)
+            results &= sr.reindex(self.objects.index).fillna(True)\
+                .to_numpy(dtype=bool)
+        results = pd.Series(results, index=self.objects.index)
 
         if out_field:
             self.objects[out_field] = results
@@ -1029,13 +1323,29 @@ class ImageObjects:
                          class_fld=None,
                          threshold_rules=None,
                          adj_rules=None,
-                         overwrite_class=False):
+                         overwrite_class=False,
+                         tile_size=None,
+                         halo=0,
+                         num_cores=None):
         """Classify objects according to rules passed. The class_name will
         be placed in the 'class' field of objects. If overwrite_class is
         False, any existing values in the 'class' field will be maintained
-        and only objects with a Null class will be classified."""
-        # TODO: optimize so that only unclassified objects have the other
-        #  rules applied, as adjacency rules can take a while
+        and only objects with a Null class will be classified.
+        Threshold rules are evaluated over whole columns, adjacency rules
+        only for the objects that could still be classified: those meeting
+        all threshold rules (and unclassified, if not overwrite_class).
+        If tile_size is provided, objects are classified in tiles in a
+        process pool of num_cores, see tiling.tiled_classify."""
+        if tile_size:
+            tiled_classify(self, tile_size=tile_size, halo=halo,
+                           num_cores=num_cores,
+                           class_name=class_name,
+                           class_fld=class_fld,
+                           threshold_rules=threshold_rules,
+                           adj_rules=adj_rules,
+                           overwrite_class=overwrite_class)
+            return
+
         # Create class field if it doesn't exist
         if class_fld is None:
             class_fld = self.class_fld
@@ -1043,31 +1353,18 @@ class ImageObjects:
         if class_fld not in self.fields:
             self.objects[class_fld] = None
 
-        # Get boolean series for each rule
-        all_results = []
+        # Objects that can be classified
+        if overwrite_class:
+            update_rows = pd.Series(True, index=self.objects.index)
+        else:
+            update_rows = self.objects[class_fld].isnull()
         if threshold_rules:
-            thresholds_results = self.apply_rules(threshold_rules)
-            all_results.append(thresholds_results)
+            update_rows &= self.apply_rules(threshold_rules)
         if adj_rules:
-            if threshold_rules:
-                self.get_neighbors(subset=self.objects.loc[thresholds_results])
-            for r in adj_rules:
-                self.compute_neighbor_values(r[self._rule_fld_name])
-            adj_results = self.apply_rules(adj_rules)
-            all_results.append(adj_results)
-
-        update_rows = pd.DataFrame(all_results).transpose().apply(
-            lambda row: all([v for v in row]), axis=1)
+            subset = self.objects[update_rows]
+            update_rows &= self.apply_rules(adj_rules, subset=subset)
 
         # Add class name to rows that meet criteria
-        if overwrite_class:
-            # Update all rows that meet rules
-            logger.debug("Classifying {:,} objects as {}={}".format(
-                len(self.objects.loc[update_rows, class_fld]), class_fld, class_name))
-            self.objects.loc[update_rows, class_fld] = class_name
-        else:
-            # Update only rows that meet rules AND are not classified
-            logger.info("Classifying {:,} objects as {}={}".format(
-                len(self.objects.loc[update_rows, class_fld]), class_fld, class_name))
-            self.objects.loc[update_rows & self.objects[class_fld].isnull(),
-                             class_fld] = class_name
+        logger.info("Classifying {:,} objects as {}={}".format(
+            update_rows.sum(), class_fld, class_name))
+        self.objects.loc[update_rows, class_fld] = class_name
@@ -0,0 +1,339 @@
+"""
+Helpers for building object adjacency (neighbor) graphs as sparse
+matrices, rather than testing spatial predicates object by object.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio as rio
+from rasterio.windows import Window
+from scipy.sparse import csr_matrix
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'DEBUG')
+
+# Bulk spatial index queries: geopandas >= 0.12 accepts arrays in
+# sindex.query, 0.8 - 0.11 provide sindex.query_bulk, older versions
+# fall back to per-geometry rtree bounding box queries.
+_GPD_VERSION = tuple(int(v) for v in gpd.__version__.split('.')[:2]
+                     if v.isdigit())
+
+
+def query_pairs(tree_geoms, query_geoms, predicate='intersects'):
+    """
+    Query the spatial index of tree_geoms with all query_geoms at once,
+    returning positional index pairs where predicate(query, tree) is True.
+
+    Parameters
+    ----------
+    tree_geoms : gpd.GeoSeries
+        Geometries to build the spatial index (STRtree) on.
+    query_geoms : gpd.GeoSeries
+        Geometries to query the index with.
+    predicate : str
+        Spatial predicate, e.g. 'touches', 'intersects', 'contains'.
+
+    Returns
+    -------
+    tuple : (np.array, np.array) of positions in query_geoms and positions
+        in tree_geoms
+    """
+    sindex = tree_geoms.sindex
+    if _GPD_VERSION >= (0, 12):
+        query_idx, tree_idx = sindex.query(query_geoms.values,
+                                           predicate=predicate)
+    elif hasattr(sindex, 'query_bulk'):
+        query_idx, tree_idx = sindex.query_bulk(query_geoms.values,
+                                                predicate=predicate)
+    else:
+        query_idx, tree_idx = rtree_query_pairs(tree_geoms, query_geoms,
+                                                predicate=predicate)
+
+    return np.asarray(query_idx), np.asarray(tree_idx)
+
+
+def rtree_query_pairs(tree_geoms, query_geoms, predicate='intersects'):
+    """
+    query_pairs for rtree backed spatial indexes, which only support
+    bounding box queries: bounding box candidates from the index, then
+    predicate(query, candidate) for each candidate.
+    """
+    sindex = tree_geoms.sindex
+    tree_values = tree_geoms.values
+    query_idx, tree_idx = [], []
+    for qi, geom in enumerate(query_geoms.values):
+        candidates = np.fromiter(sindex.intersection(geom.bounds),
+                                 dtype=np.int64)
+        if candidates.size == 0:
+            continue
+        met = np.array([getattr(geom, predicate)(tree_values[c])
+                        for c in candidates], dtype=bool)
+        tree_idx.append(candidates[met])
+        query_idx.append(np.full(met.sum(), qi, dtype=np.int64))
+    if query_idx:
+        query_idx = np.concatenate(query_idx)
+        tree_idx = np.concatenate(tree_idx)
+    else:
+        query_idx = np.array([], dtype=np.int64)
+        tree_idx = np.array([], dtype=np.int64)
+
+    return query_idx, tree_idx
+
+
+def pairs_to_csr(row_idx, col_idx, shape):
+    """
+    Convert positional index pairs to a boolean CSR adjacency matrix,
+    with duplicate pairs collapsed and column indices sorted per row.
+    """
+    adj = csr_matrix((np.ones(len(row_idx), dtype=bool),
+                      (row_idx, col_idx)),
+                     shape=shape)
+    adj.sum_duplicates()
+    adj.sort_indices()
+
+    return adj
+
+
+def csr_row(adj, row):
+    """Column positions of the non-zero entries in row of a CSR matrix."""
+    return adj.indices[adj.indptr[row]:adj.indptr[row + 1]]
+
+
+def touches_adjacency(tree_geoms, query_geoms=None):
+    """
+    Sparse adjacency between query_geoms (rows) and tree_geoms (columns),
+    where True indicates the geometries touch. If query_geoms is None,
+    the symmetric adjacency of tree_geoms with itself is returned.
+    """
+    if query_geoms is None:
+        query_geoms = tree_geoms
+    query_idx, tree_idx = query_pairs(tree_geoms, query_geoms,
+                                      predicate='touches')
+    logger.debug('Touching pairs found: {:,}'.format(len(query_idx)))
+
+    return pairs_to_csr(query_idx, tree_idx,
+                        shape=(len(query_geoms), len(tree_geoms)))
+
+
+def shifted_views(labels, row_shift, col_shift):
+    """Views of labels and labels shifted by (row_shift, col_shift), aligned
+    so that a[r, c] and b[r, c] are neighboring pixels."""
+    h, w = labels.shape
+    if col_shift >= 0:
+        a = labels[:h - row_shift, :w - col_shift]
+        b = labels[row_shift:, col_shift:]
+    else:
+        a = labels[:h - row_shift, -col_shift:]
+        b = labels[row_shift:, :w + col_shift]
+
+    return a, b
+
+
+def label_adjacency_pairs(labels, nodata=None, connectivity=8):
+    """
+    Find all pairs of different labels that share a pixel edge (or corner,
+    if connectivity is 8) by comparing the label array with shifted copies
+    of itself.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        2D array of segment labels.
+    nodata : int
+        Label value to ignore, e.g. background.
+    connectivity : int
+        4 for edge neighbors only, 8 to include diagonal (corner) neighbors,
+        which matches vector 'touches' between the polygonized segments.
+
+    Returns
+    -------
+    np.ndarray : (n, 2) array of unique label pairs, lower label first
+    """
+    shifts = [(0, 1), (1, 0)]
+    if connectivity == 8:
+        shifts.extend([(1, 1), (1, -1)])
+    elif connectivity != 4:
+        logger.error('Unsupported connectivity: {}, must be 4 or '
+                     '8.'.format(connectivity))
+        raise ValueError
+
+    pairs = []
+    for row_shift, col_shift in shifts:
+        a, b = shifted_views(labels, row_shift, col_shift)
+        boundary = a != b
+        if nodata is not None:
+            boundary &= (a != nodata) & (b != nodata)
+        a = a[boundary]
+        b = b[boundary]
+        pairs.append(np.stack([np.minimum(a, b), np.maximum(a, b)], axis=1))
+    pairs = np.concatenate(pairs)
+
+    return np.unique(pairs, axis=0)
+
+
+def raster_label_pairs(label_raster, band=1, nodata=None, connectivity=8,
+                       rows_per_strip=1024):
+    """
+    Adjacent label pairs from a segmentation label raster, read in strips
+    of rows (overlapping by one row) to bound memory use. If nodata is
+    None, the raster's nodata value is ignored.
+    """
+    logger.info('Finding adjacent labels in: {}'.format(label_raster))
+    pairs = []
+    with rio.open(label_raster) as src:
+        if nodata is None:
+            nodata = src.nodata
+        prev_row = None
+        for row_off in range(0, src.height, rows_per_strip):
+            window = Window(0, row_off, src.width,
+                            min(rows_per_strip, src.height - row_off))
+            arr = src.read(band, window=window)
+            if prev_row is not None:
+                arr = np.vstack([prev_row, arr])
+            pairs.append(label_adjacency_pairs(arr, nodata=nodata,
+                                               connectivity=connectivity))
+            prev_row = arr[-1:]
+    pairs = np.unique(np.concatenate(pairs), axis=0)
+    logger.debug('Adjacent label pairs found: {:,}'.format(len(pairs)))
+
+    return pairs
+
+
+def label_pairs_to_neighbors(pairs, object_labels):
+    """
+    Convert adjacent label pairs to lists of neighboring object IDs.
+
+    Parameters
+    ----------
+    pairs : np.ndarray
+        (n, 2) array of adjacent labels, from raster_label_pairs.
+    object_labels : pd.Series
+        Label of each object, indexed by object ID.
+
+    Returns
+    -------
+    pd.Series : Sorted array of neighbor IDs, indexed by object ID. Objects
+        whose neighbors cannot be resolved from labels alone (labels shared
+        by more than one object, or adjacent to such a label) are omitted.
+    """
+    ambiguous = object_labels.value_counts()
+    ambiguous = ambiguous[ambiguous > 1].index
+    unique_labels = object_labels[~object_labels.isin(ambiguous)]
+    # Position of each object in unique_labels, looked up by label
+    label_pos = pd.Series(np.arange(len(unique_labels)),
+                          index=unique_labels.values)
+
+    a = pd.Series(pairs[:, 0])
+    b = pd.Series(pairs[:, 1])
+    a_known = a.isin(label_pos.index).values
+    b_known = b.isin(label_pos.index).values
+    # Objects next to an ambiguous label cannot be resolved
+    unresolved = np.unique(np.concatenate([
+        a[a_known & b.isin(ambiguous).values].values,
+        b[b_known & a.isin(ambiguous).values].values]))
+
+    resolved = a_known & b_known
+    a_pos = label_pos.loc[a[resolved]].values
+    b_pos = label_pos.loc[b[resolved]].values
+    adj = pairs_to_csr(np.concatenate([a_pos, b_pos]),
+                       np.concatenate([b_pos, a_pos]),
+                       shape=(len(unique_labels), len(unique_labels)))
+
+    object_ids = unique_labels.index.to_numpy(dtype='i')
+    neighbors = pd.Series([np.unique(object_ids[csr_row(adj, pos)])
+                           for pos in range(len(object_ids))],
+                          index=unique_labels.index,
+                          dtype=object)
+    neighbors = neighbors[~unique_labels.isin(unresolved).values]
+    if len(neighbors) != len(object_labels):
+        logger.warning('Neighbors for {:,} objects could not be determined '
+                       'from labels.'.format(len(object_labels) -
+                                             len(neighbors)))
+
+    return neighbors
+
+
+def geometry_hash(geoms):
+    """
+    Content hash of geoms and their index, used to key cached adjacency
+    to the exact geometries it was computed from.
+    """
+    h = hashlib.sha1()
+    h.update(np.asarray(geoms.index).astype(np.int64).tobytes())
+    for g in geoms.values:
+        h.update(g.wkb if g is not None else b'')
+
+    return h.hexdigest()
+
+
+def save_neighbors(path, neighbors, key):
+    """
+    Save neighbors to an array file (.npz) at path, keyed by key.
+
+    Parameters
+    ----------
+    path : str
+    neighbors : pd.Series
+        Array of neighbor IDs for each object, indexed by object ID.
+    key : str
+        Hash of the geometries the neighbors were computed from, see
+        geometry_hash.
+    """
+    counts = np.array([len(ns) for ns in neighbors.values], dtype=np.int64)
+    flat = (np.concatenate(neighbors.values).astype(np.int64)
+            if len(neighbors) else np.array([], dtype=np.int64))
+    np.savez(path, key=np.array(key),
+             ids=np.asarray(neighbors.index, dtype=np.int64),
+             counts=counts, neighbors=flat)
+    logger.debug('Neighbors saved to: {}'.format(path))
+
+
+def load_neighbors(path, key):
+    """
+    Load neighbors saved by save_neighbors, if path exists and was saved
+    with the same key. Returns None otherwise.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        if str(cached['key']) != key:
+            logger.info('Cached neighbors are for different geometries, '
+                        'recomputing: {}'.format(path))
+            return None
+        splits = np.cumsum(cached['counts'])[:-1]
+        neighbors = pd.Series(np.split(cached['neighbors'].astype('i'),
+                                       splits)[:len(cached['ids'])],
+                              index=cached['ids'],
+                              dtype=object)
+    logger.info('Loaded cached neighbors: {}'.format(path))
+
+    return neighbors
+
+
+class UnionFind:
+    """
+    Disjoint set of n elements (positions), used to resolve objects that
+    have been merged to the object they were merged into.
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, into):
+        """Merge the set containing x into the set containing into,
+        returning the root of the combined set."""
+        root = self.find(into)
+        self.parent[self.find(x)] = root
+        return root
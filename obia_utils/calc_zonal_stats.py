@@ -5,6 +5,7 @@ Created on Tue Feb 18 14:00:03 2020
 @author: disbr007
 """
 import argparse
+import hashlib
 import json
 import logging.config
 import os
@@ -14,23 +15,35 @@ import sys
 
 import pandas as pd
 import geopandas as gpd
+import shapely
 # import fiona
-# import rasterio
+import rasterio as rio
+from rasterio.features import rasterize
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
 from rasterstats import zonal_stats
-from skimage.feature import greycomatrix, greycoprops
+from shapely.geometry import box
 
 from misc_utils.logging_utils import create_logger
 from misc_utils.gdal_tools import auto_detect_ogr_driver
 from misc_utils.gpd_utils import read_vec, write_gdf
+from obia_utils.adjacency import query_pairs, shifted_views, geometry_hash
+from obia_utils.tiling import tile_keys, run_parallel
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
-# custom_stat_fxn = {
-#     'glcm': calc_glcm
-# }
-
-# def calc_glcm(patch, distance = [5], angles=[0], levels=)
+# Shape metrics computed by shape_metrics
+SHAPE_METRICS = ['compactness', 'roundness', 'elongation', 'convexity',
+                 'rectangularity', 'mrr_aspect']
+# GLCM texture properties, requested as stats named glcm_<prop>
+GLCM_PROPS = ['contrast', 'dissimilarity', 'homogeneity', 'ASM', 'energy',
+              'entropy', 'correlation']
+# Gray levels images are quantized to for GLCMs
+GLCM_LEVELS = 32
+# (row, col) offsets of co-occurring pixels: distance 1 at 0, 45, 90 and
+# 135 degrees
+GLCM_OFFSETS = [(0, 1), (1, 1), (1, 0), (1, -1)]
 
 def load_stats_dict(stats_json):
     if isinstance(stats_json, str):
@@ -65,7 +78,8 @@ def calc_compactness(geometry):
 
 
 def apply_compactness(gdf, out_field='compactness'):
-    gdf[out_field] = gdf.geometry.apply(lambda x: calc_compactness(x))
+    gdf[out_field] = shape_metrics(gdf.geometry, ['compactness'])\
+        ['compactness']
     return gdf
 
 
@@ -76,18 +90,656 @@ def calc_roundness(geometry):
 
 
 def apply_roundness(gdf, out_field='roundness'):
-    gdf[out_field] = gdf.geometry.apply(lambda x: calc_roundness(x))
+    gdf[out_field] = shape_metrics(gdf.geometry, ['roundness'])['roundness']
     return gdf
 
 
+def _minimum_rotated_rectangles(geoms):
+    """Minimum rotated rectangle of each geometry, with the array
+    function of shapely >= 2 when available."""
+    if hasattr(shapely, 'oriented_envelope'):
+        return gpd.GeoSeries(shapely.oriented_envelope(geoms.values),
+                             index=geoms.index)
+    return geoms.apply(lambda x: x.minimum_rotated_rectangle)
+
+
+def _rectangle_sides(rects):
+    """Lengths of the long and short sides of rectangles, NaN for
+    degenerate (line or point) rectangles."""
+    if hasattr(shapely, 'get_coordinates'):
+        is_rect = (rects.geom_type == 'Polygon').values & \
+            (shapely.get_num_coordinates(rects.values) == 5)
+        coords = shapely.get_coordinates(
+            shapely.get_exterior_ring(rects.values[is_rect])).reshape(-1, 5, 2)
+    else:
+        is_rect = rects.apply(lambda x: x.geom_type == 'Polygon' and
+                              len(x.exterior.coords) == 5).values
+        coords = np.array([np.asarray(x.exterior.coords)
+                           for x in rects.values[is_rect]]).reshape(-1, 5, 2)
+    side_a = np.full(len(rects), np.nan)
+    side_b = np.full(len(rects), np.nan)
+    side_a[is_rect] = np.hypot(*(coords[:, 1] - coords[:, 0]).T)
+    side_b[is_rect] = np.hypot(*(coords[:, 2] - coords[:, 1]).T)
+
+    return np.fmax(side_a, side_b), np.fmin(side_a, side_b)
+
+
+def shape_metrics(geoms, metrics=None):
+    """
+    Compute shape metrics of polygons with array operations over the
+    whole GeoSeries.
+
+    Metrics:
+        compactness : Polsby-Popper score, 4 * pi * area / perimeter^2,
+            1 = circle
+        roundness : perimeter^2 / (4 * pi * area), the inverse of
+            compactness
+        elongation : length / width of the rectangle with the same area
+            and perimeter as the polygon, 1 = square or circle
+        convexity : convex hull perimeter / perimeter, 1 = convex
+        rectangularity : area / minimum rotated rectangle area,
+            1 = rectangle
+        mrr_aspect : long side / short side of the minimum rotated
+            rectangle
+
+    Parameters
+    ----------
+    geoms : gpd.GeoSeries
+    metrics : list
+        Metrics to compute, default is all of SHAPE_METRICS.
+
+    Returns
+    -------
+    pd.DataFrame : One column per metric, indexed as geoms.
+    """
+    if metrics is None:
+        metrics = SHAPE_METRICS
+    for m in metrics:
+        if m not in SHAPE_METRICS:
+            logger.error('Unknown shape metric: {}'.format(m))
+            raise KeyError
+
+    area = geoms.area.values
+    perimeter = geoms.length.values
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if 'compactness' in metrics:
+            results['compactness'] = np.pi * 4 * area / perimeter ** 2
+        if 'roundness' in metrics:
+            results['roundness'] = perimeter ** 2 / (4 * np.pi * area)
+        if 'elongation' in metrics:
+            # Sides of the rectangle with the same area and perimeter:
+            # roots of x^2 - (perimeter / 2) x + area. Shapes more compact
+            # than a square (no real roots) have elongation 1.
+            half_p = perimeter / 2
+            disc = np.sqrt(np.maximum(half_p ** 2 - 4 * area, 0))
+            results['elongation'] = (half_p + disc) / (half_p - disc)
+        if 'convexity' in metrics:
+            results['convexity'] = geoms.convex_hull.length.values / perimeter
+        if {'rectangularity', 'mrr_aspect'} & set(metrics):
+            rects = _minimum_rotated_rectangles(geoms)
+            if 'rectangularity' in metrics:
+                results['rectangularity'] = area / rects.area.values
+            if 'mrr_aspect' in metrics:
+                long_side, short_side = _rectangle_sides(rects)
+                results['mrr_aspect'] = long_side / short_side
+
+    return pd.DataFrame({m: results[m] for m in metrics}, index=geoms.index)
+
+
+# Stats computed by label_zonal_stats, other stats (and custom stat
+# functions) are computed with rasterstats
+LABEL_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median',
+               'majority', 'minority', 'unique', 'range']
+
+
+# Stats stream_label_stats computes, medians and percentiles approximately
+STREAM_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median',
+                'range']
+
+
+def _label_stat_supported(stat):
+    return stat in LABEL_STATS or stat.startswith('percentile_') or \
+        _is_glcm_stat(stat)
+
+
+def _is_glcm_stat(stat):
+    return stat.startswith('glcm_') and stat[len('glcm_'):] in GLCM_PROPS
+
+
+def _stream_stat_supported(stat):
+    return stat in STREAM_STATS or stat.startswith('percentile_')
+
+
+def grid_key(src):
+    """Key identifying the pixel grid of an open raster, rasters with the
+    same key can share a label image."""
+    return (str(src.crs), tuple(src.transform), src.width, src.height)
+
+
+def objects_window(geoms, src):
+    """Window of src covering geoms, None if they do not overlap."""
+    window = from_bounds(*geoms.total_bounds, transform=src.transform)
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    # Pad by a pixel for partial pixels lost to rounding, then clip to
+    # the raster
+    window = Window(window.col_off - 1, window.row_off - 1,
+                    window.width + 2, window.height + 2)
+    try:
+        window = window.intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        logger.warning('Objects do not overlap raster.')
+        return None
+
+    return Window(int(window.col_off), int(window.row_off),
+                  int(window.width), int(window.height))
+
+
+def rasterize_objects(geoms, src):
+    """
+    Rasterize geoms to a label image on the pixel grid of src, covering
+    only the extent of geoms. Pixels are labeled with the position of the
+    geometry (starting at 1) whose interior contains the pixel center,
+    matching the pixels rasterstats selects (all_touched=False). Objects
+    are assumed not to overlap: where they do, later geometries take the
+    pixels.
+
+    Parameters
+    ----------
+    geoms : gpd.GeoSeries
+    src : rasterio.DatasetReader
+
+    Returns
+    -------
+    tuple : (np.ndarray of labels, 0 where no object,
+             rasterio.windows.Window of src the labels cover, None if
+             geoms do not overlap src)
+    """
+    window = objects_window(geoms, src)
+    if window is None:
+        return np.zeros((0, 0), dtype='int32'), None
+
+    labels = rasterize(((g, i + 1) for i, g in enumerate(geoms.values)
+                        if g is not None and not g.is_empty),
+                       out_shape=(window.height, window.width),
+                       transform=src.window_transform(window),
+                       fill=0,
+                       dtype='int32')
+
+    return labels, window
+
+
+def label_zonal_stats(labels, values, n, stats):
+    """
+    Compute stats of values within each label with grouped array
+    reductions. Order statistics (min, max, median, percentiles,
+    majority, ...) share a single sort of the values by label.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Label of each pixel, 1 to n, 0 for no object.
+    values : np.ma.MaskedArray
+        Values of each pixel, masked where nodata.
+    n : int
+        Number of objects (labels).
+    stats : list
+        Stats to compute, from LABEL_STATS or percentile_<q>
+
+    Returns
+    -------
+    pd.DataFrame : One row per label (1 to n), one column per stat, NaN for
+        objects without any valid pixels (count is 0).
+    """
+    valid = (labels > 0) & ~np.ma.getmaskarray(values)
+    vals = np.ma.getdata(values)[valid].astype(np.float64)
+    valid_nan = ~np.isnan(vals)
+    lab = labels[valid][valid_nan] - 1
+    vals = vals[valid_nan]
+
+    count = np.bincount(lab, minlength=n)
+    has_vals = count > 0
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.bincount(lab, weights=vals, minlength=n)
+        mean = total / count
+        if 'std' in stats:
+            sq_dev = np.bincount(lab, weights=(vals - mean[lab]) ** 2,
+                                 minlength=n)
+            results['std'] = np.sqrt(sq_dev / count)
+    results['count'] = count
+    results['sum'] = np.where(has_vals, total, np.nan)
+    results['mean'] = mean
+
+    order_stats = [s for s in stats if s not in ('count', 'sum', 'mean', 'std')]
+    if order_stats:
+        order = np.lexsort((vals, lab))
+        sorted_vals = vals[order]
+        sorted_lab = lab[order]
+        start = np.searchsorted(sorted_lab, np.arange(n))
+        last = np.maximum(start + count - 1, 0)
+        empty_ok = has_vals & (len(sorted_vals) > 0)
+
+        def _at(pos):
+            if len(sorted_vals) == 0:
+                return np.full(n, np.nan)
+            return np.where(empty_ok,
+                            sorted_vals[np.minimum(pos, len(sorted_vals) - 1)],
+                            np.nan)
+
+        results['min'] = _at(start)
+        results['max'] = _at(last)
+        results['range'] = results['max'] - results['min']
+
+        def _percentile(q):
+            # Linear interpolation between closest ranks, as np.percentile
+            rank = q / 100 * np.maximum(count - 1, 0)
+            lo = np.floor(rank).astype(np.int64)
+            hi = np.ceil(rank).astype(np.int64)
+            lo_val = _at(start + lo)
+            return lo_val + (_at(start + hi) - lo_val) * (rank - lo)
+
+        for stat in order_stats:
+            if stat == 'median':
+                results[stat] = _percentile(50)
+            elif stat.startswith('percentile_'):
+                results[stat] = _percentile(float(stat.split('_')[1]))
+
+        if {'majority', 'minority', 'unique'} & set(order_stats):
+            # Runs of equal values within each label
+            run_start = np.ones(len(sorted_vals), dtype=bool)
+            run_start[1:] = ((sorted_lab[1:] != sorted_lab[:-1]) |
+                             (sorted_vals[1:] != sorted_vals[:-1]))
+            run_idx = np.flatnonzero(run_start)
+            run_lab = sorted_lab[run_idx]
+            run_val = sorted_vals[run_idx]
+            run_count = np.diff(np.append(run_idx, len(sorted_vals)))
+            results['unique'] = np.where(
+                has_vals, np.bincount(run_lab, minlength=n), np.nan)
+            for stat, sign in (('majority', -1), ('minority', 1)):
+                if stat not in order_stats:
+                    continue
+                # Most (least) common value per label, the lowest value on
+                # ties, as rasterstats
+                by_count = np.lexsort((run_val, sign * run_count, run_lab))
+                first = np.ones(len(by_count), dtype=bool)
+                first[1:] = run_lab[by_count][1:] != run_lab[by_count][:-1]
+                value = np.full(n, np.nan)
+                value[run_lab[by_count][first]] = run_val[by_count][first]
+                results[stat] = value
+
+    return pd.DataFrame({stat: results[stat] for stat in stats},
+                        index=np.arange(1, n + 1))
+
+
+def band_range(src, band=1):
+    """Minimum and maximum valid value of a band of src, read in blocks.
+    Returns (nan, nan) if there are no valid values."""
+    vmin, vmax = np.inf, -np.inf
+    for window in stream_windows(src, Window(0, 0, src.width, src.height)):
+        values = src.read(band, window=window, masked=True).astype(np.float64)
+        values = values.compressed()
+        values = values[~np.isnan(values)]
+        if values.size:
+            vmin = min(vmin, values.min())
+            vmax = max(vmax, values.max())
+    if vmin > vmax:
+        return np.nan, np.nan
+
+    return vmin, vmax
+
+
+def quantize(values, vmin, vmax, levels=GLCM_LEVELS):
+    """
+    Quantize values to integer gray levels 0 to levels - 1, evenly
+    spaced between vmin and vmax (e.g. the band_range of the raster, so
+    that levels are the same wherever the raster is read). Masked (and
+    NaN) values are -1.
+    """
+    data = np.ma.getdata(values).astype(np.float64)
+    valid = ~np.ma.getmaskarray(values) & ~np.isnan(data)
+    quantized = np.full(data.shape, -1, dtype=np.int64)
+    if not valid.any():
+        return quantized
+    scale = levels / (vmax - vmin) if vmax > vmin else 0
+    quantized[valid] = np.clip(((data[valid] - vmin) * scale)
+                               .astype(np.int64), 0, levels - 1)
+
+    return quantized
+
+
+def label_glcm_stats(labels, quantized, n, props, levels=GLCM_LEVELS,
+                     offsets=None):
+    """
+    Compute gray level co-occurrence matrix (GLCM) texture properties of
+    each label, from the pairs of pixels at each offset that are both
+    within the label. Co-occurrences of all labels are counted at once
+    as unique (label, level, level) keys, and properties are reduced per
+    label from these sparse, symmetric GLCMs. Properties are as in
+    skimage.feature.graycoprops, averaged over offsets.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Label of each pixel, 1 to n, 0 for no object.
+    quantized : np.ndarray
+        Gray level of each pixel, -1 for nodata, see quantize.
+    n : int
+        Number of objects (labels).
+    props : list
+        Properties to compute, from GLCM_PROPS
+    levels : int
+        Number of gray levels in quantized.
+    offsets : list
+        (row, col) offsets of co-occurring pixels, default GLCM_OFFSETS
+
+    Returns
+    -------
+    pd.DataFrame : One row per label (1 to n), one column per property,
+        NaN for objects without any co-occurring pixels.
+    """
+    if offsets is None:
+        offsets = GLCM_OFFSETS
+    results = {p: [] for p in props}
+    for row_shift, col_shift in offsets:
+        lab_a, lab_b = shifted_views(labels, row_shift, col_shift)
+        q_a, q_b = shifted_views(quantized, row_shift, col_shift)
+        pair = (lab_a == lab_b) & (lab_a > 0) & (q_a >= 0) & (q_b >= 0)
+        lab = lab_a[pair].astype(np.int64) - 1
+        # Symmetric: count each pair in both directions
+        keys = np.concatenate([(lab * levels + q_a[pair]) * levels + q_b[pair],
+                               (lab * levels + q_b[pair]) * levels + q_a[pair]])
+        keys, counts = np.unique(keys, return_counts=True)
+        e_lab = keys // (levels * levels)
+        i = (keys // levels) % levels
+        j = keys % levels
+
+        total = np.bincount(e_lab, weights=counts, minlength=n)
+        has_pairs = total > 0
+        prob = counts / total[e_lab]
+
+        def _sum(weights):
+            return np.where(has_pairs,
+                            np.bincount(e_lab, weights=weights, minlength=n),
+                            np.nan)
+
+        for p in props:
+            if p == 'contrast':
+                value = _sum(prob * (i - j) ** 2)
+            elif p == 'dissimilarity':
+                value = _sum(prob * np.abs(i - j))
+            elif p == 'homogeneity':
+                value = _sum(prob / (1. + (i - j) ** 2))
+            elif p == 'ASM':
+                value = _sum(prob ** 2)
+            elif p == 'energy':
+                value = np.sqrt(_sum(prob ** 2))
+            elif p == 'entropy':
+                value = _sum(-prob * np.log(prob))
+            elif p == 'correlation':
+                mean_i = _sum(prob * i)
+                mean_j = _sum(prob * j)
+                diff_i = i - mean_i[e_lab]
+                diff_j = j - mean_j[e_lab]
+                std_i = np.sqrt(_sum(prob * diff_i ** 2))
+                std_j = np.sqrt(_sum(prob * diff_j ** 2))
+                cov = _sum(prob * diff_i * diff_j)
+                # Uniform objects are perfectly correlated, as skimage
+                flat = (std_i < 1e-15) | (std_j < 1e-15)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    value = np.where(flat, 1., cov / (std_i * std_j))
+                value[~has_pairs] = np.nan
+            else:
+                logger.error('Unknown GLCM property: {}'.format(p))
+                raise KeyError
+            results[p].append(value)
+
+    with np.errstate(invalid='ignore'):
+        # Objects without pairs at an offset (e.g. one pixel wide) are
+        # averaged over the remaining offsets
+        counted = {p: np.sum(~np.isnan(v), axis=0)
+                   for p, v in results.items()}
+        results = {p: np.where(counted[p] > 0,
+                               np.nansum(v, axis=0) /
+                               np.maximum(counted[p], 1),
+                               np.nan)
+                   for p, v in results.items()}
+
+    return pd.DataFrame(results, index=np.arange(1, n + 1))
+
+
+def compute_label_stats(gdf, raster, stats, band=1, label_image=None):
+    """
+    Compute stats for each polygon in gdf from one band of raster,
+    rasterizing the polygons to a label image (see rasterize_objects)
+    rather than masking the raster per polygon. GLCM texture stats
+    (glcm_<prop>, see label_glcm_stats) are computed from the band
+    quantized to GLCM_LEVELS levels over its full range.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+    raster : str
+        Path to raster.
+    stats : list
+        Stats to compute, from LABEL_STATS, percentile_<q> or glcm_<prop>
+    band : int
+        Band of raster to use.
+    label_image : tuple
+        (labels, window) from rasterize_objects, to reuse for rasters on
+        the same grid. Computed if not provided.
+
+    Returns
+    -------
+    pd.DataFrame : Stats indexed by gdf's index.
+    """
+    with rio.open(raster) as src:
+        if label_image is None:
+            label_image = rasterize_objects(gdf.geometry, src)
+        labels, window = label_image
+        if window is None:
+            values = np.ma.zeros(labels.shape)
+        else:
+            values = src.read(band, window=window, masked=True)
+        glcm_stats = [x for x in stats if _is_glcm_stat(x)]
+        if glcm_stats:
+            vmin, vmax = band_range(src, band)
+    stats_df = label_zonal_stats(
+        labels, values, n=len(gdf),
+        stats=[x for x in stats if x not in glcm_stats])
+    if glcm_stats:
+        glcm_df = label_glcm_stats(
+            labels, quantize(values, vmin, vmax), n=len(gdf),
+            props=[x[len('glcm_'):] for x in glcm_stats])
+        glcm_df.columns = ['glcm_{}'.format(x) for x in glcm_df.columns]
+        stats_df = stats_df.join(glcm_df)[stats]
+    stats_df.index = gdf.index
+
+    return stats_df
+
+
+def stream_windows(src, window, max_pixels=2**22):
+    """
+    Windows covering window, made of whole native blocks of src (combined
+    until about max_pixels, e.g. for single row strips) in GDAL block
+    order: left to right, top to bottom.
+    """
+    block_h, block_w = src.block_shapes[0]
+    blocks_w = max(1, min(-(-window.width // block_w),
+                          max_pixels // (block_h * block_w)))
+    blocks_h = max(1, max_pixels // (block_h * block_w * blocks_w))
+    step_h, step_w = block_h * blocks_h, block_w * blocks_w
+
+    row_start = (window.row_off // block_h) * block_h
+    col_start = (window.col_off // block_w) * block_w
+    for row_off in range(row_start, window.row_off + window.height, step_h):
+        for col_off in range(col_start, window.col_off + window.width,
+                             step_w):
+            yield Window(col_off, row_off, step_w, step_h)\
+                .intersection(window)
+
+
+def stream_label_stats(gdf, raster, stats, band=1, quantile_bins=100,
+                       max_pixels=2**22):
+    """
+    Compute stats for each polygon in gdf from one band of raster,
+    reading the raster in blocks (see stream_windows) and rasterizing
+    only the polygons that intersect each block. Per-object counts,
+    sums, means and sums of squared deviations (merged across blocks),
+    minimums and maximums are accumulated, so memory is bounded by the
+    block size and the number of objects rather than the raster size.
+
+    Medians and percentiles are approximate: a second pass over the
+    blocks builds a histogram of quantile_bins bins between each object's
+    minimum and maximum, and quantiles are interpolated within the bin
+    containing them, with an error of at most (max - min) / quantile_bins.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+    raster : str
+        Path to raster.
+    stats : list
+        Stats to compute, from STREAM_STATS or percentile_<q>
+    band : int
+        Band of raster to use.
+    quantile_bins : int
+        Number of histogram bins per object for medians and percentiles.
+    max_pixels : int
+        Approximate number of pixels to read at once.
+
+    Returns
+    -------
+    pd.DataFrame : Stats indexed by gdf's index.
+    """
+    n = len(gdf)
+    geoms = gdf.geometry.reset_index(drop=True)
+    count = np.zeros(n, dtype=np.int64)
+    total = np.zeros(n)
+    mean = np.zeros(n)
+    m2 = np.zeros(n)
+    mins = np.full(n, np.inf)
+    maxs = np.full(n, -np.inf)
+
+    def _blocks(src, window):
+        # Labels (positions + 1) and valid values of each block
+        for block in stream_windows(src, window, max_pixels=max_pixels):
+            block_geoms = geoms.iloc[query_pairs(
+                geoms, gpd.GeoSeries([box(*src.window_bounds(block))]))[1]]
+            if len(block_geoms) == 0:
+                continue
+            labels = rasterize(((g, i + 1) for i, g in block_geoms.items()
+                                if g is not None and not g.is_empty),
+                               out_shape=(int(block.height),
+                                          int(block.width)),
+                               transform=src.window_transform(block),
+                               fill=0,
+                               dtype='int32')
+            values = src.read(band, window=block, masked=True)
+            valid = (labels > 0) & ~np.ma.getmaskarray(values)
+            vals = np.ma.getdata(values)[valid].astype(np.float64)
+            valid_nan = ~np.isnan(vals)
+            yield labels[valid][valid_nan] - 1, vals[valid_nan]
+
+    with rio.open(raster) as src:
+        window = objects_window(geoms, src) if n > 0 else None
+        if window is not None:
+            for lab, vals in _blocks(src, window):
+                # Positions of the objects in the block (idx), and each
+                # pixel's index into them, so that work per block does not
+                # depend on the total number of objects
+                idx, block_lab = np.unique(lab, return_inverse=True)
+                block_count = np.bincount(block_lab)
+                block_total = np.bincount(block_lab, weights=vals)
+                block_mean = block_total / block_count
+                block_m2 = np.bincount(
+                    block_lab, weights=(vals - block_mean[block_lab]) ** 2)
+                # Merge block moments into running moments (Chan et al.)
+                n_a = count[idx]
+                n_ab = n_a + block_count
+                delta = block_mean - mean[idx]
+                mean[idx] += delta * block_count / n_ab
+                m2[idx] += block_m2 + delta ** 2 * n_a * block_count / n_ab
+                count[idx] = n_ab
+                total[idx] += block_total
+                np.minimum.at(mins, lab, vals)
+                np.maximum.at(maxs, lab, vals)
+
+        has_vals = count > 0
+        results = {'count': count}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results['sum'] = np.where(has_vals, total, np.nan)
+            results['mean'] = total / count
+            results['std'] = np.sqrt(m2 / count)
+        results['min'] = np.where(has_vals, mins, np.nan)
+        results['max'] = np.where(has_vals, maxs, np.nan)
+        results['range'] = results['max'] - results['min']
+
+        quantiles = {stat: 50. if stat == 'median'
+                     else float(stat.split('_')[1])
+                     for stat in stats
+                     if stat == 'median' or stat.startswith('percentile_')}
+        if quantiles and window is not None:
+            width = np.where(has_vals, maxs - mins, 0)
+            hist = np.zeros((n, quantile_bins), dtype=np.int32)
+            for lab, vals in _blocks(src, window):
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    rel = (vals - mins[lab]) / width[lab]
+                bins = np.clip(np.nan_to_num(rel * quantile_bins),
+                               0, quantile_bins - 1).astype(np.int64)
+                # Histograms of only the objects in the block
+                idx, block_lab = np.unique(lab, return_inverse=True)
+                hist[idx] += np.bincount(
+                    block_lab * quantile_bins + bins,
+                    minlength=len(idx) * quantile_bins)\
+                    .reshape(len(idx), quantile_bins).astype(np.int32)
+            cum = np.cumsum(hist, axis=1)
+            rows = np.arange(n)
+
+            def _value_at(k):
+                # Approximate k-th smallest value: the bin containing it,
+                # with values assumed evenly spread within the bin
+                k_bin = np.minimum((cum <= k[:, None]).sum(axis=1),
+                                   quantile_bins - 1)
+                before = np.where(k_bin > 0,
+                                  cum[rows, np.maximum(k_bin - 1, 0)], 0)
+                in_bin = np.maximum(hist[rows, k_bin], 1)
+                frac = (k - before + 0.5) / in_bin
+                value = mins + (k_bin + frac) / quantile_bins * width
+                return np.clip(value, mins, maxs)
+
+            for stat, q in quantiles.items():
+                # Linear interpolation between closest ranks, as
+                # np.percentile
+                rank = q / 100 * np.maximum(count - 1, 0)
+                lo = np.floor(rank)
+                lo_val = _value_at(lo)
+                with np.errstate(invalid='ignore'):
+                    value = lo_val + \
+                        (_value_at(np.ceil(rank)) - lo_val) * (rank - lo)
+                results[stat] = np.where(has_vals, value, np.nan)
+
+    stats_df = pd.DataFrame({stat: results[stat] for stat in stats},
+                            index=gdf.index)
+
+    return stats_df
+
+
 def compute_stats(gdf, raster, name=None,
                   stats=None,
                   custom_stats=None, band=None,
-                  renamer=None):
+                  renamer=None,
+                  label_image=None,
+                  streaming=False):
     """
     Computes statistics for each polygon in geodataframe
     based on raster. Statistics to be computed are the keys
     in the stats_dict, and the renamed columns are the values.
+    If all stats are supported by label_zonal_stats and there are no
+    custom_stats, stats are computed from a label image of the polygons
+    (label_image, or rasterized from gdf), otherwise with rasterstats.
+    If streaming, stats are computed by stream_label_stats, reading the
+    raster in blocks, where supported.
 
     Parameters
     ----------
@@ -98,7 +750,14 @@ def compute_stats(gdf, raster, name=None,
     stats_dict : dict
         Dictionary of stat:renamed_col pairs.
         Stats must be one of: min, max, median, sum, std,
-                              unique, range, percentile_<q>
+                              unique, range, percentile_<q>,
+                              glcm_<prop> (GLCM_PROPS)
+    label_image : tuple
+        (labels, window) from rasterize_objects, for gdf on the grid of
+        raster.
+    streaming : bool
+        True to read the raster in blocks rather than reading the extent
+        of gdf at once, for rasters that do not fit in memory.
     Returns
     -------
     The geodataframe with added columns.
@@ -110,7 +769,26 @@ def compute_stats(gdf, raster, name=None,
     if renamer is None:
         renamer = {x: '{}_{}'.format(name, x) for x in stats}
 
-    if band:
+    if streaming and not custom_stats and \
+            all(_stream_stat_supported(x) for x in stats):
+        if band:
+            logger.info('Band: {}'.format(band))
+        stats_df = stream_label_stats(gdf, raster, stats=list(stats),
+                                      band=band if band else 1)
+        gdf = gdf.join(stats_df.rename(columns=renamer), how='left')
+    elif not custom_stats and \
+            all(_label_stat_supported(x) for x in stats) and \
+            (not streaming or any(_is_glcm_stat(x) for x in stats)):
+        if streaming:
+            logger.warning('GLCM stats cannot be streamed, reading the '
+                           'extent of the objects at once.')
+        if band:
+            logger.info('Band: {}'.format(band))
+        stats_df = compute_label_stats(gdf, raster, stats=list(stats),
+                                       band=band if band else 1,
+                                       label_image=label_image)
+        gdf = gdf.join(stats_df.rename(columns=renamer), how='left')
+    elif band:
         logger.info('Band: {}'.format(band))
         gdf = gdf.join(pd.DataFrame(zonal_stats(gdf['geometry'], raster,
                                                 stats=stats,
@@ -129,13 +807,281 @@ def compute_stats(gdf, raster, name=None,
     return gdf
 
 
+def stat_columns(name, stats, bands=None):
+    """
+    Columns raster_stats creates for a raster, as (column, band, stat)
+    tuples in the order they are created. band is None if bands is None.
+    """
+    if bands is None:
+        # Split custom stat functions from built-in options
+        accepted_stats = ['min', 'max', 'median', 'sum', 'std', 'mean',
+                          'unique', 'range', 'majority']
+        return [('{}_{}'.format(name, k), None, k) for k in stats
+                if k in accepted_stats or k.startswith('percentile_') or
+                _is_glcm_stat(k)]
+
+    return [('{}b{}_{}'.format(name, b, x), b, x)
+            for b in bands for x in stats]
+
+
+def file_hash(path, cache_dir):
+    """
+    SHA-1 of the content of the file at path. Hashes are recorded in
+    cache_dir by path, size and modification time, so unchanged files are
+    only read once.
+    """
+    index_path = os.path.join(cache_dir, 'file_hashes.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as jf:
+            index = json.load(jf)
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    entry = index.get(path)
+    if entry and entry['size'] == st.st_size and \
+            entry['mtime'] == st.st_mtime:
+        return entry['hash']
+
+    logger.info('Hashing: {}'.format(path))
+    h = hashlib.sha1()
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(2**24), b''):
+            h.update(chunk)
+    index[path] = {'size': st.st_size, 'mtime': st.st_mtime,
+                   'hash': h.hexdigest()}
+    with open(index_path, 'w') as jf:
+        json.dump(index, jf)
+
+    return index[path]['hash']
+
+
+def column_key(objects_key, raster_key, band, stat, streaming=False):
+    """Cache key of a stat column: the objects, the raster content, the
+    band, the stat and the parameters that change its values."""
+    params = [objects_key, raster_key, str(band), stat]
+    if streaming and not _is_glcm_stat(stat):
+        # Approximate quantiles
+        params.append('streaming')
+    if _is_glcm_stat(stat):
+        params.append('levels{}'.format(GLCM_LEVELS))
+    return hashlib.sha1('|'.join(params).encode()).hexdigest()
+
+
+def load_cached_column(cache_dir, key, n):
+    """Values of a cached stat column, None if not cached (for n
+    objects)."""
+    path = os.path.join(cache_dir, '{}.npy'.format(key))
+    if not os.path.exists(path):
+        return None
+    values = np.load(path, allow_pickle=True)
+    if len(values) != n:
+        return None
+    return values
+
+
+def save_cached_column(cache_dir, key, values):
+    path = os.path.join(cache_dir, '{}.npy'.format(key))
+    np.save(path, np.asarray(values), allow_pickle=True)
+
+
+def cached_raster_stats(gdf, rasters, names, stats, bands, cache_dir,
+                        streaming=False, **kwargs):
+    """
+    Compute stats of each raster for gdf, reusing stat columns cached in
+    cache_dir. Columns are keyed by the geometries of gdf, the content of
+    the raster, the band and the stat (see column_key), so a column is
+    only computed again if any of these change. For each raster, the
+    bands and stats with any column missing from the cache are computed
+    (with raster_stats, or parallel_raster_stats if kwargs are passed),
+    and the new columns cached.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : gdf with stats columns added, in the same order as
+        without the cache.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    objects_key = geometry_hash(gdf.geometry)
+
+    cached = {}
+    missing = {}
+    todo = []
+    columns = []
+    for r, n, s, bs in zip(rasters, names, stats, bands):
+        raster_key = file_hash(r, cache_dir)
+        raster_missing = []
+        for col, b, stat in stat_columns(n, s, bs):
+            key = column_key(objects_key, raster_key, b, stat,
+                             streaming=streaming)
+            columns.append(col)
+            values = load_cached_column(cache_dir, key, len(gdf))
+            if values is None:
+                missing[col] = key
+                raster_missing.append((b, stat))
+            else:
+                cached[col] = values
+        if raster_missing:
+            missing_bands = {b for b, _stat in raster_missing}
+            missing_stats = {stat for _b, stat in raster_missing}
+            todo.append((r, n, [x for x in s if x in missing_stats],
+                         None if bs is None
+                         else [b for b in bs if b in missing_bands]))
+    logger.info('Stats columns cached: {:,}, to compute: {:,}'.format(
+        len(cached), len(missing)))
+
+    if todo:
+        t_rasters, t_names, t_stats, t_bands = zip(*todo)
+        if kwargs:
+            gdf = parallel_raster_stats(gdf, rasters=t_rasters,
+                                        names=t_names, stats=t_stats,
+                                        bands=t_bands, streaming=streaming,
+                                        **kwargs)
+        else:
+            label_images = {}
+            for r, n, s, bs in todo:
+                gdf = raster_stats(gdf, raster=r, name=n, stats=s, bands=bs,
+                                   label_images=label_images,
+                                   streaming=streaming)
+        for col, key in missing.items():
+            save_cached_column(cache_dir, key, gdf[col].values)
+
+    for col, values in cached.items():
+        if col not in gdf.columns:
+            gdf[col] = values
+    # Same column order as computing all columns
+    gdf = gdf[[c for c in gdf.columns if c not in columns] + columns]
+
+    return gdf
+
+
+def raster_stats(gdf, raster, name, stats, bands=None, label_images=None,
+                 streaming=False):
+    """
+    Compute stats for each polygon in gdf from raster, for each of bands
+    if provided, naming columns <name>_<stat>, or <name>b<band>_<stat>.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+    raster : str
+        Path to raster.
+    name : str
+        Prefix for stats columns.
+    stats : list
+        Stats to compute.
+    bands : list
+        Bands of raster to compute stats for.
+    label_images : dict
+        Label images of gdf by grid_key, to reuse across rasters on the
+        same grid. Label images created are added.
+    streaming : bool
+        True to read the raster in blocks, see stream_label_stats.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : gdf with stats columns added.
+    """
+    label_image = None
+    if not streaming:
+        if label_images is None:
+            label_images = {}
+        with rio.open(raster) as src:
+            key = grid_key(src)
+            if key not in label_images:
+                logger.info('Rasterizing segments to label image...')
+                label_images[key] = rasterize_objects(gdf.geometry, src)
+        label_image = label_images[key]
+    if bands is None:
+        stats_acc = [stat for _col, _b, stat
+                     in stat_columns(name, stats, bands)]
+        gdf = compute_stats(gdf=gdf, raster=raster, name=name,
+                            stats=stats_acc,
+                            label_image=label_image,
+                            streaming=streaming)
+    else:
+        # Compute stats for each band
+        for b in bands:
+            stats_dict = {x: '{}b{}_{}'.format(name, b, x) for x in stats}
+            gdf = compute_stats(gdf=gdf, raster=raster,
+                                stats=stats_dict,
+                                renamer=stats_dict,
+                                band=b,
+                                label_image=label_image,
+                                streaming=streaming)
+
+    return gdf
+
+
+def _raster_stats_columns(geoms, raster, name, stats, bands, streaming):
+    """Stats columns of raster_stats, without the geometries."""
+    gdf = raster_stats(geoms, raster=raster, name=name, stats=stats,
+                       bands=bands, streaming=streaming)
+    return pd.DataFrame(gdf.drop(columns=geoms.columns))
+
+
+def parallel_raster_stats(gdf, rasters, names, stats, bands,
+                          chunk_size=None, num_cores=None, streaming=False):
+    """
+    Compute raster_stats for each raster in a process pool, with the
+    polygons split into spatial chunks of chunk_size x chunk_size (in
+    units of the CRS, each polygon belongs to the chunk containing its
+    representative point), each raster and chunk a separate job. The
+    results are joined to gdf in the order of rasters, with the same
+    columns as computing the rasters serially.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+    rasters, names, stats, bands : list
+        Path, column prefix, stats and bands (or None) for each raster, see
+        load_stats_dict.
+    chunk_size : float
+        Width and height of chunks of polygons, None to compute all
+        polygons in one job per raster.
+    num_cores : int
+        Number of processes, defaults to all but two cores.
+    streaming : bool
+        True to read rasters in blocks, see stream_label_stats.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : gdf with stats columns added.
+    """
+    geoms = gdf[[gdf.geometry.name]]
+    if chunk_size is None:
+        chunks = [geoms]
+    else:
+        keys = tile_keys(geoms.geometry, chunk_size)
+        chunks = [geoms[keys == k] for k in np.unique(keys)]
+    logger.info('Computing stats for {:,} rasters in {:,} chunks of '
+                'objects...'.format(len(rasters), len(chunks)))
+
+    jobs = [(chunk, r, n, s, bs, streaming)
+            for r, n, s, bs in zip(rasters, names, stats, bands)
+            for chunk in chunks]
+    results = run_parallel(_raster_stats_columns, jobs, num_cores=num_cores)
+
+    for i in range(len(rasters)):
+        raster_results = results[i * len(chunks):(i + 1) * len(chunks)]
+        gdf = gdf.join(pd.concat(raster_results).reindex(gdf.index),
+                       how='left')
+
+    return gdf
+
+
 def calc_zonal_stats(shp, rasters,
                      names=None,
                      stats=['min', 'max', 'mean', 'count', 'median'],
                      area=True,
                      compactness=False,
                      roundness=False,
-                     out_path=None):
+                     out_path=None,
+                     streaming=False,
+                     num_cores=1,
+                     chunk_size=None,
+                     cache_dir=None,
+                     metrics=None):
     """
     Calculate zonal statistics on the given vector file
     for each raster provided.
@@ -164,6 +1110,22 @@ def calc_zonal_stats(shp, rasters,
         True to also compute compactness of each object
     roundness : bool
         True to also compute roundess of each object
+    streaming : bool
+        True to read rasters in blocks, bounding memory use by block size
+        rather than raster size. Medians and percentiles are approximate.
+    num_cores : int
+        Number of processes to compute stats with, by raster and by chunk
+        of objects, None for all but two cores.
+    chunk_size : float
+        Width and height of spatial chunks of objects to compute stats for
+        in separate processes, in units of the CRS. Default is not to
+        chunk objects.
+    cache_dir : os.path.abspath
+        Directory to cache stats columns in, keyed by the content of the
+        objects and rasters, see cached_raster_stats. Cached columns are
+        reused rather than computed again.
+    metrics : list
+        Shape metrics to compute, from SHAPE_METRICS, see shape_metrics.
 
     Returns
     -------
@@ -213,30 +1175,30 @@ def calc_zonal_stats(shp, rasters,
             logger.error('Raster does not exist: {}'.format(r))
             logger.error('FileNotFoundError')
 
-    # Iterate rasters and compute stats for each
-    for r, n, s, bs in zip(rasters, names, stats, bands):
-        if bs is None:
-            # Split custom stat functions from built-in options
-            accepted_stats = ['min', 'max', 'median', 'sum', 'std', 'mean',
-                              'unique', 'range', 'majority']
-            stats_acc = [k for k in s if k in accepted_stats
-                         or k.startswith('percentile_')]
-            # Assume any key not in accepted_stats is a name:custom_fxn
-            custom_stats = [k for k in stats if k not in accepted_stats]
-            custom_stats_dict = {}
-            # for cs in custom_stats:
-            #     custom_stats[cs] = custom_stat_fxn(cs)
-
-            seg = compute_stats(gdf=seg, raster=r, name=n,
-                                stats=stats_acc)
-        else:
-            # Compute stats for each band
-            for b in bs:
-                stats_dict = {x: '{}b{}_{}'.format(n, b, x) for x in s}
-                seg = compute_stats(gdf=seg, raster=r,
-                                    stats=stats_dict,
-                                    renamer=stats_dict,
-                                    band=b)
+    if cache_dir:
+        parallel_kwargs = {}
+        if num_cores != 1 or chunk_size is not None:
+            parallel_kwargs = {'num_cores': num_cores,
+                               'chunk_size': chunk_size}
+        seg = cached_raster_stats(seg, rasters=rasters, names=names,
+                                  stats=stats, bands=bands,
+                                  cache_dir=cache_dir, streaming=streaming,
+                                  **parallel_kwargs)
+    elif num_cores == 1 and chunk_size is None:
+        # Label images of the segments, shared by all bands of all rasters
+        # on the same grid
+        label_images = {}
+        # Iterate rasters and compute stats for each
+        for r, n, s, bs in zip(rasters, names, stats, bands):
+            seg = raster_stats(seg, raster=r, name=n, stats=s, bands=bs,
+                               label_images=label_images,
+                               streaming=streaming)
+    else:
+        seg = parallel_raster_stats(seg, rasters=rasters, names=names,
+                                    stats=stats, bands=bands,
+                                    chunk_size=chunk_size,
+                                    num_cores=num_cores,
+                                    streaming=streaming)
 
     # Area recording
     if area:
@@ -249,6 +1211,11 @@ def calc_zonal_stats(shp, rasters,
     if roundness:
         seg = apply_roundness(seg)
 
+    if metrics:
+        seg = seg.join(shape_metrics(seg.geometry,
+                                     [m for m in metrics
+                                      if m not in seg.columns]))
+
     # Write segments with stats to new shapefile
     if not out_path:
         out_path = os.path.join(os.path.dirname(shp),
@@ -303,6 +1270,29 @@ if __name__ == '__main__':
     parser.add_argument('-rd', '--roundness',
                         action='store_true',
                         help='Use to compute a roundness field.')
+    parser.add_argument('-m', '--metrics',
+                        type=str,
+                        nargs='+',
+                        choices=SHAPE_METRICS,
+                        help='Shape metrics to compute.')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Read rasters in blocks, for rasters too large '
+                             'to fit in memory. Medians and percentiles are '
+                             'approximate.')
+    parser.add_argument('--num_cores',
+                        type=int,
+                        default=1,
+                        help='Number of processes to compute stats with.')
+    parser.add_argument('--chunk_size',
+                        type=float,
+                        help='Width and height of spatial chunks of objects '
+                             'to compute stats for in separate processes, '
+                             'in units of the objects\' CRS.')
+    parser.add_argument('--cache_dir',
+                        type=os.path.abspath,
+                        help='Directory to cache stats in, to reuse for the '
+                             'same objects and rasters.')
 
     os.chdir(r'E:\disbr007\umn\accuracy_assessment\banks\banks1')
     sys.argv = [r'C:\code\pgc-code-all\obia_utils\calc_zonal_stats.py',
@@ -319,5 +1309,10 @@ if __name__ == '__main__':
                      area=args.area,
                      compactness=args.compactness,
                      roundness=args.roundness,
-                     out_path=args.out_path)
+                     out_path=args.out_path,
+                     streaming=args.streaming,
+                     num_cores=args.num_cores,
+                     chunk_size=args.chunk_size,
+                     cache_dir=args.cache_dir,
+                     metrics=args.metrics)
     logger.info('Done.')
\ No newline at end of file
@@ -1,15 +1,22 @@
 import argparse
 import copy
+import multiprocessing
 import os
 from pathlib import PurePath
 
 from osgeo import gdal
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import rowcol
 
-from misc_utils.gpd_utils import read_vec, write_gdf
+from misc_utils.gpd_utils import read_vec, write_gdf, count_features
 from misc_utils.RasterWrapper import Raster
 from misc_utils.logging_utils import create_logger
+from obia_utils.calc_zonal_stats import rasterize_objects, objects_window, \
+    label_zonal_stats
+from obia_utils.tiling import run_parallel
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
@@ -21,7 +28,6 @@ def load_objs(objects):
     if isinstance(objects, PurePath):
         objects = str(objects)
     # Load objects
-    # TODO: Read in chunks, parallelize, recombine and write
     logger.info('Reading in objects...')
     # objs = gpd.read_file(objects)
     objs = read_vec(objects)
@@ -30,6 +36,18 @@ def load_objs(objects):
     return objs
 
 
+def chunk_rows(objects, chunk_size):
+    """Row slices of at most chunk_size features covering the objects
+    layer, to read with read_vec(objects, rows=...)."""
+    if isinstance(objects, PurePath):
+        objects = str(objects)
+    n = count_features(objects)
+    logger.info('Objects found: {:,}'.format(n))
+
+    return [slice(start, min(start + chunk_size, n))
+            for start in range(0, n, chunk_size)]
+
+
 def remove_small_objects(objects, min_size):
     logger.info('Removing objects with area less than {}'.format(min_size))
     objects = objects[objects.geometry.area >= min_size]
@@ -38,7 +56,91 @@ def remove_small_objects(objects, min_size):
     return objects
 
 
-def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
+def masked_fraction(objs, mask_on):
+    """
+    Fraction of the pixels of each object that are NoData in mask_on,
+    from a label image of the objects on the raster's grid. Objects that
+    do not cover any pixel center are sampled at their representative
+    point instead, and objects outside the raster are entirely masked.
+    """
+    with rio.open(mask_on) as src:
+        labels, window = rasterize_objects(objs.geometry, src)
+        if window is None:
+            return pd.Series(1., index=objs.index)
+        is_masked = src.read_masks(1, window=window) == 0
+        fraction = label_zonal_stats(labels, np.ma.masked_array(is_masked),
+                                     n=len(objs),
+                                     stats=['mean'])['mean'].values
+        # Objects smaller than a pixel
+        no_pixels = np.isnan(fraction)
+        if no_pixels.any():
+            fraction[no_pixels] = sample_mask(objs[no_pixels], src,
+                                              window, is_masked)
+
+    return pd.Series(fraction, index=objs.index)
+
+
+def sample_mask(objs, src, window, is_masked):
+    """1. where the representative point of each object is masked, 0.
+    otherwise. is_masked covers window of src."""
+    pts = objs.geometry.representative_point()
+    rows, cols = rowcol(src.window_transform(window), pts.x.values,
+                        pts.y.values)
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    inside = (rows >= 0) & (rows < is_masked.shape[0]) & \
+             (cols >= 0) & (cols < is_masked.shape[1])
+    sampled = np.ones(len(objs))
+    sampled[inside] = is_masked[rows[inside], cols[inside]]
+
+    return sampled
+
+
+def mask_objs_raster(objs, mask_on, max_masked=0.5, method='fraction'):
+    """
+    Remove objects in NoData areas of mask_on, deciding in the raster
+    domain rather than polygonizing the mask.
+
+    Parameters
+    ----------
+    objs : gpd.GeoDataFrame
+    mask_on : os.path.abspath
+        Raster with NoData areas to remove objects in.
+    max_masked : float
+        Objects with a larger fraction of their pixels masked are removed.
+    method : str
+        'fraction' to compute the masked fraction of each object's pixels,
+        'point' to only sample the mask at each object's representative
+        point.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : objects kept
+    """
+    logger.info('Removing objects in masked areas of: {}'.format(mask_on))
+    if method == 'fraction':
+        keep = masked_fraction(objs, mask_on) <= max_masked
+    elif method == 'point':
+        with rio.open(mask_on) as src:
+            window = objects_window(objs.geometry, src)
+            if window is None:
+                keep = pd.Series(False, index=objs.index)
+            else:
+                is_masked = src.read_masks(1, window=window) == 0
+                keep = pd.Series(sample_mask(objs, src, window,
+                                             is_masked) == 0,
+                                 index=objs.index)
+    else:
+        logger.error('Unknown mask method: {}'.format(method))
+        raise ValueError
+    keep_objs = objs[keep.values]
+    logger.info('Objects kept: {:,}'.format(len(keep_objs)))
+
+    return keep_objs
+
+
+def mask_polygons(mask_on, out_mask_img=None, out_mask_vec=None):
+    """Polygonize mask_on, returning the polygons of valid areas."""
     if out_mask_img is None:
         out_mask_img = r'/vsimem/temp_mask.tif'
     if out_mask_vec is None:
@@ -51,6 +153,11 @@ def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
     mask = read_vec(out_mask_vec)
     not_mask = mask[mask.iloc[:, 0] != '1']
 
+    return not_mask
+
+
+def overlay_mask(objs, not_mask):
+    """Clip objs to the valid area polygons from mask_polygons."""
     # Select only objects in valid areas of mask
     logger.info('Removing objects in masked areas...')
     # TODO: use centroids for faster cleanup - Begin
@@ -63,21 +170,121 @@ def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
     return keep_objs
 
 
+def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
+    not_mask = mask_polygons(mask_on, out_mask_img=out_mask_img,
+                             out_mask_vec=out_mask_vec)
+
+    return overlay_mask(objs, not_mask)
+
+
 def remove_null_objects(objects, fields=['all']):
     logger.info('Removing objects with fields that are null.')
     if len(fields) == 1 and fields[0] == 'all':
         fields = list(objects)
     logger.info('Fields considered: {}'.format(fields))
 
-    keep_objs = objects[objects.apply(lambda x: all([pd.notna(x[f])
-                                                     for f in fields]), axis=1)]
-    # keep_objs = keep_objs[keep_objs[fields].notnull()]
+    keep_objs = objects[objects[fields].notna().all(axis=1).values]
 
     logger.info('Objects kept: {:,}'.format(len(keep_objs)))
 
     return keep_objs
 
 
+def cleanup_chunk(keep_objs, min_size=None, mask_on=None, not_mask=None,
+                  drop_na=None, mask_method='vector', max_masked=0.5):
+    """Apply the cleanup steps to keep_objs. If mask_method is 'vector',
+    not_mask are the valid area polygons of mask_on, see mask_polygons."""
+    if min_size:
+        keep_objs = remove_small_objects(objects=keep_objs,
+                                         min_size=min_size)
+    if mask_on and len(keep_objs) > 0:
+        if mask_method == 'vector':
+            keep_objs = overlay_mask(keep_objs, not_mask)
+        else:
+            keep_objs = mask_objs_raster(objs=keep_objs, mask_on=mask_on,
+                                         max_masked=max_masked,
+                                         method=mask_method)
+    if drop_na:
+        keep_objs = remove_null_objects(keep_objs, fields=drop_na)
+
+    return keep_objs
+
+
+def _read_cleanup_chunk(input_objects, rows, cleanup_kwargs):
+    """Read the features of input_objects in rows and clean them up."""
+    objs = read_vec(input_objects, rows=rows)
+    logger.debug('Cleaning up objects {:,} - {:,}'.format(rows.start,
+                                                          rows.stop))
+
+    return cleanup_chunk(objs, **cleanup_kwargs)
+
+
+def cleanup_objects_chunked(input_objects, out_objects, chunk_size,
+                            num_cores=None, overwrite=False, **cleanup_kwargs):
+    """
+    Clean up input_objects in chunks of chunk_size features, read and
+    cleaned up in a process pool num_cores chunks at a time, writing the
+    objects kept by each chunk to out_objects as they are done. Memory use
+    is bounded by num_cores * chunk_size objects rather than the size of
+    the layer.
+
+    Parameters
+    ----------
+    input_objects : str
+    out_objects : str
+    chunk_size : int
+        Number of features to read per chunk.
+    num_cores : int
+        Number of processes, defaults to all but two cores.
+    overwrite : bool
+    **cleanup_kwargs
+        Keyword arguments to cleanup_chunk, with mask_on, out_mask_img and
+        out_mask_vec in place of not_mask.
+
+    Returns
+    -------
+    int : number of objects kept
+    """
+    if isinstance(input_objects, PurePath):
+        input_objects = str(input_objects)
+    if os.path.exists(out_objects) and not overwrite:
+        logger.warning('Out file exists and overwrite not specified, '
+                       'skipping writing.')
+        return 0
+    num_cores = num_cores if num_cores else multiprocessing.cpu_count() - 2
+    num_cores = max(1, num_cores)
+
+    # Polygonize the mask once, rather than in each chunk
+    out_mask_img = cleanup_kwargs.pop('out_mask_img', None)
+    out_mask_vec = cleanup_kwargs.pop('out_mask_vec', None)
+    if cleanup_kwargs.get('mask_on') and \
+            cleanup_kwargs.get('mask_method', 'vector') == 'vector':
+        cleanup_kwargs['not_mask'] = mask_polygons(
+            cleanup_kwargs['mask_on'], out_mask_img=out_mask_img,
+            out_mask_vec=out_mask_vec)
+
+    rows = chunk_rows(input_objects, chunk_size)
+    logger.info('Cleaning up objects in {:,} chunks...'.format(len(rows)))
+    kept = 0
+    for i in range(0, len(rows), num_cores):
+        results = run_parallel(_read_cleanup_chunk,
+                               [(input_objects, r, cleanup_kwargs)
+                                for r in rows[i:i + num_cores]],
+                               num_cores=num_cores)
+        for keep_objs in results:
+            if len(keep_objs) == 0:
+                continue
+            write_gdf(keep_objs, out_objects, overwrite=overwrite,
+                      append=kept > 0)
+            kept += len(keep_objs)
+    logger.info('Objects kept ({:,}) written to: {}'.format(kept,
+                                                            out_objects))
+    if kept == 0:
+        logger.warning('No objects kept, nothing written.')
+
+    return kept
+
+
 def cleanup_objects(input_objects,
                     out_objects=None,
                     min_size=None,
@@ -85,19 +292,37 @@ def cleanup_objects(input_objects,
                     out_mask_img=None,
                     out_mask_vec=None,
                     drop_na=None,
-                    overwrite=False):
+                    overwrite=False,
+                    mask_method='vector',
+                    max_masked=0.5,
+                    chunk_size=None,
+                    num_cores=1):
+    """Remove small objects, objects in NoData areas of mask_on and
+    objects with null fields. mask_method is 'vector' to overlay objects
+    with the polygonized mask (clipping objects to valid areas), or
+    'fraction' or 'point' to decide in the raster domain, see
+    mask_objs_raster. If chunk_size is given, objects are read, cleaned
+    up in num_cores processes and written chunk_size features at a time,
+    see cleanup_objects_chunked."""
+    cleanup_kwargs = dict(min_size=min_size, mask_on=mask_on,
+                          drop_na=drop_na, mask_method=mask_method,
+                          max_masked=max_masked)
+    if chunk_size and out_objects:
+        cleanup_objects_chunked(input_objects, out_objects,
+                                chunk_size=chunk_size,
+                                num_cores=num_cores,
+                                overwrite=overwrite,
+                                out_mask_img=out_mask_img,
+                                out_mask_vec=out_mask_vec,
+                                **cleanup_kwargs)
+        return out_objects
 
     keep_objs = load_objs(input_objects)
-
-    if min_size:
-        keep_objs = remove_small_objects(objects=keep_objs,
-                                         min_size=min_size)
-    if mask_on:
-        keep_objs = mask_objs(objs=keep_objs, mask_on=mask_on,
-                              out_mask_img=out_mask_img,
-                              out_mask_vec=out_mask_vec)
-    if drop_na:
-        keep_objs = remove_null_objects(keep_objs, fields=drop_na)
+    if mask_on and mask_method == 'vector':
+        cleanup_kwargs['not_mask'] = mask_polygons(mask_on,
+                                                   out_mask_img=out_mask_img,
+                                                   out_mask_vec=out_mask_vec)
+    keep_objs = cleanup_chunk(keep_objs, **cleanup_kwargs)
 
     if out_objects:
         logger.info('Writing kept objects ({:,}) to: {}'.format(len(keep_objs),
@@ -130,6 +355,24 @@ if __name__ == '__main__':
     parser.add_argument('--out_mask_vec', type=os.path.abspath,
                         help='Path to write intermediate mask vector '
                              'polygonized from mask raster.')
+    parser.add_argument('--mask_method', choices=['vector', 'fraction',
+                                                  'point'],
+                        default='vector',
+                        help='How to remove objects in NoData areas: '
+                             '"vector" overlays the polygonized mask, '
+                             '"fraction" removes objects with more than '
+                             '--max_masked of their pixels NoData, "point" '
+                             'removes objects with NoData at their '
+                             'representative point.')
+    parser.add_argument('--max_masked', type=float, default=0.5,
+                        help='Largest fraction of NoData pixels to keep an '
+                             'object with, for --mask_method fraction.')
+    parser.add_argument('--chunk_size', type=int,
+                        help='Read, clean up and write objects this many '
+                             'features at a time, rather than all at once.')
+    parser.add_argument('--num_cores', type=int, default=1,
+                        help='Number of chunks to clean up in parallel, '
+                             'with --chunk_size.')
     parser.add_argument('--overwrite', action='store_true',
                         help='Overwrite outfile if it exists.')
 
@@ -157,6 +400,10 @@ if __name__ == '__main__':
     out_mask_img = args.out_mask_img
     out_mask_vec = args.out_mask_vec
     overwrite = args.overwrite
+    mask_method = args.mask_method
+    max_masked = args.max_masked
+    chunk_size = args.chunk_size
+    num_cores = args.num_cores
 
     cleanup_objects(input_objects=input_objects,
                     out_objects=out_objects,
@@ -165,4 +412,8 @@ if __name__ == '__main__':
                     drop_na=drop_na,
                     out_mask_vec=out_mask_vec,
                     out_mask_img=out_mask_img,
-                    overwrite=overwrite)
+                    overwrite=overwrite,
+                    mask_method=mask_method,
+                    max_masked=max_masked,
+                    chunk_size=chunk_size,
+                    num_cores=num_cores)
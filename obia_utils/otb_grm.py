@@ -72,7 +72,8 @@ def otb_grm(img,
             spectral=0.5,
             spatial=0.5,
             init_otb_env=True,
-            drop_smaller=None):
+            drop_smaller=None,
+            keep_raster=False):
     """
     Run the Orfeo Toolbox GenericRegionMerging command via the command line.
     Requires that OTB environment is activated
@@ -101,6 +102,9 @@ def otb_grm(img,
         Call OTB environment activating .bat script before running.
     drop_smaller: float
         If not None, drop resulting segments smaller than this size.
+    keep_raster: bool
+        Keep the label raster after vectorizing, e.g. to pass to
+        ImageObjects(label_raster=...) to find neighbors from labels.
 
     Returns
     -------
@@ -196,12 +200,13 @@ def otb_grm(img,
         write_gdf(objects, out_seg)
         logger.info('Segmentation created at: {}'.format(out_seg))
 
-        logger.debug('Removing raster segmentation...')
-        try:
-            os.remove(out_img)
-        except:
-            logger.warning('Could not remove segmentation image: '
-                           '{}'.format(out_img))
+        if not keep_raster:
+            logger.debug('Removing raster segmentation...')
+            try:
+                os.remove(out_img)
+            except:
+                logger.warning('Could not remove segmentation image: '
+                               '{}'.format(out_img))
 
     return out_seg
 
@@ -257,6 +262,8 @@ if __name__ == "__main__":
     parser.add_argument('--drop_smaller', type=float,
                         help='Drop objects smaller than this size before writing '
                              'to file.')
+    parser.add_argument('--keep_raster', action='store_true',
+                        help='Keep the label raster after vectorizing.')
     parser.add_argument('-l', '--log_file',
                         type=os.path.abspath,
                         default='otb_grm.log',
@@ -279,6 +286,7 @@ if __name__ == "__main__":
     spectral = args.spectral
     spatial = args.spatial
     drop_smaller = args.drop_smaller
+    keep_raster = args.keep_raster
 
     # Set up logger
     handler_level = 'INFO'
@@ -305,4 +313,5 @@ if __name__ == "__main__":
             spectral=spectral,
             spatial=spatial,
             out_dir=out_dir,
-            drop_smaller=drop_smaller)
+            drop_smaller=drop_smaller,
+            keep_raster=keep_raster)
@@ -0,0 +1,228 @@
+"""
+Split ImageObjects into spatial tiles to classify and merge them in a
+process pool.
+
+Each object is owned by exactly one tile: the tile its representative
+point falls in. A tile is processed with a halo of the objects around
+the objects it owns, so that every owned object has all of its neighbors
+available, and only the results for owned objects are kept. Objects that
+cross tile seams are therefore resolved once, by their owner, and the
+reconciled output matches a single-process run.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'DEBUG')
+
+
+def tile_keys(geoms, tile_size):
+    """
+    Tile of each geometry, from the location of its representative point
+    (a point guaranteed to be within the geometry) on a grid of
+    tile_size x tile_size tiles anchored at the upper left of geoms.
+
+    Parameters
+    ----------
+    geoms : gpd.GeoSeries
+    tile_size : float
+        Width and height of tiles, in units of the CRS.
+
+    Returns
+    -------
+    np.ndarray : integer tile key of each geometry
+    """
+    minx, _miny, _maxx, maxy = geoms.total_bounds
+    pts = geoms.representative_point()
+    cols = np.floor((pts.x.values - minx) / tile_size).astype(np.int64)
+    rows = np.floor((maxy - pts.y.values) / tile_size).astype(np.int64)
+
+    return rows * (cols.max() + 1) + cols
+
+
+def tile_subsets(objects, tile_size, halo=0):
+    """
+    Split objects into tiles.
+
+    Parameters
+    ----------
+    objects : gpd.GeoDataFrame
+    tile_size : float
+        Width and height of tiles, in units of the CRS.
+    halo : float
+        Additional distance around the objects owned by a tile to include.
+        The halo always includes every object whose bounds intersect the
+        bounds of the owned objects, which contains all of their neighbors.
+
+    Returns
+    -------
+    list : of (core_ids, tile_objects) tuples, ordered by tile, where
+        core_ids is the index of the objects owned by the tile and
+        tile_objects the owned objects and their halo
+    """
+    keys = tile_keys(objects.geometry, tile_size)
+    tiles = []
+    for key in np.unique(keys):
+        core = objects[keys == key]
+        minx, miny, maxx, maxy = core.total_bounds
+        tile_objects = objects.cx[minx - halo:maxx + halo,
+                                  miny - halo:maxy + halo]
+        tiles.append((core.index, tile_objects))
+    logger.debug('Objects split into {:,} tiles.'.format(len(tiles)))
+
+    return tiles
+
+
+def run_parallel(fxn, jobs, num_cores=None):
+    """Run fxn(*job) for each job in a process pool, returning results in
+    the order of jobs."""
+    from joblib import Parallel, delayed
+    num_cores = num_cores if num_cores else multiprocessing.cpu_count() - 2
+    num_cores = max(1, min(num_cores, len(jobs)))
+
+    return Parallel(n_jobs=num_cores)(delayed(fxn)(*job) for job in jobs)
+
+
+def tile_neighbors(neighbors, tile_ids):
+    """Known neighbors of the objects in a tile, restricted to the objects
+    in the tile. Objects without neighbors computed are omitted."""
+    neighbors = neighbors.reindex(tile_ids)
+    neighbors = neighbors[neighbors.apply(
+        lambda x: isinstance(x, np.ndarray))]
+
+    return pd.Series([np.intersect1d(ns, tile_ids).astype('i')
+                      for ns in neighbors.values],
+                     index=neighbors.index,
+                     dtype=object)
+
+
+def _classify_tile(core_ids, tile_objects, tile_nebs, classify_kwargs):
+    """Classify the objects of one tile, returning the class, neighbors and
+    any rule fields created, for the objects owned by the tile. Neighbors
+    are only computed for objects not in tile_nebs."""
+    from obia_utils.ImageObjects import ImageObjects
+    tile_io = ImageObjects(tile_objects)
+    tile_io.objects[tile_io.nebs_fld] = tile_nebs.reindex(
+        tile_io.objects.index)
+    in_fields = set(tile_io.fields) - {tile_io.nebs_fld}
+    tile_io.classify_objects(**classify_kwargs)
+
+    class_fld = classify_kwargs.get('class_fld') or tile_io.class_fld
+    out_fields = [f for f in tile_io.fields
+                  if f not in in_fields or f == class_fld or
+                  f in tile_io.rule_fields]
+    results = tile_io.objects.loc[core_ids, out_fields]
+
+    return results, tile_io.rule_fields
+
+
+def tiled_classify(image_objects, tile_size, halo=0, num_cores=None,
+                   **classify_kwargs):
+    """
+    Run ImageObjects.classify_objects on tiles of image_objects in a
+    process pool and write the results back to image_objects.
+
+    Each call is one reconciled step: every tile sees the classes and
+    values of all objects as they were before the call, so rules on the
+    class field of neighbors (set by earlier classify_objects calls)
+    give the same result as when classifying all objects at once.
+    Neighbors already computed, or available from the label raster or
+    adjacency cache of image_objects, are passed to the tiles, so only
+    the remaining neighbors are computed from geometries.
+
+    Parameters
+    ----------
+    image_objects : ImageObjects
+    tile_size : float
+        Width and height of tiles, in units of the CRS.
+    halo : float
+        Additional distance around the objects owned by each tile to
+        include, see tile_subsets.
+    num_cores : int
+        Number of processes, defaults to all but two cores.
+    **classify_kwargs
+        Keyword arguments to ImageObjects.classify_objects
+
+    Returns
+    -------
+    None : modifies image_objects in place
+    """
+    nebs_fld = image_objects.nebs_fld
+    if classify_kwargs.get('adj_rules'):
+        # Take any missing neighbors from the label raster or adjacency
+        # cache once, rather than recomputing them from geometries in tiles
+        image_objects.get_neighbors(
+            subset=image_objects.objects[
+                image_objects.objects[nebs_fld].isnull()],
+            known_only=True)
+    objects = image_objects.objects
+    tiles = tile_subsets(objects.drop(columns=nebs_fld),
+                         tile_size=tile_size, halo=halo)
+    logger.info('Classifying {:,} objects in {:,} tiles...'.format(
+        len(objects), len(tiles)))
+    results = run_parallel(_classify_tile,
+                            [(core_ids, tile_objects,
+                              tile_neighbors(objects[nebs_fld],
+                                             tile_objects.index),
+                              classify_kwargs)
+                             for core_ids, tile_objects in tiles],
+                            num_cores=num_cores)
+
+    # Reconcile: each object's results come from the tile that owns it
+    results, rule_fields = zip(*results)
+    results = pd.concat(results).reindex(objects.index)
+    for fld in results.columns:
+        if fld == nebs_fld:
+            # Only keep neighbors the tiles computed, already known
+            # neighbors were restricted to the tile when passed to it
+            has_nebs = results[fld].notnull() & objects[fld].isnull()
+            objects.loc[has_nebs, fld] = results.loc[has_nebs, fld]
+        else:
+            objects[fld] = results[fld]
+    for rf in [rf for tile_rfs in rule_fields for rf in tile_rfs]:
+        if rf not in image_objects.rule_fields:
+            image_objects.rule_fields.append(rf)
+
+
+def _dissolve_tile(geometry, groups, crs):
+    merge_grp = 'merge_group'
+    return gpd.GeoDataFrame({merge_grp: groups}, geometry=geometry,
+                            crs=crs).dissolve(by=merge_grp).geometry
+
+
+def tiled_dissolve(geometry, groups, tile_size, num_cores=None):
+    """
+    Union geometries by group, with groups split into tiles dissolved in a
+    process pool. A group that crosses tile seams is dissolved whole by
+    the tile its first geometry belongs to.
+
+    Parameters
+    ----------
+    geometry : gpd.GeoSeries
+    groups : np.ndarray
+        Group of each geometry
+    tile_size : float
+        Width and height of tiles, in units of the CRS.
+    num_cores : int
+        Number of processes, defaults to all but two cores.
+
+    Returns
+    -------
+    gpd.GeoSeries : Dissolved geometry of each group, indexed by group
+    """
+    groups = pd.Series(np.asarray(groups))
+    keys = tile_keys(geometry, tile_size)
+    # Owner tile of each group, broadcast to all of the group's geometries
+    owner = pd.Series(keys).groupby(groups).transform('first').values
+    jobs = [(geometry.values[owner == key], groups.values[owner == key],
+             geometry.crs)
+            for key in np.unique(owner)]
+    logger.debug('Dissolving {:,} groups in {:,} tiles...'.format(
+        groups.nunique(), len(jobs)))
+    results = run_parallel(_dissolve_tile, jobs, num_cores=num_cores)
+
+    return pd.concat(results).sort_index()
@@ -231,7 +231,8 @@ def classify_rts(sub_objects_path,
             gdf = select_in_aoi(read_vec(sub_objects_path), aoi, centroid=True)
             hwc = ImageObjects(objects_path=gdf, value_fields=value_fields)
         else:
-            hwc = ImageObjects(objects_path=sub_objects_path, value_fields=value_fields)
+            hwc = ImageObjects(objects_path=sub_objects_path, value_fields=value_fields,
+                               adjacency_cache=True)
 
 
         #%% Classify headwalls
@@ -262,43 +263,37 @@ def classify_rts(sub_objects_path,
     #%% Load super objects
     logger.info('Loading RTS candidate objects...')
     so = ImageObjects(super_objects_path,
-                      value_fields=value_fields)
+                      value_fields=value_fields,
+                      adjacency_cache=True)
     logger.info('Determining RTS candidates...')
 
     #%% Find objects that contain headwalls of a higher elevation than
     # themselves
-    so.objects[contains_hw_gtr] = so.objects.apply(
-        lambda x: overlay_any_objects(
-            x.geometry,
-            hwc.objects[hwc.objects[hwc.class_fld] == hw_candidate],
-            predicate='contains',
-            threshold=x[elev_mean],
-            other_value_field=elev_mean,
-            op=operator.gt),
-        axis=1)
-    so.objects[contains_hw] = so.objects.apply(
-        lambda x: overlay_any_objects(
-            x.geometry,
-            hwc.objects[hwc.objects[hwc.class_fld] == hw_candidate],
-            predicate='contains',),
-        axis=1)
-    so.objects[contains_hw_cent] = so.objects.apply(
-        lambda x: overlay_any_objects(
-            x.geometry,
-            hwc.objects[hwc.objects[hwc.class_fld] == hw_candidate],
-            predicate='contains',
-            others_centroid=True),
-        axis=1)
-    so.objects[contains_hw_gtr] = so.objects.apply(
-        lambda x: overlay_any_objects(
-            x.geometry,
-            hwc.objects[hwc.objects[hwc.class_fld] == hw_candidate],
-            predicate='contains',
-            threshold=x[elev_mean],
-            other_value_field=elev_mean,
-            op=operator.gt,
-            others_centroid=True),
-        axis=1)
+    headwalls = hwc.objects[hwc.objects[hwc.class_fld] == hw_candidate]
+    so.objects[contains_hw_gtr] = overlay_any_objects(
+        so.objects,
+        headwalls,
+        predicate='contains',
+        threshold=so.objects[elev_mean],
+        other_value_field=elev_mean,
+        op=operator.gt)
+    so.objects[contains_hw] = overlay_any_objects(
+        so.objects,
+        headwalls,
+        predicate='contains',)
+    so.objects[contains_hw_cent] = overlay_any_objects(
+        so.objects,
+        headwalls,
+        predicate='contains',
+        others_centroid=True)
+    so.objects[contains_hw_gtr] = overlay_any_objects(
+        so.objects,
+        headwalls,
+        predicate='contains',
+        threshold=so.objects[elev_mean],
+        other_value_field=elev_mean,
+        op=operator.gt,
+        others_centroid=True)
 
     #%% Classify
     so.classify_objects(class_name=rts_candidate,
@@ -204,6 +204,7 @@ def main(dem, dem_prev,
                     '{}'.format(project_dir))
         os.makedirs(project_dir)
     SCRATCH_DIR = project_dir / 'scratch'
+    ZS_CACHE_DIR = SCRATCH_DIR / 'zs_cache'
     IMG_DIR = project_dir / 'img'
     PANSH_DIR = project_dir / 'pansh'
     NDVI_DIR = project_dir / 'ndvi'
@@ -405,7 +406,8 @@ def main(dem, dem_prev,
             zonal_stats_inputs[img_k][bands_k] = hw_config[zonal_stats][bands_k]
         hw_objects = calc_zonal_stats(shp=cleaned_objects_out,
                                       rasters=zonal_stats_inputs,
-                                      out_path=hw_zs_out)
+                                      out_path=hw_zs_out,
+                                      cache_dir=str(ZS_CACHE_DIR))
     else:
         logger.debug('Using provided headwall objects with zonal stats: '
                      '{}'.format(Path(hw_zs_out).relative_to(project_dir)))
@@ -467,7 +469,8 @@ def main(dem, dem_prev,
                               if k in rts_config[zonal_stats][zs_rasters]}
         rts_objects = calc_zonal_stats(shp=cleaned_objects_out,
                                        rasters=zonal_stats_inputs,
-                                       out_path=rts_zs_out)
+                                       out_path=rts_zs_out,
+                                       cache_dir=str(ZS_CACHE_DIR))
     else:
         logger.debug('Using provided RTS zonal stats objects: '
                      '{}'.format(Path(rts_zs_out).relative_to(project_dir)))
@@ -575,7 +578,8 @@ def main(dem, dem_prev,
                      '{}'.format(zonal_stats_inputs.keys()))
         grow = calc_zonal_stats(shp=merged_out,
                                 rasters=zonal_stats_inputs,
-                                out_path=str(grow_zs_out))
+                                out_path=str(grow_zs_out),
+                                cache_dir=str(ZS_CACHE_DIR))
 
     # Do growing
     logger.info('Growing RTS objects into subobjects...')
@@ -0,0 +1,109 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+from obia_utils.adjacency import query_pairs, rtree_query_pairs
+
+
+@pytest.fixture
+def geoms():
+    # Unit grid of 3 x 3 squares
+    tree = gpd.GeoSeries([box(c, r, c + 1, r + 1)
+                          for r in range(3) for c in range(3)])
+    # A square containing tree square 0, a square within tree square 4 and
+    # a square overlapping tree squares 4, 5, 7 and 8
+    query = gpd.GeoSeries([box(-0.5, -0.5, 1.5, 1.5),
+                           box(1.25, 1.25, 1.75, 1.75),
+                           box(1.5, 1.5, 2.5, 2.5)])
+    return tree, query
+
+
+def sorted_pairs(pairs):
+    query_idx, tree_idx = pairs
+    return sorted(zip(np.asarray(query_idx).tolist(),
+                      np.asarray(tree_idx).tolist()))
+
+
+@pytest.mark.parametrize('predicate', ['intersects', 'touches', 'contains',
+                                       'within', 'overlaps'])
+def test_rtree_matches_query_pairs(geoms, predicate):
+    tree, query = geoms
+    assert sorted_pairs(rtree_query_pairs(tree, query, predicate)) == \
+        sorted_pairs(query_pairs(tree, query, predicate))
+
+
+def test_predicate_order(geoms):
+    # predicate(query, tree)
+    tree, query = geoms
+    assert sorted_pairs(rtree_query_pairs(tree, query, 'contains')) == [(0, 0)]
+    assert sorted_pairs(rtree_query_pairs(tree, query, 'within')) == [(1, 4)]
+
+
+def test_label_neighbors_match_touches(tmp_path):
+    rasterio = pytest.importorskip('rasterio')
+    from rasterio.features import shapes
+    from rasterio.transform import from_origin
+    from shapely.geometry import shape
+    from obia_utils.ImageObjects import ImageObjects
+
+    # Labels of the nearest of a few random seeds, as irregular segments
+    rng = np.random.default_rng(0)
+    seeds = rng.uniform(0, 20, (12, 2))
+    rows, cols = np.mgrid[0:20, 0:20]
+    labels = np.argmin(np.hypot(rows[..., None] - seeds[:, 0],
+                                cols[..., None] - seeds[:, 1]),
+                       axis=-1).astype('int32') + 1
+    transform = from_origin(0, 20, 1, 1)
+    label_raster = str(tmp_path / 'labels.tif')
+    with rasterio.open(label_raster, 'w', driver='GTiff', width=20,
+                       height=20, count=1, dtype='int32',
+                       transform=transform) as dst:
+        dst.write(labels, 1)
+    polygons = [(shape(geom), value) for geom, value in
+                shapes(labels, transform=transform)]
+    objects = gpd.GeoDataFrame({'raster_val': [v for _, v in polygons]},
+                               geometry=[g for g, _ in polygons])
+    assert objects['raster_val'].is_unique
+
+    from_labels = ImageObjects(objects, label_raster=label_raster)
+    # All neighbors are resolved from labels, none from geometries
+    assert len(from_labels.label_neighbors) == len(objects)
+    from_labels.get_neighbors(from_labels.objects)
+    from_geoms = ImageObjects(objects)
+    from_geoms.get_neighbors(from_geoms.objects)
+    for a, b in zip(from_labels.objects['neighbors'],
+                    from_geoms.objects['neighbors']):
+        assert np.array_equal(np.sort(a), np.sort(b))
+
+
+def test_adjacency_cache(tmp_path, monkeypatch):
+    import obia_utils.ImageObjects as image_objects
+    objects = gpd.GeoDataFrame(geometry=[box(c, r, c + 1, r + 1)
+                                         for r in range(4) for c in range(4)])
+    cache = str(tmp_path / 'adjacency.npz')
+
+    fresh = image_objects.ImageObjects(objects)
+    fresh.get_neighbors(fresh.objects)
+    cached = image_objects.ImageObjects(objects, adjacency_cache=cache)
+    cached.get_neighbors(cached.objects)
+
+    # Reloaded without computing neighbors from geometries
+    def fail(*args, **kwargs):
+        raise AssertionError('neighbors recomputed')
+    monkeypatch.setattr(image_objects, 'touches_adjacency', fail)
+    reloaded = image_objects.ImageObjects(objects, adjacency_cache=cache)
+    reloaded.get_neighbors(reloaded.objects)
+
+    for a, b, c in zip(fresh.objects['neighbors'],
+                       cached.objects['neighbors'],
+                       reloaded.objects['neighbors']):
+        assert np.array_equal(a, b)
+        assert np.array_equal(a, c)
+
+    # Different geometries are not loaded from the cache
+    monkeypatch.undo()
+    moved = objects.copy()
+    moved.geometry = moved.geometry.translate(1, 0)
+    assert image_objects.load_neighbors(
+        cache, image_objects.geometry_hash(moved.geometry)) is None
@@ -0,0 +1,23 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+from misc_utils.gpd_utils import write_gdf
+
+
+@pytest.mark.parametrize('out_name, layer', [('objects.gpkg', 'objects'),
+                                             ('objects.shp', None)])
+def test_write_gdf_append(tmp_path, out_name, layer):
+    gdf = gpd.GeoDataFrame({'a': np.arange(10), 'v': np.linspace(0, 1, 10)},
+                           geometry=[box(i, 0, i + 1, 1) for i in range(10)],
+                           crs='epsg:32633')
+    out_path = tmp_path / out_name
+    out_footprint = out_path / layer if layer else out_path
+    for start in range(0, len(gdf), 4):
+        write_gdf(gdf.iloc[start:start + 4], out_footprint,
+                  append=start > 0)
+
+    written = gpd.read_file(str(out_path), layer=layer)
+    assert list(written['a']) == list(gdf['a'])
+    assert written.geometry.geom_equals(gdf.geometry).all()
@@ -0,0 +1,74 @@
+import operator
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+from obia_utils.ImageObjects import ImageObjects, create_rule
+
+
+def strip_objects(values):
+    """One row of adjacent rectangles, with widths 1, 2, 3, ... so that
+    objects are merged in index order (smallest first)."""
+    geoms = []
+    x = 0
+    for width in range(1, len(values) + 1):
+        geoms.append(box(x, 0, x + width, 1))
+        x += width
+    return gpd.GeoDataFrame({'v': values}, geometry=geoms)
+
+
+def merge_paths(values, max_iter=None):
+    io = ImageObjects(strip_objects(values), value_fields=[('v', 'mean')])
+    io.pseudo_merging(merge_candidate_rules=[
+                          create_rule('threshold', 'v', operator.lt, 0.4)],
+                      pairwise_criteria=None,
+                      grow_fields=['v'],
+                      max_iter=max_iter)
+    return {i: sorted(mp.tolist())
+            for i, mp in io.objects[io.mp_fld].sort_index().items()}
+
+
+def test_only_candidates_are_merged():
+    # Candidates (v < 0.4): 0, 1, 3. Object 2 is not a candidate.
+    # 0 merges into its only neighbor 1. 1 and 3 then only neighbor 2,
+    # which is not a candidate, so nothing else merges. In particular 2
+    # must not be merged into candidate 3.
+    assert merge_paths([0.1, 0.2, 0.9, 0.3]) == {0: [], 1: [0], 2: [], 3: []}
+
+
+def test_non_candidates_not_merged_max_iter():
+    # No candidate neighbors each other, so there are no merges at all
+    assert merge_paths([0.1, 0.9, 0.2, 0.8, 0.3], max_iter=1) == \
+        {i: [] for i in range(5)}
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_merge_aggregates_original_values(seed):
+    # Grid of rectangles with random widths and heights, so areas differ
+    rng = np.random.default_rng(seed)
+    xs = np.concatenate([[0], np.cumsum(rng.uniform(0.5, 2, 6))])
+    ys = np.concatenate([[0], np.cumsum(rng.uniform(0.5, 2, 6))])
+    original = gpd.GeoDataFrame(
+        {'v': rng.random(36), 's': rng.random(36)},
+        geometry=[box(xs[c], ys[r], xs[c + 1], ys[r + 1])
+                  for r in range(6) for c in range(6)])
+    io = ImageObjects(original, value_fields=[('v', 'mean'), ('s', 'sum')])
+    io.pseudo_merging(merge_candidate_rules=[
+                          create_rule('threshold', 'v', operator.lt, 0.6)],
+                      pairwise_criteria=None,
+                      grow_fields=['v'])
+    io.merge(aggregate_values=True)
+    assert len(io.objects) < len(original)
+
+    # Brute force: original objects within each merged object, area
+    # weighted mean and sum of their values
+    points = original.representative_point()
+    for _, merged in io.objects.iterrows():
+        members = original[points.within(merged.geometry).values]
+        assert members.geometry.unary_union.equals(merged.geometry)
+        areas = members.geometry.area
+        assert merged['v'] == pytest.approx(
+            (members['v'] * areas).sum() / areas.sum())
+        assert merged['s'] == pytest.approx(members['s'].sum())
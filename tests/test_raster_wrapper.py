@@ -0,0 +1,224 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from misc_utils.RasterWrapper import GTIFF_BLOCKSIZE, Raster  # noqa: E402
+
+NODATA = -9999
+# Raster of 40 x 30 pixels of size 2, upper left at (100, 200)
+WIDTH, HEIGHT = 40, 30
+GEOTRANSFORM = (100, 2, 0, 200, 0, -2)
+
+
+@pytest.fixture
+def values():
+    """Two bands of positive integers with some NoData, including a 7 x 7
+    block of NoData in both bands."""
+    rng = np.random.default_rng(0)
+    values = rng.integers(1, 50, (2, HEIGHT, WIDTH)).astype('int16')
+    values[rng.random(values.shape) < 0.1] = NODATA
+    values[:, 10:17, 20:27] = NODATA
+    return values
+
+
+def write_raster(path, values):
+    """Write (bands, rows, cols) values as a GeoTIFF in 16 x 16 blocks."""
+    ds = gdal.GetDriverByName('GTiff').Create(
+        path, WIDTH, HEIGHT, len(values), gdal.GDT_Int16,
+        options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+    ds.SetGeoTransform(GEOTRANSFORM)
+    for b, arr in enumerate(values, start=1):
+        ds.GetRasterBand(b).SetNoDataValue(NODATA)
+        ds.GetRasterBand(b).WriteArray(arr)
+    ds = None
+
+
+@pytest.fixture
+def raster_path(values, request):
+    """values written in memory."""
+    path = '/vsimem/{}.tif'.format(request.node.name)
+    write_raster(path, values)
+    yield path
+    gdal.Unlink(path)
+
+
+@pytest.fixture
+def out_path(request):
+    path = '/vsimem/{}_out.tif'.format(request.node.name)
+    yield path
+    gdal.Unlink(path)
+
+
+def padded(values, xoff, yoff, xsize, ysize, fill_value):
+    """Brute force window of values, filled outside of the raster."""
+    window = np.full(values.shape[:-2] + (ysize, xsize), fill_value,
+                     dtype=np.float64)
+    for r in range(ysize):
+        for c in range(xsize):
+            if 0 <= yoff + r < HEIGHT and 0 <= xoff + c < WIDTH:
+                window[..., r, c] = values[..., yoff + r, xoff + c]
+    return window
+
+
+def valid_mean3(values):
+    """Brute force mean of the valid values in the 3 x 3 window around
+    each pixel, clipped at the edges, NaN where there are none."""
+    result = np.full(values.shape, np.nan)
+    for r in range(HEIGHT):
+        for c in range(WIDTH):
+            window = values[max(r - 1, 0):r + 2, max(c - 1, 0):c + 2]
+            window = window[window != NODATA]
+            if window.size:
+                result[r, c] = window.mean()
+    return result
+
+
+def mean3(arr):
+    """Mean of the valid values in the 3 x 3 window around each pixel of
+    a masked array, masked where there are none."""
+    filled = np.pad(arr.filled(0).astype(np.float64), 1)
+    valid = np.pad((~np.ma.getmaskarray(arr)).astype(np.float64), 1)
+    rows, cols = arr.shape
+    sums = sum(filled[dr:dr + rows, dc:dc + cols]
+               for dr in range(3) for dc in range(3))
+    counts = sum(valid[dr:dr + rows, dc:dc + cols]
+                 for dr in range(3) for dc in range(3))
+    return np.ma.masked_where(counts == 0, sums / np.maximum(counts, 1))
+
+
+@pytest.mark.parametrize('read_array', [False, True])
+@pytest.mark.parametrize('window', [(-3, -2, 8, 6), (35, 25, 10, 10),
+                                    (5, 5, 10, 10), (-5, 10, 50, 3)])
+def test_read_window_padding(raster_path, values, window, read_array):
+    raster = Raster(raster_path)
+    if read_array:
+        # Windows are sliced from the array once it has been read
+        raster.Array
+    np.testing.assert_array_equal(raster.ReadWindow(*window, band=2),
+                                  padded(values[1], *window, NODATA))
+    np.testing.assert_array_equal(raster.ReadWindow(*window),
+                                  padded(values, *window, NODATA))
+    # A fill value that can not be represented in the data type
+    result = raster.ReadWindow(*window, fill_value=np.nan, band=1)
+    np.testing.assert_array_equal(result, padded(values[0], *window, np.nan))
+
+
+def test_read_window_outside(raster_path):
+    raster = Raster(raster_path)
+    assert raster.ReadWindow(-10, 0, 10, 5) is None
+    assert raster.ReadWindow(0, HEIGHT, 5, 5, band=1) is None
+
+
+def test_iter_blocks_cover_raster(raster_path):
+    raster = Raster(raster_path)
+    covered = np.zeros((HEIGHT, WIDTH), dtype=int)
+    for (xoff, yoff, xsize, ysize), halo_window in raster.IterBlocks(
+            block_size=(16, 16), halo=2):
+        covered[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+        assert halo_window == (xoff - 2, yoff - 2, xsize + 4, ysize + 4)
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize('num_threads', [1, 2])
+def test_map_blocks_halo(raster_path, out_path, values, num_threads):
+    raster = Raster(raster_path)
+    raster.MapBlocks(mean3, out_path, block_size=(16, 16), halo=1,
+                     num_threads=num_threads, dtype=gdal.GDT_Float32)
+    result = Raster(out_path)
+    assert result.nodata_val == NODATA
+    expected = valid_mean3(values[0])
+    np.testing.assert_allclose(result.Array,
+                               np.where(np.isnan(expected), NODATA,
+                                        expected),
+                               rtol=1e-6)
+
+
+def test_map_blocks_without_halo_differs(raster_path, out_path, values):
+    # Without a halo, windows at the block edges are clipped
+    raster = Raster(raster_path)
+    raster.MapBlocks(mean3, out_path, block_size=(16, 16),
+                     dtype=gdal.GDT_Float32)
+    expected = valid_mean3(values[0])
+    edges = Raster(out_path).Array[:, 15:17] != \
+        np.where(np.isnan(expected), NODATA, expected)[:, 15:17]
+    assert edges.any()
+
+
+def test_band_math_nodata(raster_path, out_path, values):
+    raster = Raster(raster_path)
+    raster.BandMath('(a - b) / (a + b)', {'a': 1, 'b': 2}, out_path,
+                    block_size=(16, 16), num_threads=2)
+    result = Raster(out_path)
+    assert result.nodata_val == NODATA
+    a, b = values.astype(np.float64)
+    nodata = (values == NODATA).any(axis=0)
+    expected = np.where(nodata, NODATA, (a - b) / (a + b))
+    np.testing.assert_allclose(result.Array, expected, rtol=1e-6)
+
+
+def test_sample_points(raster_path):
+    raster = Raster(raster_path)
+    rng = np.random.default_rng(1)
+    # (y, x) in geocoordinates, some outside of the raster
+    points = np.column_stack([rng.uniform(130, 210, 200),
+                              rng.uniform(90, 190, 200)])
+    result = raster.SamplePoints(points, band=1)
+    for i, point in enumerate(points):
+        expected = raster.SamplePoint(point)
+        if expected is None:
+            assert result.mask[i]
+        else:
+            expected = expected[0]
+            assert result.mask[i] == (expected == NODATA)
+            assert result.data[i] == expected
+
+
+@pytest.mark.parametrize('window_size', [(1, 1), (3, 3), (5, 3)])
+@pytest.mark.parametrize('grow_window,max_grow', [(False, 100000),
+                                                  (True, 25),
+                                                  (True, 100000)])
+def test_sample_windows(raster_path, values, window_size, grow_window,
+                        max_grow):
+    # SampleWindow assumes a single band
+    path = raster_path.replace('.tif', '_band1.tif')
+    write_raster(path, values[:1])
+    raster = Raster(path)
+    rng = np.random.default_rng(2)
+    # Random points within the raster, and the center of the NoData block
+    points = np.column_stack([rng.uniform(142, 198, 100),
+                              rng.uniform(102, 178, 100)])
+    points = np.vstack([points, [[174, 146]]])
+    aggs = ['mean', 'sum', 'min', 'max']
+    result = raster.SampleWindows(points, window_size, aggs=aggs,
+                                  grow_window=grow_window,
+                                  max_grow=max_grow)
+    for agg in aggs:
+        expected = [raster.SampleWindow(point, window_size, agg=agg,
+                                        grow_window=grow_window,
+                                        max_grow=max_grow)
+                    for point in points]
+        np.testing.assert_allclose(result[agg], expected, rtol=1e-6)
+    # The NoData block is only sampled by growing past 7 x 7 windows
+    assert (result['mean'][-1] == NODATA) == (not grow_window or
+                                              max_grow < 49)
+    gdal.Unlink(path)
+
+
+@pytest.mark.parametrize('cog_driver', [True, False])
+def test_map_blocks_cog(raster_path, out_path, values, cog_driver,
+                        monkeypatch):
+    if not cog_driver:
+        # GDAL < 3.1
+        get_driver = gdal.GetDriverByName
+        monkeypatch.setattr(gdal, 'GetDriverByName',
+                            lambda name: None if name == 'COG'
+                            else get_driver(name))
+    elif gdal.GetDriverByName('COG') is None:
+        pytest.skip('COG driver not available')
+    raster = Raster(raster_path)
+    raster.MapBlocks(lambda arr: arr, out_path, block_size=(16, 16),
+                     cog=True)
+    result = Raster(out_path)
+    assert result.BlockSize() == (GTIFF_BLOCKSIZE, GTIFF_BLOCKSIZE)
+    np.testing.assert_array_equal(result.Array, values[0])
@@ -0,0 +1,50 @@
+import operator
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+from obia_utils.ImageObjects import ImageObjects, create_rule
+from obia_utils.tiling import tiled_dissolve
+
+
+@pytest.fixture
+def grid():
+    rng = np.random.default_rng(0)
+    n = 10
+    return gpd.GeoDataFrame({'v': rng.random(n * n), 'w': rng.random(n * n)},
+                            geometry=[box(c, r, c + 1, r + 1)
+                                      for r in range(n) for c in range(n)])
+
+
+def classify(objects, **kwargs):
+    io = ImageObjects(objects)
+    io.classify_objects(
+        'a', threshold_rules=[create_rule('threshold', 'v', operator.lt, 0.6)],
+        adj_rules=[create_rule('adjacent', 'w', operator.gt, 0.7)],
+        **kwargs)
+    # Second step with a rule on the class of neighbors from the first
+    io.objects['is_a'] = io.objects['class'] == 'a'
+    io.classify_objects(
+        'b', threshold_rules=[create_rule('threshold', 'w', operator.lt, 0.5)],
+        adj_rules=[create_rule('adjacent', 'is_a', operator.eq, True)],
+        **kwargs)
+    return io.objects['class']
+
+
+@pytest.mark.parametrize('num_cores', [1, 2])
+def test_tiled_classify_matches_untiled(grid, num_cores):
+    untiled = classify(grid)
+    tiled = classify(grid, tile_size=3, halo=1, num_cores=num_cores)
+    assert untiled.notnull().any()
+    assert tiled.equals(untiled)
+
+
+def test_tiled_dissolve_matches_dissolve(grid):
+    groups = (np.arange(len(grid)) * 7) % 13
+    dissolved = gpd.GeoDataFrame({'group': groups}, geometry=grid.geometry)\
+        .dissolve(by='group').geometry
+    tiled = tiled_dissolve(grid.geometry, groups, tile_size=3, num_cores=2)
+    assert list(tiled.index) == list(dissolved.index)
+    assert all(t.equals(d) for t, d in zip(tiled, dissolved))
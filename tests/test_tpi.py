@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from dem_utils.tpi_engine import tpi_windows
+
+
+@pytest.fixture
+def dem():
+    rng = np.random.default_rng(0)
+    dem = rng.normal(100, 10, (23, 31))
+    mask = rng.random(dem.shape) < 0.15
+    # A block of NoData larger than the smaller windows
+    mask[5:12, 8:15] = True
+    return np.ma.masked_array(dem, mask=mask)
+
+
+def brute_tpi(dem, inner, outer):
+    """Value - mean of the valid values in the outer window, excluding the
+    inner window, with windows clipped at the edges."""
+    data, mask = dem.data, np.ma.getmaskarray(dem)
+    rows, cols = data.shape
+    tpi = np.ma.masked_all(data.shape)
+    for r in range(rows):
+        for c in range(cols):
+            if mask[r, c]:
+                continue
+            window = []
+            for wr in range(r - outer // 2, r + outer // 2 + 1):
+                for wc in range(c - outer // 2, c + outer // 2 + 1):
+                    if inner and abs(wr - r) <= inner // 2 and \
+                            abs(wc - c) <= inner // 2:
+                        continue
+                    if 0 <= wr < rows and 0 <= wc < cols and \
+                            not mask[wr, wc]:
+                        window.append(data[wr, wc])
+            if window:
+                tpi[r, c] = data[r, c] - np.mean(window)
+    return tpi
+
+
+def test_tpi_windows_match_brute_force(dem):
+    windows = [3, 9, (1, 3), (1, 7), (3, 11), 41]
+    for window, tpi in zip(windows, tpi_windows(dem, windows)):
+        inner, outer = window if isinstance(window, tuple) else (0, window)
+        expected = brute_tpi(dem, inner, outer)
+        # Masked where dem is masked or there are no valid values
+        np.testing.assert_array_equal(np.ma.getmaskarray(tpi),
+                                      np.ma.getmaskarray(expected))
+        np.testing.assert_allclose(tpi.compressed(), expected.compressed(),
+                                   atol=1e-9, err_msg=str(window))
+
+
+def test_tpi_windows_explicit_mask(dem):
+    # NoData values given as a separate mask of an unmasked array
+    nodata = dem.filled(-9999)
+    tpi = tpi_windows(nodata, [(1, 5)], mask=nodata == -9999)[0]
+    np.testing.assert_allclose(tpi.filled(0),
+                               brute_tpi(dem, 1, 5).filled(0), atol=1e-9)
+
+
+def test_tpi_window_without_valid_values():
+    dem = np.ma.masked_array(np.ones((5, 5)), mask=True)
+    dem.mask[2, 2] = False
+    # The only valid value is the center, excluded by the annulus
+    assert tpi_windows(dem, [(1, 3)])[0].mask.all()
+    assert tpi_windows(dem, [3])[0][2, 2] == 0
+
+
+@pytest.mark.parametrize('window', [4, (2, 5), (1, 6)])
+def test_even_window_rejected(dem, window):
+    with pytest.raises(ValueError):
+        tpi_windows(dem, [window])
@@ -0,0 +1,175 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterstats import zonal_stats
+from shapely.geometry import Polygon, box
+
+from obia_utils import calc_zonal_stats as czs
+
+NODATA = -9999
+# Raster of 40 x 30 pixels of size 1, upper left at (0, 30)
+WIDTH, HEIGHT = 40, 30
+
+LABEL_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median',
+               'majority', 'minority', 'unique', 'range', 'percentile_25']
+STREAM_EXACT = ['count', 'min', 'max', 'mean', 'sum', 'std', 'range']
+
+
+@pytest.fixture(scope='module')
+def raster(tmp_path_factory):
+    """Integer values with some NoData in the lower half, in 16 x 16
+    blocks."""
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 20, (HEIGHT, WIDTH)).astype('int16')
+    values[15:][rng.random((HEIGHT - 15, WIDTH)) < 0.1] = NODATA
+    # An object's worth of NoData
+    values[2:6, 30:36] = NODATA
+    path = str(tmp_path_factory.mktemp('rasters') / 'values.tif')
+    with rio.open(path, 'w', driver='GTiff', width=WIDTH, height=HEIGHT,
+                  count=1, dtype='int16', nodata=NODATA, tiled=True,
+                  blockxsize=16, blockysize=16,
+                  transform=from_origin(0, HEIGHT, 1, 1)) as dst:
+        dst.write(values, 1)
+    return path
+
+
+@pytest.fixture(scope='module')
+def objects():
+    """Non-overlapping objects: rectangles, triangles, an object of only
+    NoData, one partly and one entirely outside the raster."""
+    geoms = [box(x, y, x + 5.5, y + 4.5)
+             for x in range(0, 25, 6) for y in range(0, 25, 5)]
+    geoms.extend([Polygon([(31, 0), (39, 0), (31, 9)]),
+                  Polygon([(39.5, 10), (39.5, 20), (32, 20)]),
+                  box(30, 24, 36, 28),
+                  box(36.2, 21, 45, 29),
+                  box(50, 50, 60, 60)])
+    return gpd.GeoDataFrame({'obj': np.arange(len(geoms))}, geometry=geoms,
+                            index=np.arange(100, 100 + len(geoms)))
+
+
+def reference_stats(objects, raster, stats):
+    ref = pd.DataFrame(zonal_stats(objects.geometry, raster, stats=stats),
+                       index=objects.index)
+    return ref[stats].astype(float)
+
+
+def assert_stats_equal(result, expected, **kwargs):
+    for stat in expected.columns:
+        np.testing.assert_allclose(result[stat].astype(float),
+                                   expected[stat], err_msg=stat, **kwargs)
+
+
+def test_label_stats_match_rasterstats(objects, raster):
+    result = czs.compute_label_stats(objects, raster, LABEL_STATS)
+    expected = reference_stats(objects, raster, LABEL_STATS)
+    # Objects without valid pixels
+    assert (expected['count'] == 0).sum() >= 2
+    assert_stats_equal(result, expected)
+
+
+@pytest.mark.parametrize('max_pixels', [64, 2**22])
+def test_stream_stats_match_rasterstats(objects, raster, max_pixels):
+    stats = STREAM_EXACT + ['median', 'percentile_25']
+    result = czs.stream_label_stats(objects, raster, stats,
+                                     quantile_bins=100,
+                                     max_pixels=max_pixels)
+    expected = reference_stats(objects, raster, stats)
+    assert_stats_equal(result[STREAM_EXACT], expected[STREAM_EXACT])
+    # Quantiles within a bin of the exact value
+    tolerance = (expected['max'] - expected['min']) / 100
+    for stat in ['median', 'percentile_25']:
+        error = (result[stat] - expected[stat]).abs()
+        assert (error[expected['count'] > 0] <=
+                tolerance[expected['count'] > 0] + 1e-9).all()
+        assert result[stat][expected['count'] == 0].isnull().all()
+
+
+def test_glcm_matches_skimage(objects, raster):
+    skimage_feature = pytest.importorskip('skimage.feature')
+    props = ['contrast', 'dissimilarity', 'homogeneity', 'ASM', 'energy',
+             'correlation', 'entropy']
+    result = czs.compute_label_stats(objects, raster,
+                                     ['glcm_{}'.format(p) for p in props])
+    with rio.open(raster) as src:
+        labels, window = czs.rasterize_objects(objects.geometry, src)
+        values = src.read(1, window=window, masked=True)
+        vmin, vmax = czs.band_range(src)
+    quantized = czs.quantize(values, vmin, vmax)
+
+    # Objects covering a rectangle of pixels, without NoData
+    checked = 0
+    for pos, i in enumerate(objects.index):
+        rows, cols = np.nonzero(labels == pos + 1)
+        if len(rows) == 0:
+            continue
+        rows = slice(rows.min(), rows.max() + 1)
+        cols = slice(cols.min(), cols.max() + 1)
+        crop = quantized[rows, cols]
+        if (labels[rows, cols] != pos + 1).any() or (crop < 0).any():
+            continue
+        glcm = skimage_feature.graycomatrix(
+            crop.astype(np.uint8), distances=[1],
+            angles=[0, np.pi / 4, np.pi / 2, 3 * np.pi / 4],
+            levels=czs.GLCM_LEVELS, symmetric=True, normed=True)
+        for p in props:
+            expected = skimage_feature.graycoprops(glcm, p).mean()
+            assert result.at[i, 'glcm_{}'.format(p)] == \
+                pytest.approx(expected, rel=1e-6, abs=1e-6), p
+        checked += 1
+    assert checked > 0
+
+
+def test_parallel_matches_serial(objects, raster):
+    serial = czs.raster_stats(objects, raster, 'r', ['mean', 'median',
+                                                     'count'])
+    parallel = czs.parallel_raster_stats(objects, [raster], ['r'],
+                                         [['mean', 'median', 'count']],
+                                         [None], chunk_size=12, num_cores=2)
+    pd.testing.assert_frame_equal(pd.DataFrame(parallel),
+                                  pd.DataFrame(serial), check_dtype=False)
+
+
+def test_cached_matches_fresh(objects, raster, tmp_path, monkeypatch):
+    stats = ['mean', 'std', 'median']
+    fresh = czs.raster_stats(objects, raster, 'r', stats)
+    cache_dir = str(tmp_path / 'cache')
+    computed = czs.cached_raster_stats(objects, [raster], ['r'], [stats],
+                                       [None], cache_dir)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('stats recomputed')
+    monkeypatch.setattr(czs, 'raster_stats', fail)
+    cached = czs.cached_raster_stats(objects, [raster], ['r'], [stats],
+                                     [None], cache_dir)
+    for result in (computed, cached):
+        assert list(result.columns) == list(fresh.columns)
+        pd.testing.assert_frame_equal(pd.DataFrame(result),
+                                      pd.DataFrame(fresh),
+                                      check_dtype=False)
+
+
+def test_shape_metrics():
+    geoms = gpd.GeoSeries([box(0, 0, 4, 1),
+                           Polygon([(0, 0), (4, 0), (4, 4), (2, 1), (0, 4)]),
+                           Polygon([(0, 0), (3, 1), (1, 3)])])
+    metrics = czs.shape_metrics(geoms)
+    for i, g in geoms.items():
+        rect = g.minimum_rotated_rectangle
+        sides = sorted(np.hypot(*np.diff(np.asarray(rect.exterior.coords),
+                                         axis=0)[:2].T))
+        assert metrics.at[i, 'compactness'] == \
+            pytest.approx(4 * np.pi * g.area / g.length ** 2)
+        assert metrics.at[i, 'roundness'] == \
+            pytest.approx(g.length ** 2 / (4 * np.pi * g.area))
+        assert metrics.at[i, 'convexity'] == \
+            pytest.approx(g.convex_hull.length / g.length)
+        assert metrics.at[i, 'rectangularity'] == \
+            pytest.approx(g.area / rect.area)
+        assert metrics.at[i, 'mrr_aspect'] == pytest.approx(sides[1] /
+                                                            sides[0])
+    # Elongation of a rectangle is its aspect ratio
+    assert metrics.at[0, 'elongation'] == pytest.approx(4)